@@ -5,3 +5,11 @@ class GeolocationError(Exception):
     geolocated.
     """
     pass
+
+
+class AddressNotFoundError(GeolocationError):
+    """
+    An error that occurs whenever the geocoder
+    does not find an address.
+    """
+    pass
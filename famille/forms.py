@@ -152,7 +152,19 @@ class PrestatairePlanningSubForm(PlanningSubForm):
         model = PrestatairePlanning
 
 
-class BaseFamillePlanningForm(object):
+class BasePlanningForm(object):
+
+    def save(self, *args, **kwargs):
+        """
+        Save the plannings and rebuild the
+        availability bitmask of the user.
+        """
+        instance = super(BasePlanningForm, self).save(*args, **kwargs)
+        instance.update_availability()
+        return instance
+
+
+class BaseFamillePlanningForm(BasePlanningForm):
     foreign_model = FamillePlanning
     origin_model_name = "famille"
     related_name = "planning"
@@ -162,7 +174,8 @@ class BaseFamillePlanningForm(object):
         model = Famille
         fields = ()
 
-class BasePrestatairePlanningForm(object):
+
+class BasePrestatairePlanningForm(BasePlanningForm):
     foreign_model = PrestatairePlanning
     origin_model_name = "prestataire"
     related_name = "planning"
@@ -462,7 +475,8 @@ class PrestataireSearchForm(BaseSearchForm):
 
     ordering_dict = {
         "-updated_at": u"Le plus récent",
-        "-rating": u"Le mieux noté"
+        "-rating": u"Le mieux noté",
+        "-match": u"Le plus pertinent"
     }
     # BOX 2
     nationality = forms.CharField(
@@ -541,7 +555,8 @@ class FamilleSearchForm(BaseSearchForm):
     search_blocks = []
     ordering_dict = {
         "-updated_at": u"Le plus récent",
-        "-rating": u"Le mieux noté"
+        "-rating": u"Le mieux noté",
+        "-match": u"Le plus pertinent"
     }
     type_attente_famille = forms.MultipleChoiceField(
         label=u"Type d'attentes", required=False, choices=Famille.TYPE_ATTENTES_FAMILLE,
@@ -0,0 +1,131 @@
+from optparse import make_option
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from famille.models import Famille, Prestataire, Geolocation
+from famille.utils.geolocation import bounding_box, distance_sql, grid_cell
+
+
+USER_CLASSES = {
+    "famille": Famille,
+    "prestataire": Prestataire
+}
+# roughly the metropolitan France
+LAT_RANGE = (42.3, 51.1)
+LON_RANGE = (-4.8, 8.2)
+
+
+class Rollback(Exception):
+    pass
+
+
+def random_point():
+    return Geolocation(lat=random.uniform(*LAT_RANGE), lon=random.uniform(*LON_RANGE))
+
+
+def create_users(UserClass, size):
+    """
+    Create geolocated users at random points, with bulk inserts.
+    """
+    last_pk = lambda model: model.objects.order_by("-pk").values_list("pk", flat=True).first() or 0
+    user_pk, geolocation_pk = last_pk(User), last_pk(Geolocation)
+
+    geolocations = [random_point() for _ in xrange(size)]
+    for g in geolocations:
+        g.cell = grid_cell(g.lat, g.lon)
+    Geolocation.objects.bulk_create(geolocations)
+    User.objects.bulk_create([User(username="bench_geolocation_%s" % i) for i in xrange(size)])
+
+    geolocation_pks = Geolocation.objects.filter(pk__gt=geolocation_pk).order_by("pk").values_list("pk", flat=True)
+    user_pks = User.objects.filter(pk__gt=user_pk).order_by("pk").values_list("pk", flat=True)
+    UserClass.objects.bulk_create([
+        UserClass(user_id=u, geolocation_id=g, email="bench_geolocation_%s@example.com" % u)
+        for u, g in zip(user_pks, geolocation_pks)
+    ])
+
+
+def distance_queryset(UserClass, origin, distance):
+    """
+    The users at less than a distance, without any index.
+    """
+    table = connection.ops.quote_name(Geolocation._meta.db_table)
+    where, params = distance_sql(
+        origin, distance,
+        "%s.%s" % (table, connection.ops.quote_name("lat")),
+        "%s.%s" % (table, connection.ops.quote_name("lon"))
+    )
+    return UserClass.objects.filter(geolocation__has_error=False).extra(where=[where], params=params)
+
+
+def bounding_box_queryset(UserClass, origin, distance):
+    """
+    The users at less than a distance, prefiltered
+    on the lat / lon columns.
+    """
+    lat_range, lon_range = bounding_box(origin, distance)
+    return distance_queryset(UserClass, origin, distance).filter(
+        geolocation__lat__range=lat_range, geolocation__lon__range=lon_range
+    )
+
+
+QUERIES = (
+    ("grid", lambda UserClass, origin, distance: UserClass.located_within(origin, distance)),
+    ("bbox", bounding_box_queryset),
+    ("scan", distance_queryset),
+)
+
+
+class Command(BaseCommand):
+    args = "[famille|prestataire]"
+    help = (
+        "Benchmark the radius queries of the search in the database: the grid "
+        "cells index (UserClass.located_within) against a prefilter on the "
+        "lat / lon columns and a full scan. Random users can be created for "
+        "the benchmark, they are removed at the end."
+    )
+    option_list = BaseCommand.option_list + (
+        make_option("--create", type="int", default=0, help="Number of random users created"),
+        make_option("--queries", type="int", default=20, help="Number of radius queries"),
+        make_option("--distance", type="float", default=10.0, help="Radius of the queries in km"),
+        make_option("--seed", type="int", default=0, help="Seed of the random points"),
+    )
+
+    def handle(self, *args, **options):
+        user_type = args[0].lower() if args else "prestataire"
+        if user_type not in USER_CLASSES:
+            raise CommandError("Unknown user type %s" % user_type)
+
+        random.seed(options["seed"])
+        try:
+            with transaction.atomic():
+                self.bench(USER_CLASSES[user_type], options)
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def bench(self, UserClass, options):
+        if options["create"]:
+            create_users(UserClass, options["create"])
+
+        distance = options["distance"]
+        origins = [random_point() for _ in xrange(options["queries"])]
+        print "users: %d, radius: %.1f km, %s" % (UserClass.objects.count(), distance, connection.vendor)
+        print "%10s %15s %12s" % ("query", "ms / query", "results")
+        expected = None
+        for name, query in QUERIES:
+            elapsed, results = 0, []
+            for origin in origins:
+                start = time.time()
+                results.append(sorted(query(UserClass, origin, distance).values_list("pk", flat=True)))
+                elapsed += time.time() - start
+
+            print "%10s %15.3f %12.1f" % (
+                name, elapsed * 1000 / len(origins), float(sum(len(r) for r in results)) / len(origins)
+            )
+            if expected is not None and results != expected:
+                raise CommandError("The %s query does not give the same results" % name)
+            expected = results
@@ -0,0 +1,80 @@
+from optparse import make_option
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from famille.models import Famille, Prestataire, Geolocation, availability_mask
+from famille.utils.matching import MatchScorer
+
+
+USER_CLASSES = {
+    "famille": Famille,
+    "prestataire": Prestataire
+}
+
+
+def random_row(scorer, pk):
+    """
+    Build the values_list row of a random candidate.
+    """
+    model = scorer.model
+    values = {
+        "pk": pk,
+        "geolocation__lat": random.uniform(48.0, 49.5),
+        "geolocation__lon": random.uniform(1.5, 3.5),
+        "rating_avg": random.choice([0, 0, 2.5, 3.75, 5]),
+        "plan": random.choice(model.PLANS.values()),
+    }
+    for name in model.CRITERIA_FIELDS:
+        values[name] = ",".join(str(v) for v in random.sample(range(10), random.randint(0, 3)))
+    for name in model.MATCH_BOOLEAN_FIELDS:
+        values[name] = random.random() < 0.5
+    mask = availability_mask(random.sample(range(1, 8), random.randint(1, 3)), random.sample(range(1, 11), 2))
+    for name, word in zip(model.AVAILABILITY_FIELDS, model.split_availability(mask)):
+        values[name] = word
+    return tuple(values[name] for name in scorer.fields)
+
+
+class Command(BaseCommand):
+    args = "[famille|prestataire]"
+    help = (
+        "Benchmark the match ordering (see famille.utils.matching) on random "
+        "candidates: scoring, then keeping the top K with a bounded heap "
+        "or sorting all the candidates."
+    )
+    option_list = BaseCommand.option_list + (
+        make_option("--candidates", type="int", default=100000, help="Number of candidates"),
+        make_option("--top", type="int", default=20, help="Number of best candidates kept"),
+        make_option("--seed", type="int", default=0, help="Seed of the random candidates"),
+    )
+
+    def handle(self, *args, **options):
+        search_type = args[0].lower() if args else "prestataire"
+        if search_type not in USER_CLASSES:
+            raise CommandError("Unknown search type %s" % search_type)
+
+        random.seed(options["seed"])
+        searcher = Famille(
+            type_garde="0,1", language="1", menage=True, permis=True,
+            availability=availability_mask([1, 3], [3, 4]),
+            geolocation=Geolocation(lat=48.85, lon=2.35)
+        )
+        scorer = MatchScorer(
+            searcher, USER_CLASSES[search_type],
+            settings.SEARCH_MATCH["weights"], settings.SEARCH_MATCH["distance_scale"]
+        )
+        rows = [random_row(scorer, pk) for pk in xrange(options["candidates"])]
+
+        print "%10s %12s %10s" % ("method", "candidates", "ms")
+        start = time.time()
+        top = scorer.top(rows, options["top"])
+        print "%10s %12d %10.1f" % ("heap", len(rows), (time.time() - start) * 1000)
+
+        start = time.time()
+        ranked = scorer.top(rows)[:options["top"]]
+        print "%10s %12d %10.1f" % ("sort", len(rows), (time.time() - start) * 1000)
+
+        if top != ranked:
+            raise CommandError("The heap and the sort do not give the same results")
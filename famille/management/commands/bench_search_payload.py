@@ -0,0 +1,73 @@
+from optparse import make_option
+import time
+from urlparse import urlparse, parse_qsl
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.test.client import RequestFactory
+
+from famille.resources import PrestataireResource, FamilleResource, local_cache
+
+
+RESOURCES = {
+    "prestataire": PrestataireResource,
+    "famille": FamilleResource
+}
+
+
+def get_page(view, url, params):
+    """
+    Request a page of the search API as an anonymous
+    user, return the response and the time it took.
+    """
+    request = RequestFactory().get(url, params)
+    request.user = AnonymousUser()
+    start = time.time()
+    response = view(request, api_name="v1")
+    return response, time.time() - start
+
+
+class Command(BaseCommand):
+    args = "[famille|prestataire]"
+    help = (
+        "Benchmark the payload size and the server time of the pages "
+        "of the search API, with the rendered cards (json) or without (compact)."
+    )
+    option_list = BaseCommand.option_list + (
+        make_option("--pages", type="int", default=10, help="Number of pages requested per format"),
+        make_option("--limit", type="int", default=20, help="Number of results per page"),
+        make_option("--cold", action="store_true", default=False, help="Clear the cache of the cards before each page"),
+    )
+
+    def handle(self, *args, **options):
+        search_type = args[0].lower() if args else "prestataire"
+        if search_type not in RESOURCES:
+            raise CommandError("Unknown search type %s" % search_type)
+
+        resource = RESOURCES[search_type]()
+        view = resource.wrap_view("dispatch_list")
+        url = "/api/v1/%s/" % resource._meta.resource_name
+        print "%10s %8s %15s %15s %12s" % ("format", "pages", "bytes / page", "ms / page", "results")
+        for format in ("json", "compact"):
+            nb_bytes, elapsed, nb_pages, nb_results = 0, 0, 0, 0
+            params = {"format": format, "limit": options["limit"]}
+            while nb_pages < options["pages"]:
+                if options["cold"]:
+                    local_cache.clear()
+                response, duration = get_page(view, url, params)
+                if response.status_code != 200:
+                    raise CommandError("The API returned %s: %s" % (response.status_code, response.content))
+
+                nb_pages += 1
+                nb_bytes += len(response.content)
+                elapsed += duration
+                data = resource._meta.serializer.from_json(response.content)
+                nb_results += len(data["objects"])
+                if not data["meta"]["next"]:
+                    break
+                params = dict(parse_qsl(urlparse(data["meta"]["next"]).query))
+
+            print "%10s %8d %15d %15.1f %12d" % (
+                format, nb_pages, nb_bytes / max(nb_pages, 1),
+                elapsed * 1000 / max(nb_pages, 1), nb_results
+            )
@@ -0,0 +1,27 @@
+from optparse import make_option
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from famille.models import GeolocationJob
+
+
+class Command(BaseCommand):
+    help = "Run the pending geolocation jobs. Only one worker should run at a time."
+    option_list = BaseCommand.option_list + (
+        make_option("--once", action="store_true", default=False, help="Run the due jobs and exit"),
+        make_option("--batch-size", type="int", default=50, help="Number of jobs run per batch"),
+        make_option("--sleep", type="float", default=5.0, help="Seconds to wait when there is no job"),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            nb_jobs = GeolocationJob.run_pending(limit=options["batch_size"])
+            if nb_jobs:
+                logging.info("%s geolocation jobs run", nb_jobs)
+            if options["once"]:
+                if nb_jobs < options["batch_size"]:
+                    return
+            elif not nb_jobs:
+                time.sleep(options["sleep"])
@@ -0,0 +1,47 @@
+import csv
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from famille.models import PostalCode
+
+
+DEFAULT_CSV = os.path.join(settings.PROJECT_DIR, "fixtures", "postal_codes.csv")
+
+
+class Command(BaseCommand):
+    args = "[<csv file>]"
+    help = (
+        "Load postal codes coordinates from a CSV file with code,lat,lon columns. "
+        "Defaults to the bundled famille/fixtures/postal_codes.csv."
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError("This command takes at most one argument: %s" % self.args)
+
+        path = args[0] if args else DEFAULT_CSV
+        try:
+            with open(path) as f:
+                rows = [
+                    (PostalCode.normalize(row["code"].decode("utf-8")), float(row["lat"]), float(row["lon"]))
+                    for row in csv.DictReader(f)
+                ]
+        except IOError:
+            raise CommandError("Cannot read file %s" % path)
+        except (KeyError, ValueError):
+            raise CommandError("File %s should have code,lat,lon columns" % path)
+
+        existing = dict(PostalCode.objects.values_list("code", "pk"))
+        created, updated = [], 0
+        for code, lat, lon in rows:
+            if code in existing:
+                PostalCode.objects.filter(pk=existing[code]).update(lat=lat, lon=lon)
+                updated += 1
+            else:
+                created.append(PostalCode(code=code, lat=lat, lon=lon))
+                existing[code] = None
+
+        PostalCode.objects.bulk_create(created)
+        print "%s postal codes created, %s updated." % (len(created), updated)
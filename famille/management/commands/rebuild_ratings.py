@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from famille.models import FamilleRatings, PrestataireRatings
+
+
+class Command(BaseCommand):
+    help = "Rebuild the rating aggregates (sum, count, average) of all the users."
+
+    def handle(self, *args, **options):
+        for RatingClass in (FamilleRatings, PrestataireRatings):
+            nb_users = RatingClass.rebuild_user_ratings()
+            print "%s: rebuilt the ratings of %s users" % (RatingClass.__name__, nb_users)
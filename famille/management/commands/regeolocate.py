@@ -0,0 +1,132 @@
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+
+from famille import errors
+from famille.models import Famille, Prestataire, Geolocation, GeolocationJob
+from famille.utils import geolocation
+from famille.utils.threading import RateLimiter
+
+
+USER_CLASSES = {
+    "famille": Famille,
+    "prestataire": Prestataire
+}
+
+
+def iter_chunks(queryset, chunk_size, start_after=0):
+    """
+    Iterate over a queryset by chunks of rows, ordered by pk,
+    without loading the whole queryset.
+    """
+    last_pk = start_after
+    while True:
+        chunk = list(queryset.filter(pk__gt=last_pk).select_related("geolocation").order_by("pk")[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
+
+
+def geocode_addresses(addresses, pool, limiter):
+    """
+    Geocode unique addresses concurrently. Return a dict
+    address -> (lat, lon), or None if it cannot be geolocated.
+    """
+    def geocode(address):
+        limiter.wait()
+        try:
+            return address, tuple(geolocation.geolocate(address))
+        except errors.GeolocationError:
+            return address, None
+
+    return dict(pool.map(geocode, addresses))
+
+
+def save_geolocations(UserClass, users, coordinates):
+    """
+    Write the geolocations of a chunk of users. Existing Geolocation
+    rows sharing the same address are updated with a single query.
+    """
+    to_update = defaultdict(list)
+    with transaction.atomic():
+        for user in users:
+            coords = coordinates[user.get_address()]
+            if user.geolocation:
+                to_update[coords].append(user.geolocation.pk)
+                continue
+
+            lat, lon = coords or (None, None)
+            g = Geolocation(lat=lat, lon=lon, has_error=coords is None)
+            g.save()
+            UserClass.objects.filter(pk=user.pk).update(geolocation=g)
+
+        for coords, pks in to_update.iteritems():
+            lat, lon = coords or (None, None)
+            located = coords is not None
+            Geolocation.objects.filter(pk__in=pks).update(
+                lat=lat, lon=lon, has_error=not located, pending=False,
+                cell=geolocation.grid_cell(lat, lon) if located else None
+            )
+
+        GeolocationJob.objects.filter(
+            object_type=UserClass.__name__, object_id__in=[u.pk for u in users]
+        ).delete()
+
+
+class Command(BaseCommand):
+    args = "[famille|prestataire ...]"
+    help = (
+        "Geolocate the users that are not geolocated, have a geolocation "
+        "error or a pending geolocation (or all users with --all)."
+    )
+    option_list = BaseCommand.option_list + (
+        make_option("--all", action="store_true", default=False, help="Geolocate all users again"),
+        make_option("--chunk-size", type="int", default=500, help="Number of users loaded at once"),
+        make_option("--workers", type="int", default=4, help="Number of concurrent geocoding requests"),
+        make_option("--rate", type="float", default=10.0, help="Maximum geocoding requests per second"),
+        make_option("--start-after", type="int", default=0, help="Resume after this user pk"),
+    )
+
+    def handle(self, *args, **options):
+        user_types = [a.lower() for a in args] or ["famille", "prestataire"]
+        for user_type in user_types:
+            if user_type not in USER_CLASSES:
+                raise CommandError("Unknown user type %s" % user_type)
+
+        pool = ThreadPool(options["workers"])
+        limiter = RateLimiter(options["rate"])
+        try:
+            for user_type in user_types:
+                self.regeolocate(USER_CLASSES[user_type], pool, limiter, options)
+        finally:
+            pool.close()
+
+    def regeolocate(self, UserClass, pool, limiter, options):
+        queryset = UserClass.objects.filter(Q(city__gt="") | Q(postal_code__gt=""))
+        if not options["all"]:
+            queryset = queryset.filter(
+                Q(geolocation__isnull=True) | Q(geolocation__has_error=True) | Q(geolocation__pending=True)
+            )
+
+        start, nb_users, nb_addresses, nb_errors = time.time(), 0, 0, 0
+        for users in iter_chunks(queryset, options["chunk_size"], options["start_after"]):
+            addresses = set(user.get_address() for user in users)
+            coordinates = geocode_addresses(addresses, pool, limiter)
+            save_geolocations(UserClass, users, coordinates)
+
+            nb_users += len(users)
+            nb_addresses += len(addresses)
+            nb_errors += sum(1 for coords in coordinates.itervalues() if coords is None)
+            elapsed = max(time.time() - start, 0.001)
+            print "%s: %s users, %s addresses (%s errors), %.1f users/s, %.1f addresses/s, last pk %s" % (
+                UserClass.__name__, nb_users, nb_addresses, nb_errors,
+                nb_users / elapsed, nb_addresses / elapsed, users[-1].pk
+            )
+
+        print "%s: done, %s users geolocated in %.1fs" % (UserClass.__name__, nb_users, time.time() - start)
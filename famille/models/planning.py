@@ -8,9 +8,39 @@ from famille.models.users import Famille, Prestataire
 
 
 __all__ = [
-    "FamillePlanning", "PrestatairePlanning", "Weekday", "Schedule"
+    "FamillePlanning", "PrestatairePlanning", "Weekday", "Schedule",
+    "availability_mask"
 ]
 
+# the layout of the availability bitmasks: one bit per (weekday, schedule),
+# bit (weekday.id - 1) * MAX_SCHEDULES + schedule.id - 1
+MAX_WEEKDAYS = 7
+MAX_SCHEDULES = 10
+
+
+def availability_mask(weekdays=None, schedules=None):
+    """
+    Return the availability bitmask of the given weekdays
+    and schedules ids, i.e. with the bits of each (weekday,
+    schedule) set. Empty weekdays or schedules mean all
+    of them, unknown ids are ignored.
+
+    :param weekdays:     the weekday ids
+    :param schedules:    the schedule ids
+    """
+    weekdays = [int(w) for w in weekdays or ()] or range(1, MAX_WEEKDAYS + 1)
+    schedules = [int(s) for s in schedules or ()] or range(1, MAX_SCHEDULES + 1)
+    day_mask = 0
+    for schedule in schedules:
+        if 0 < schedule <= MAX_SCHEDULES:
+            day_mask |= 1 << (schedule - 1)
+
+    mask = 0
+    for weekday in weekdays:
+        if 0 < weekday <= MAX_WEEKDAYS:
+            mask |= day_mask << ((weekday - 1) * MAX_SCHEDULES)
+    return mask
+
 
 class ChoicesModel(models.Model):
 
@@ -78,6 +108,17 @@ class BasePlanning(BaseModel):
         hours = " (%s)" % hours if hours else ""
         return self.DISPLAY_TPL % (days, hours, freq, date)
 
+    def get_availability(self):
+        """
+        Return the availability bitmask of the planning. A
+        planning without weekday is not taken into account,
+        a planning without schedule covers the whole days.
+        """
+        weekdays = [w.pk for w in self.weekday.all()]
+        if not weekdays:
+            return 0
+        return availability_mask(weekdays, [s.pk for s in self.schedule.all()])
+
 
 class FamillePlanning(BasePlanning):
     famille = models.ForeignKey(Famille, related_name="planning")
@@ -1,4 +1,7 @@
-from django.db import models
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import models, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.signals import post_save, post_delete
 
 from famille.models.base import BaseModel
 from famille.models.users import Famille, Prestataire
@@ -39,6 +42,96 @@ class BaseRatings(BaseModel):
         """
         return bool(cls.objects.filter(user=user, by=voter.simple_id).count())
 
+    @classmethod
+    def get_voted_user_ids(cls, voter):
+        """
+        Return the set of ids of the users a user has voted for.
+        The set is computed once and memoized on the voter instance,
+        so that it can be checked for a whole list of users.
+
+        :param voter:        the voter
+        """
+        cache_name = "_voted_%s_ids" % cls.__name__.lower()
+        if not hasattr(voter, cache_name):
+            ids = cls.objects.filter(by=voter.simple_id).values_list("user_id", flat=True)
+            setattr(voter, cache_name, set(ids))
+        return getattr(voter, cache_name)
+
+    @staticmethod
+    def get_rating_aggregates(ratings):
+        """
+        Return the rating aggregates of a user (see UserInfo),
+        given a queryset over his ratings.
+
+        :param ratings:      the queryset of ratings
+        """
+        return BaseRatings.compute_rating_aggregates(
+            ratings.aggregate(count=Count("pk"), a=Sum("a"), b=Sum("b"), c=Sum("c"), d=Sum("d"))
+        )
+
+    @staticmethod
+    def compute_rating_aggregates(values):
+        """
+        Compute the rating aggregates of a user, given the number
+        of ratings and the sum of each rating column.
+
+        :param values:       a dict with count, a, b, c and d keys
+        """
+        count = values["count"]
+        rating_sum = sum(values[key] or 0 for key in "abcd") / 4.0
+        return {
+            "rating_sum": rating_sum,
+            "rating_count": count,
+            "rating_avg": rating_sum / count if count else 0
+        }
+
+    @classmethod
+    def update_user_rating(cls, user):
+        """
+        Recompute the rating aggregates of a user.
+
+        :param user:         the user that was rated
+        """
+        aggregates = cls.get_rating_aggregates(cls.objects.filter(user=user))
+        type(user).objects.filter(pk=user.pk).update(**aggregates)
+        for key, value in aggregates.iteritems():
+            setattr(user, key, value)
+
+    @classmethod
+    def add_user_rating(cls, user, rating):
+        """
+        Add a rating to the aggregates of a user, incrementally.
+
+        :param user:         the user that was rated
+        :param rating:       the average of the new rating
+        """
+        queryset = type(user).objects.filter(pk=user.pk)
+        queryset.update(
+            rating_sum=F("rating_sum") + rating,
+            rating_count=F("rating_count") + 1,
+            rating_avg=(F("rating_sum") + rating) / (F("rating_count") + 1)
+        )
+        values = queryset.values(*user.RATING_FIELDS)[0]
+        for key, value in values.iteritems():
+            setattr(user, key, value)
+
+    @classmethod
+    def rebuild_user_ratings(cls):
+        """
+        Rebuild the rating aggregates of all the users
+        that can be rated with this class. Return the
+        number of users that have ratings.
+        """
+        UserClass = cls._meta.get_field("user").rel.to
+        rows = cls.objects.values("user").annotate(
+            count=Count("pk"), a=Sum("a"), b=Sum("b"), c=Sum("c"), d=Sum("d")
+        )
+        with transaction.atomic():
+            UserClass.objects.update(**cls.compute_rating_aggregates({"count": 0, "a": 0, "b": 0, "c": 0, "d": 0}))
+            for row in rows:
+                UserClass.objects.filter(pk=row["user"]).update(**cls.compute_rating_aggregates(row))
+        return len(rows)
+
 
 class FamilleRatings(BaseRatings):
     user = models.ForeignKey(Famille, related_name="ratings")
@@ -52,3 +145,36 @@ class PrestataireRatings(BaseRatings):
 
     class Meta:
         app_label = 'famille'
+
+
+def rating_saved(sender, instance, created, raw=False, **kwargs):
+    """
+    Maintain the rating aggregates of the rated user. A new
+    rating is added incrementally, an updated one triggers
+    a full computation.
+    """
+    if raw:
+        return
+    if created:
+        sender.add_user_rating(instance.user, instance.average)
+    else:
+        sender.update_user_rating(instance.user)
+
+
+def rating_deleted(sender, instance, **kwargs):
+    """
+    Recompute the rating aggregates of the rated
+    user when a rating is deleted.
+    """
+    try:
+        user = instance.user
+    except ObjectDoesNotExist:  # the user is being deleted
+        return
+    sender.update_user_rating(user)
+
+
+# signals
+post_save.connect(rating_saved, sender=FamilleRatings, dispatch_uid="famille.famille_rating_saved")
+post_save.connect(rating_saved, sender=PrestataireRatings, dispatch_uid="famille.prestataire_rating_saved")
+post_delete.connect(rating_deleted, sender=FamilleRatings, dispatch_uid="famille.famille_rating_deleted")
+post_delete.connect(rating_deleted, sender=PrestataireRatings, dispatch_uid="famille.prestataire_rating_deleted")
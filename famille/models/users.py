@@ -1,14 +1,18 @@
 # -*- coding=utf-8 -*-
-from collections import OrderedDict
-from datetime import date, datetime
+from collections import OrderedDict, defaultdict
+from datetime import date, datetime, timedelta
 import logging
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.auth.signals import user_logged_in
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, connection
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete
+from django.utils.functional import cached_property
 from django.utils.timezone import utc
 from paypal.standard.ipn.models import PayPalIPN
 from paypal.standard.ipn.signals import payment_was_successful
@@ -18,14 +22,14 @@ from verification.signals import key_claimed
 from famille import errors
 from famille.models.base import BaseModel
 from famille.utils import (
-    parse_resource_uri, geolocation, IMAGE_TYPES, DOCUMENT_TYPES,
+    parse_resource_uri, geolocation, fulltext, IMAGE_TYPES, DOCUMENT_TYPES,
     fields as extra_fields, payment
 )
 from famille.utils.mail import (
     send_mail_from_template_with_noreply,
     encode_recipient, decode_recipient_list
 )
-from famille.utils.python import pick, get_age_from_date
+from famille.utils.python import pick, get_age_from_date, years_ago, CacheStats, LRUCache
 
 
 __all__ = [
@@ -33,39 +37,132 @@ __all__ = [
     "get_user_related", "Reference", "UserInfo",
     "has_user_related", "user_is_located", "Geolocation",
     "compute_user_visibility_filters", "get_user_pseudo",
-    "check_plan_expiration"
+    "check_plan_expiration", "PostalCode", "GeolocationJob",
+    "FamilleCriterion", "PrestataireCriterion"
 ]
 
 
+class PostalCode(BaseModel):
+    """
+    The GPS coordinates of a postal code. Postal codes
+    do not move, so they are geolocated once and for all.
+    """
+    code = models.CharField(max_length=50, unique=True)
+    lat = models.FloatField()
+    lon = models.FloatField()
+
+    stats = CacheStats()
+
+    class Meta:
+        app_label = 'famille'
+
+    def __unicode__(self):
+        return unicode(self.code)
+
+    @staticmethod
+    def normalize(postal_code):
+        """
+        Normalize a postal code (or a city name) to use it as a key.
+        """
+        return u" ".join(postal_code.split()).lower()
+
+    @classmethod
+    def get_coordinates(cls, postal_code):
+        """
+        Retrieve the coordinates of a postal code from database.
+        If missing, geolocate it and store it for next time.
+
+        :param postal_code:       the postal code
+        """
+        code = cls.normalize(postal_code)
+        try:
+            obj = cls.objects.get(code=code)
+        except cls.DoesNotExist:
+            cls.stats.miss()
+            lat, lon = geolocation.geolocate("%s France" % postal_code)  # FIXME: this will obviously only work in France
+            obj, _ = cls.objects.get_or_create(code=code, defaults={"lat": lat, "lon": lon})
+        else:
+            cls.stats.hit()
+
+        return obj.lat, obj.lon
+
+
+postal_code_cache = LRUCache(settings.POSTAL_CODE_CACHE_SIZE)
+logger = logging.getLogger(__name__)
+
+
 class Geolocation(BaseModel):
     """
     A model that represent a geolocation
     of a user.
     """
-    lat = models.FloatField(null=True)
-    lon = models.FloatField(null=True)
+    lat = models.FloatField(null=True, db_index=True)
+    lon = models.FloatField(null=True, db_index=True)
     has_error = models.BooleanField(default=False)
+    cell = models.CharField(max_length=20, null=True, blank=True, db_index=True)
+    pending = models.BooleanField(default=False)
 
     class Meta:
         app_label = 'famille'
 
+    def save(self, *args, **kwargs):
+        """
+        Keep the grid cell index up to date with the coordinates.
+        """
+        located = self.lat is not None and self.lon is not None and not self.has_error
+        self.cell = geolocation.grid_cell(self.lat, self.lon) if located else None
+        return super(Geolocation, self).save(*args, **kwargs)
+
     @classmethod
     def from_postal_code(cls, postal_code):
         """
         Geolocation user from postal code. This is useful
-        for search using postal code.
+        for search using postal code. The coordinates are
+        looked up in memory, then in database, and only
+        geolocated if unknown.
         """
-        lat, lon = geolocation.geolocate("%s France" % postal_code)  # FIXME: this will obviously only work in France
+        code = PostalCode.normalize(postal_code)
+        coordinates = postal_code_cache.get(code)
+        if coordinates is None:
+            coordinates = PostalCode.get_coordinates(postal_code)
+            postal_code_cache.set(code, coordinates)
+        cls.log_postal_code_cache_stats()
+
+        lat, lon = coordinates
         return cls(lat=lat, lon=lon)
 
-    def geolocate(self, address):
+    @staticmethod
+    def postal_code_cache_stats():
+        """
+        Return the hits / misses of the postal code
+        caches (in memory and in database).
+        """
+        return {
+            "memory": postal_code_cache.stats.as_dict(),
+            "database": PostalCode.stats.as_dict()
+        }
+
+    @classmethod
+    def log_postal_code_cache_stats(cls):
+        """
+        Log the stats of the postal code caches of the process every
+        POSTAL_CODE_CACHE_STATS_INTERVAL lookups, so that they can be
+        followed in the logs.
+        """
+        stats = postal_code_cache.stats
+        interval = settings.POSTAL_CODE_CACHE_STATS_INTERVAL
+        if interval and (stats.hits + stats.misses) % interval == 0:
+            logger.info("Postal code caches: %s", cls.postal_code_cache_stats())
+
+    def geolocate(self, address, use_cache=True):
         """
         Geolocate a geolocation object, given an address.
 
         :param address:         the address to geolocate
+        :param use_cache:       if False, the address cache is bypassed
         """
         try:
-            lat, lon = geolocation.geolocate(address)
+            lat, lon = geolocation.geolocate(address, use_cache=use_cache)
         except errors.GeolocationError:
             self.has_error = True
             self.lat = None
@@ -75,9 +172,90 @@ class Geolocation(BaseModel):
             self.lat = lat
             self.lon = lon
 
+        self.pending = False
         self.save()
 
 
+class GeolocationJob(BaseModel):
+    """
+    A user waiting to be geolocated. There is at most one job
+    per user, which is run by the geolocation_worker command.
+    """
+    OBJECT_TYPES = {
+        'Prestataire': 'Prestataire',
+        'Famille': 'Famille',
+    }
+    object_id = models.IntegerField()
+    object_type = models.CharField(max_length=20, choices=OBJECT_TYPES.items())
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        app_label = 'famille'
+        unique_together = (("object_type", "object_id"), )
+
+    def __unicode__(self):
+        return unicode(self.__str__())
+
+    def __str__(self):
+        return "%s %s" % (self.object_type, self.object_id)
+
+    @classmethod
+    def enqueue(cls, user):
+        """
+        Schedule the geolocation of a user, as soon as possible.
+        If the user is already scheduled, the job is reset.
+
+        :param user:          a Famille or a Prestataire
+        """
+        job, created = cls.objects.get_or_create(
+            object_type=user.__class__.__name__, object_id=user.pk,
+            defaults={"run_at": datetime.now(utc)}
+        )
+        if not created:
+            job.attempts = 0
+            job.run_at = datetime.now(utc)
+            job.save()
+        return job
+
+    @classmethod
+    def run_pending(cls, limit=50):
+        """
+        Run the jobs that are due. Return the number of jobs run.
+
+        :param limit:         the maximum number of jobs to run
+        """
+        jobs = list(cls.objects.filter(run_at__lte=datetime.now(utc)).order_by("run_at")[:limit])
+        for job in jobs:
+            job.run()
+        return len(jobs)
+
+    def run(self):
+        """
+        Geolocate the user. In case of error, the job is retried
+        later, with an exponential backoff, until max_attempts
+        is reached (see settings.GEOLOCATION_JOBS). The retries
+        bypass the address cache, which would return the error.
+        """
+        try:
+            user = USER_CLASSES[self.object_type].objects.get(pk=self.object_id)
+        except ObjectDoesNotExist:
+            self.delete()
+            return
+
+        user.geolocate(use_cache=not self.attempts)
+        self.attempts += 1
+        if user.geolocation.has_error and self.attempts < settings.GEOLOCATION_JOBS["max_attempts"]:
+            Geolocation.objects.filter(pk=user.geolocation.pk).update(pending=True)
+            backoff = settings.GEOLOCATION_JOBS["backoff"] * 2 ** (self.attempts - 1)
+            # make sure the job was not reset by enqueue in the meantime
+            type(self).objects.filter(pk=self.pk, run_at=self.run_at).update(
+                attempts=self.attempts, run_at=datetime.now(utc) + timedelta(seconds=backoff)
+            )
+        else:
+            type(self).objects.filter(pk=self.pk, run_at=self.run_at).delete()
+
+
 def get_user_related(user):
     """
     Return the user related model. Either
@@ -164,6 +342,7 @@ class UserInfo(BaseModel):
         "name", "first_name", "street", "postal_code", "city", "profile_pic"
     ]
     MIN_VISIBILITY_SCORE = 0
+    RATING_FIELDS = ("rating_sum", "rating_count", "rating_avg")
 
     user = models.OneToOneField(User)
     geolocation = models.OneToOneField(Geolocation, blank=True, null=True)
@@ -191,6 +370,12 @@ class UserInfo(BaseModel):
     visibility_prestataire = models.BooleanField(default=True, blank=True)
     visibility_global = models.BooleanField(default=True, blank=True)
     is_test = models.BooleanField(default=False, blank=True)
+    # computed on save, see compute_visibility_score
+    visibility_score = models.FloatField(default=0, blank=True, db_index=True)
+    # rating aggregates, maintained by the ratings (see famille.models.rating)
+    rating_sum = models.FloatField(default=0, blank=True)
+    rating_count = models.PositiveIntegerField(default=0, blank=True)
+    rating_avg = models.FloatField(default=0, blank=True, db_index=True)
 
     class Meta:
         abstract = True
@@ -201,6 +386,23 @@ class UserInfo(BaseModel):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        """
+        Save the user. The rating aggregates are not written
+        when updating a user loaded from the database, so that a
+        stale instance cannot override the ratings received in the
+        meantime. The new instances are saved as usual, even with
+        a pk. The visibility score is recomputed.
+        """
+        self.visibility_score = self.compute_visibility_score()
+        updating = not self._state.adding and not kwargs.get("force_insert")
+        if updating and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.RATING_FIELDS
+            ]
+        super(UserInfo, self).save(*args, **kwargs)
+
     @classmethod
     def create_user(cls, dj_user, type):
         """
@@ -223,6 +425,8 @@ class UserInfo(BaseModel):
     def decode_users(cls, data):
         """
         Decode a list of users. Uses mail.decode_recipient_list.
+        The users are fetched with one query per user class,
+        with their auth user, in the order of the data.
 
         :param data:        the encoded data
         """
@@ -231,21 +435,75 @@ class UserInfo(BaseModel):
         except (TypeError, ValueError):
             raise ValueError("Wrong format")
 
-        users = []
+        keys, pks = [], defaultdict(set)
         for u in user_data:
             try:
                 kls = Prestataire if u["type"] == "Prestataire" else Famille
-                users.append(kls.objects.get(pk=u["pk"]))
-            except (KeyError, kls.DoesNotExist):
+                pk = int(u["pk"])
+            except (KeyError, TypeError, ValueError):
                 raise ValueError("Wrong format")
-        return users
+            keys.append((kls, pk))
+            pks[kls].add(pk)
+
+        users = {}
+        for kls, kls_pks in pks.iteritems():
+            for pk, user in kls.objects.select_related("user").in_bulk(kls_pks).iteritems():
+                users[(kls, pk)] = user
+        try:
+            return [users[key] for key in keys]
+        except KeyError:
+            raise ValueError("Wrong format")
+
+    @classmethod
+    def located_within(cls, origin, distance, queryset=None):
+        """
+        Restrict a queryset to the users located at less than a
+        given distance of a point. Only the grid cells overlapping
+        the circle are scanned, then the exact distance is checked.
+
+        :param origin:         a Geolocation model
+        :param distance:       the distance in km
+        :param queryset:       the initial queryset, defaults to all users
+        """
+        queryset = cls.objects.all() if queryset is None else queryset
+        table = connection.ops.quote_name(Geolocation._meta.db_table)
+        where, params = geolocation.distance_sql(
+            origin, distance,
+            "%s.%s" % (table, connection.ops.quote_name("lat")),
+            "%s.%s" % (table, connection.ops.quote_name("lon"))
+        )
+        cells = geolocation.grid_cells(origin, distance)
+        if cells is not None:
+            queryset = queryset.filter(geolocation__cell__in=cells)
+        else:
+            lat_range, lon_range = geolocation.bounding_box(origin, distance)
+            queryset = queryset.filter(
+                geolocation__has_error=False,
+                geolocation__lat__range=lat_range,
+                geolocation__lon__range=lon_range
+            )
+        return queryset.extra(where=[where], params=params)
+
+    @classmethod
+    def ids_located_within(cls, origin, distance):
+        """
+        Return the ids of the users located at less than
+        a given distance of a point.
+
+        :param origin:         a Geolocation model
+        :param distance:       the distance in km
+        """
+        return cls.located_within(origin, distance).values_list("pk", flat=True)
 
     @property
     def is_geolocated(self):
         """
         A property to check if a user is geolocated.
         """
-        return self.geolocation and not self.geolocation.has_error
+        return bool(
+            self.geolocation and not self.geolocation.has_error
+            and self.geolocation.lat is not None
+        )
 
     @property
     def is_premium(self):
@@ -259,17 +517,14 @@ class UserInfo(BaseModel):
         """
         Return the number of total ratings the user received.
         """
-        return self.ratings.all().count()
+        return self.rating_count
 
     @property
     def total_rating(self):
         """
-        A property that computes the overall rating of a given user.
+        A property that returns the overall rating of a given user.
         """
-        nb_ratings = self.nb_ratings
-        if not nb_ratings:
-            return 0
-        return sum(rating.average for rating in self.ratings.all()) / float(nb_ratings)
+        return self.rating_avg
 
     @property
     def total_rating_percent(self):
@@ -289,12 +544,11 @@ class UserInfo(BaseModel):
     def encoded(self):
         return encode_recipient(self)
 
-    @property
-    def visibility_score(self):
+    def compute_visibility_score(self):
         """
         Compute the visibility score of the user.
         If less than a certain value, the user won't show up
-        in the result.
+        in the result. It is stored in visibility_score on save.
         """
         score = 0
         for field in self.MANDATORY_FIELDS_FOR_VISIBILITY:
@@ -308,38 +562,66 @@ class UserInfo(BaseModel):
         Return True if the visibility score is superior to
         self.MIN_VISIBILITY_SCORE.
         """
-        return self.visibility_score >= self.MIN_VISIBILITY_SCORE
+        return self.compute_visibility_score() >= self.MIN_VISIBILITY_SCORE
 
-    # FIXME: can be async
-    def geolocate(self):
+    @classmethod
+    def filter_visible(cls, queryset):
         """
-        Geolocate a user, using google geolocation.
-        It basically calls the Google API and
-        saves the GPS coordinates into database.
+        Filter a queryset to keep the users whose stored
+        visibility score is enough (see visibility_score_is_enough).
+
+        :param queryset:         the queryset to filter
+        """
+        return queryset.filter(visibility_score__gte=cls.MIN_VISIBILITY_SCORE)
 
-        NB: since geolocate is called in a pre_save signal,
-            we do not save the model to save time, since
-            it'll be saved soon enough.
+    def get_address(self):
         """
-        address = "%s %s %s, %s" % (
+        Return the address of the user, as given to the geocoder.
+        """
+        return "%s %s %s, %s" % (
             self.street or "",
             self.postal_code or "",
             self.city or "",
             self.country or "France"  # FIXME: this will obviously only work in France
         )
 
+    def geolocate(self, use_cache=True):
+        """
+        Geolocate a user, using google geolocation.
+        It basically calls the Google API and
+        saves the GPS coordinates into database.
+
+        NB: only the geolocation link is saved on the user,
+            using an update query, not the whole model.
+
+        :param use_cache:       if False, the address cache is bypassed
+        """
         # make sure the one to one field is set when having a pk
         g = Geolocation() if not self.geolocation else self.geolocation
-        g.geolocate(address)
+        g.geolocate(self.get_address(), use_cache=use_cache)
 
         self.geolocation = g
-        self.save()
+        type(self).objects.filter(pk=self.pk).update(geolocation=g)
+
+    def schedule_geolocation(self):
+        """
+        Mark the user geolocation as pending and schedule
+        the call to geolocate (see GeolocationJob).
+        """
+        g = Geolocation() if not self.geolocation else self.geolocation
+        g.pending = True
+        g.save()
+        if not self.geolocation:
+            self.geolocation = g
+            type(self).objects.filter(pk=self.pk).update(geolocation=g)
+
+        GeolocationJob.enqueue(self)
 
     def manage_geolocation(self, changed_data):
         """
         Manage the user geolocation. If street / postal code /
         city / country is in changed data, and if city / country
-        at least is not None, the geolocation will be triggered.
+        at least is not None, the geolocation will be scheduled.
 
         :param changed_data:        the data that changed on the model
         """
@@ -348,7 +630,7 @@ class UserInfo(BaseModel):
             and (self.city or self.postal_code)
         )
         if condition:
-            self.geolocate()
+            self.schedule_geolocation()
 
     def add_favorite(self, resource_uri):
         """
@@ -372,19 +654,52 @@ class UserInfo(BaseModel):
 
     def get_favorites_data(self):
         """
-        Retrieve the favorites data.
+        Retrieve the favorites data. The favorited users are fetched
+        with one query per user class, in the order of the favorites.
         """
-        # FIXME: can become greedy in the future
         favs = OrderedDict([
             ("Prestataire", []),
             ("Famille", [])
         ])
-        for favorite in self.favorites.all():
-            fav = favorite.get_user()
-            favs[fav.__class__.__name__].append(fav)
+        keys, pks = [], defaultdict(set)
+        for object_type, object_id in self.favorites.values_list("object_type", "object_id").order_by("id"):
+            keys.append((object_type, object_id))
+            pks[object_type].add(object_id)
+
+        users = {}
+        for object_type, type_pks in pks.iteritems():
+            kls = USER_CLASSES[object_type]
+            for pk, user in kls.objects.select_related("user").in_bulk(type_pks).iteritems():
+                users[(object_type, pk)] = user
+
+        for key in keys:
+            if key in users:  # the favorited user may have been deleted
+                favs[key[0]].append(users[key])
 
         return favs
 
+    def get_favorite_keys(self):
+        """
+        Return the set of the (object_type, object_id) of the
+        favorites, to check if a user is favorited in O(1).
+        """
+        return set(self.favorites.values_list("object_type", "object_id"))
+
+    @property
+    def favorites_count_cache_key(self):
+        return "famille.favorites_count.%s.%s" % (self.__class__.__name__, self.pk)
+
+    def get_favorites_count(self):
+        """
+        Return the number of favorites of the user, cached in the
+        shared cache until a favorite is added or removed.
+        """
+        count = cache.get(self.favorites_count_cache_key)
+        if count is None:
+            count = self.favorites.count()
+            cache.set(self.favorites_count_cache_key, count, settings.FAVORITES_COUNT_CACHE_TIMEOUT)
+        return count
+
     # FIXME: nothing to do here...
     def get_resource_uri(self):
         """
@@ -489,12 +804,191 @@ class Criteria(UserInfo):
     permis = models.BooleanField(blank=True, default=False)
     enfant_malade = models.BooleanField(blank=True, default=False)
     tarif = models.CharField(blank=True, default="%s,%s" % settings.TARIF_RANGE, max_length=10)
+    # the bounds of tarif, kept in sync on save for searching
+    tarif_min = models.PositiveSmallIntegerField(blank=True, null=True, db_index=True)
+    tarif_max = models.PositiveSmallIntegerField(blank=True, null=True, db_index=True)
     description = models.CharField(blank=True, null=True, max_length=400)
     language = models.CommaSeparatedIntegerField(blank=True, null=True, max_length=100)
+    # the weekday x schedule bitmask of the plannings, split in
+    # signed 64 bits words, see update_availability
+    availability_0 = models.BigIntegerField(blank=True, default=0)
+    availability_1 = models.BigIntegerField(blank=True, default=0)
+    # the normalized text searched with the q parameter, see get_search_text
+    search_text = models.TextField(blank=True, default="")
+
+    # the comma separated fields, also stored in the criteria table for searching
+    CRITERIA_FIELDS = ("type_garde", "diploma", "experience_type", "language")
+    # the text fields in search_text, and the (related name, field) of the related objects
+    SEARCH_TEXT_FIELDS = ("description", )
+    SEARCH_TEXT_RELATED = ()
+    # the boolean fields compared when ordering the results by match
+    MATCH_BOOLEAN_FIELDS = (
+        "menage", "repassage", "cuisine", "devoirs", "animaux",
+        "non_fumeur", "psc1", "permis", "enfant_malade"
+    )
+    # the fields holding the availability bitmask, AVAILABILITY_BITS bits each
+    AVAILABILITY_FIELDS = ("availability_0", "availability_1")
+    AVAILABILITY_BITS = 63
+    # the badges of the search cards, as (field, value): a badge is
+    # set if the comma separated field has the value, or if the field
+    # is set when value is None. See get_badges.
+    BADGES = (
+        ("type_garde", "0"), ("type_garde", "1"), ("type_garde", "3"),
+        ("type_garde", "4"), ("type_garde", "7"), ("diploma", None),
+        ("experience_type", "1"), ("permis", None), ("enfant_malade", None),
+        ("psc1", None), ("repassage", None), ("menage", None),
+        ("non_fumeur", None), ("cuisine", None), ("devoirs", None)
+    )
 
     class Meta:
         abstract = True
 
+    def save(self, *args, **kwargs):
+        """
+        Save the user, with the bounds of the tarif and
+        the search text, and synchronize the criteria table.
+        """
+        self.tarif_min, self.tarif_max = self.get_tarif_range() or (None, None)
+        self.search_text = self.get_search_text()
+        super(Criteria, self).save(*args, **kwargs)
+        self.sync_criteria()
+
+    @property
+    def availability(self):
+        """
+        The availability bitmask of the user, see
+        famille.models.planning.availability_mask.
+        """
+        mask = 0
+        for i, name in enumerate(self.AVAILABILITY_FIELDS):
+            mask |= getattr(self, name) << (i * self.AVAILABILITY_BITS)
+        return mask
+
+    @availability.setter
+    def availability(self, mask):
+        for name, word in zip(self.AVAILABILITY_FIELDS, self.split_availability(mask)):
+            setattr(self, name, word)
+
+    @classmethod
+    def split_availability(cls, mask):
+        """
+        Split an availability bitmask in words
+        fitting in the availability fields.
+
+        :param mask:     the availability bitmask
+        """
+        word_mask = (1 << cls.AVAILABILITY_BITS) - 1
+        return [
+            (mask >> (i * cls.AVAILABILITY_BITS)) & word_mask
+            for i in xrange(len(cls.AVAILABILITY_FIELDS))
+        ]
+
+    @classmethod
+    def filter_available(cls, queryset, mask):
+        """
+        Filter a queryset of users, keeping those with at least one
+        bit of the availability bitmask in common with mask.
+
+        :param queryset:     the queryset
+        :param mask:         the availability bitmask
+        """
+        table = connection.ops.quote_name(cls._meta.db_table)
+        where, params = [], []
+        for name, word in zip(cls.AVAILABILITY_FIELDS, cls.split_availability(mask)):
+            if word:
+                where.append("(%s.%s & %%s) != 0" % (table, connection.ops.quote_name(name)))
+                params.append(word)
+
+        if not where:
+            return queryset.none()
+        return queryset.extra(where=["(%s)" % " OR ".join(where)], params=params)
+
+    def update_availability(self):
+        """
+        Rebuild the availability bitmask from the
+        plannings of the user, and save it.
+        """
+        mask = 0
+        for planning in self.planning.prefetch_related("weekday", "schedule"):
+            mask |= planning.get_availability()
+        self.availability = mask
+        type(self).objects.filter(pk=self.pk).update(
+            **dict((name, getattr(self, name)) for name in self.AVAILABILITY_FIELDS)
+        )
+
+    def get_search_text(self):
+        """
+        Return the text searched with the q parameter: the text
+        fields of the user and of the related objects (see
+        SEARCH_TEXT_FIELDS and SEARCH_TEXT_RELATED), lower
+        cased and without accents.
+        """
+        texts = [getattr(self, name) for name in self.SEARCH_TEXT_FIELDS]
+        if self.pk:
+            for related, name in self.SEARCH_TEXT_RELATED:
+                texts.extend(getattr(self, related).values_list(name, flat=True))
+        return fulltext.normalize(u"\n".join(text for text in texts if text))
+
+    def update_search_text(self):
+        """
+        Rebuild and save the search text, e.g. when
+        a related object changes.
+        """
+        self.save(update_fields=["search_text"])
+
+    def get_badges(self):
+        """
+        Return the badges of the user as a bitmask,
+        bit i being set for the badge BADGES[i].
+        """
+        badges = 0
+        for i, (name, value) in enumerate(self.BADGES):
+            field = getattr(self, name)
+            if (value in (field or "").split(",")) if value is not None else field:
+                badges |= 1 << i
+        return badges
+
+    def get_tarif_range(self):
+        """
+        Return the tarif as a [min, max] list, or
+        None if it is not set.
+        """
+        try:
+            tarif = [int(v) for v in self.tarif.split(",")]
+        except (AttributeError, ValueError):
+            return None
+        return tarif if len(tarif) == 2 else None
+
+    def get_criteria(self):
+        """
+        Return the set of (name, value) of the comma separated
+        fields of the user (see CRITERIA_FIELDS).
+        """
+        criteria = set()
+        for name in self.CRITERIA_FIELDS:
+            values = getattr(self, name) or ""
+            criteria.update((name, value) for value in values.split(",") if value)
+        return criteria
+
+    def sync_criteria(self):
+        """
+        Synchronize the criteria table with the comma separated
+        fields of the user, deleting and creating the rows that changed.
+        """
+        criteria = self.get_criteria()
+        existing = dict(((c.name, c.value), c.pk) for c in self.criteria.all())
+        removed = [pk for key, pk in existing.iteritems() if key not in criteria]
+        if removed:
+            self.criteria.filter(pk__in=removed).delete()
+
+        CriterionClass = self.criteria.model
+        added = [
+            CriterionClass(user=self, name=name, value=value)
+            for name, value in criteria if (name, value) not in existing
+        ]
+        if added:
+            CriterionClass.objects.bulk_create(added)
+
 
 class Prestataire(Criteria):
     """
@@ -522,10 +1016,18 @@ class Prestataire(Criteria):
         "18-": u"Moins de 18 ans",
         "18+": u"Plus de 18 ans"
     }
+    # the age comparison of each age bucket, see get_birthday_lookups
+    AGE_LIMITS = {
+        "16-": ("lt", 16),
+        "18-": ("lt", 18),
+        "18+": ("gte", 18)
+    }
     MANDATORY_FIELDS_FOR_VISIBILITY = UserInfo.MANDATORY_FIELDS_FOR_VISIBILITY + ["birthday", "type"]
+    SEARCH_TEXT_FIELDS = ("description", "nationality")
+    SEARCH_TEXT_RELATED = (("references", "missions"), )
     MIN_VISIBILITY_SCORE = float(settings.PRESTATAIRE_MIN_VISIBILITY_SCORE)
 
-    birthday = models.DateField(null=True, blank=True)
+    birthday = models.DateField(null=True, blank=True, db_index=True)
     nationality = models.CharField(max_length=70, null=True, blank=True)
     type = models.CharField(max_length=40, choices=TYPES, null=True, blank=False)
     other_type = models.CharField(max_length=50, null=True, blank=True)  # FIXME: broken in the front?
@@ -537,10 +1039,37 @@ class Prestataire(Criteria):
 
     class Meta:
         app_label = 'famille'
+        # search filters, prestataires being mostly searched by familles
+        index_together = [("visibility_global", "visibility_family", "plan", "visibility_score")]
 
-    def get_age(self):
+    @cached_property
+    def age(self):
+        """
+        The age of the prestataire, computed once per instance.
+        """
         return get_age_from_date(self.birthday)
 
+    def get_age(self):
+        return self.age
+
+    @classmethod
+    def get_birthday_lookups(cls, age, today=None):
+        """
+        Translate an age bucket (see AGES) into a range of birthdays,
+        as a dict of lookups. Return None for an unknown bucket.
+
+        :param age:          the age bucket
+        :param today:        the date of today, by default the current date
+        """
+        if age not in cls.AGE_LIMITS:
+            return None
+
+        comparison, years = cls.AGE_LIMITS[age]
+        limit = years_ago(today or date.today(), years)
+        if comparison == "lt":
+            return {"birthday__gt": limit}
+        return {"birthday__lte": limit}
+
     def get_type(self):
         """
         Return the prestataire type, depending on if he
@@ -574,6 +1103,7 @@ class Famille(Criteria):
     )
     PAYMENT_PREFIX = "f"
     MIN_VISIBILITY_SCORE = float(settings.FAMILLE_MIN_VISIBILITY_SCORE)
+    SEARCH_TEXT_RELATED = (("enfants", "e_school"), )
 
     type = models.CharField(blank=True, null=True, max_length=10, choices=TYPE_FAMILLE.items())
     type_presta = models.CharField(blank=True, null=True, max_length=10, choices=Prestataire.TYPES)
@@ -581,12 +1111,16 @@ class Famille(Criteria):
 
     class Meta:
         app_label = 'famille'
+        # search filters, familles being mostly searched by prestataires
+        index_together = [("visibility_global", "visibility_prestataire", "plan", "visibility_score")]
 
 
 class Enfant(BaseModel):
     """
     An child of a Famille.
     """
+    # the user whose search text contains this object, see Criteria.SEARCH_TEXT_RELATED
+    SEARCH_TEXT_USER = "famille"
 
     famille = models.ForeignKey(Famille, related_name="enfants")
     # compelled to do this naming because we cannot change the form field names...
@@ -611,6 +1145,50 @@ class Enfant(BaseModel):
         return disp
 
 
+class BaseCriterion(BaseModel):
+    """
+    A value of a comma separated field of a user (see Criteria),
+    stored in its own row so that it can be searched using an index.
+    """
+    name = models.CharField(max_length=20)
+    value = models.CharField(max_length=10)
+
+    class Meta:
+        abstract = True
+
+    def __str__(self):
+        return "%s=%s" % (self.name, self.value)
+
+    @classmethod
+    def filter_users(cls, queryset, name, values):
+        """
+        Filter a queryset of users, keeping the ones that have
+        at least one of the values for the given criterion.
+
+        :param queryset:       the queryset of users
+        :param name:           the name of the criterion, e.g. language
+        :param values:         the desired values
+        """
+        user_ids = cls.objects.filter(name=name, value__in=values).values("user")
+        return queryset.filter(pk__in=user_ids)
+
+
+class FamilleCriterion(BaseCriterion):
+    user = models.ForeignKey(Famille, related_name="criteria")
+
+    class Meta:
+        app_label = 'famille'
+        index_together = [("name", "value")]
+
+
+class PrestataireCriterion(BaseCriterion):
+    user = models.ForeignKey(Prestataire, related_name="criteria")
+
+    class Meta:
+        app_label = 'famille'
+        index_together = [("name", "value")]
+
+
 class BaseFavorite(BaseModel):
     """
     A model reprensenting a favorite.
@@ -671,6 +1249,8 @@ class Reference(BaseModel):
         ("Maison d’assistantes parentales", "Maison d’assistantes parentales"),
         ("Autre", "Autre")
     )
+    # the user whose search text contains this object, see Criteria.SEARCH_TEXT_RELATED
+    SEARCH_TEXT_USER = "prestataire"
 
     prestataire = models.ForeignKey(Prestataire, related_name="references")
     name = models.CharField(max_length=100, null=True, blank=True)
@@ -719,6 +1299,11 @@ FAVORITE_CLASSES = {
     Prestataire: PrestataireFavorite
 }
 
+CRITERION_CLASSES = {
+    Famille: FamilleCriterion,
+    Prestataire: PrestataireCriterion
+}
+
 
 def check_plan_expiration(sender=None, request=None, user=None, related=None, **kwargs):
     """
@@ -747,7 +1332,41 @@ def check_plan_expiration(sender=None, request=None, user=None, related=None, **
                 subject=u"Votre plan premium vient d'expirer", to=[related.email]
             )
 
+def related_text_changed(sender, instance, raw=False, **kwargs):
+    """
+    Rebuild the search text of the user an enfant
+    or a reference belongs to.
+    """
+    if raw:
+        return
+    try:
+        user = getattr(instance, sender.SEARCH_TEXT_USER)
+    except ObjectDoesNotExist:  # the user is being deleted
+        return
+    user.update_search_text()
+
+
+def favorites_changed(sender, instance, raw=False, **kwargs):
+    """
+    Invalidate the cached favorites count of the owner of a favorite.
+    """
+    try:
+        owner = instance.owner
+    except ObjectDoesNotExist:  # the owner is being deleted
+        return
+    cache.delete(owner.favorites_count_cache_key)
+
+
 # signals
+post_save.connect(related_text_changed, sender=Enfant, dispatch_uid="famille.enfant_search_text")
+post_delete.connect(related_text_changed, sender=Enfant, dispatch_uid="famille.enfant_search_text")
+post_save.connect(related_text_changed, sender=Reference, dispatch_uid="famille.reference_search_text")
+post_delete.connect(related_text_changed, sender=Reference, dispatch_uid="famille.reference_search_text")
+post_save.connect(favorites_changed, sender=FamilleFavorite, dispatch_uid="famille.famille_favorites_count")
+post_delete.connect(favorites_changed, sender=FamilleFavorite, dispatch_uid="famille.famille_favorites_count")
+post_save.connect(favorites_changed, sender=PrestataireFavorite, dispatch_uid="famille.prestataire_favorites_count")
+post_delete.connect(favorites_changed, sender=PrestataireFavorite, dispatch_uid="famille.prestataire_favorites_count")
 payment_was_successful.connect(payment.signer.premium_signup, dispatch_uid="famille.premium")
 key_claimed.connect(UserInfo.verify_user, dispatch_uid="famille.verify")
 user_logged_in.connect(check_plan_expiration, dispatch_uid="famille.check_plan")
+connection_created.connect(geolocation.register_sqlite_functions, dispatch_uid="famille.sqlite_functions")
@@ -1,19 +1,40 @@
-import operator
+import hashlib
+import json
+import time
 
 from django.conf import settings
+from django.conf.urls import url
+from django.core.cache import cache, get_cache
 from django.core.exceptions import FieldError
-from django.db.models import Q, Count
+from django.db import connection
+from django.db.models import Count
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.http import StreamingHttpResponse
 from django.template.loader import render_to_string
 from tastypie import fields
 from tastypie.resources import ModelResource, ALL, ALL_WITH_RELATIONS
-from tastypie.exceptions import InvalidSortError
-
-from famille import models, forms, errors
-from famille.models import planning, compute_user_visibility_filters
-from famille.utils import get_result_template_from_user, get_overlap
-from famille.utils.python import pick, without
-from famille.utils.geolocation import is_close_enough, geolocate
-
+from tastypie.exceptions import InvalidSortError, ImmediateHttpResponse
+from tastypie.http import HttpForbidden
+from tastypie.paginator import Paginator
+from tastypie.utils import trailing_slash
+from tastypie.utils.mime import build_content_type
+
+from famille import models, forms, errors, data
+from famille.models import planning, users, compute_user_visibility_filters
+from famille.utils import fulltext, get_result_template_from_user, get_overlap
+from famille.utils.fulltext import FulltextIndex
+from famille.utils.index import CriteriaIndex, build_bitset, bitset_count, bitset_ids
+from famille.utils.matching import MatchScorer, MatchResults
+from famille.utils.pagination import CursorPaginator
+from famille.utils.python import pick, without, chunks, CacheStats
+
+
+# the cache of each process, for the rendered search cards
+local_cache = get_cache("local")
+# the maximum number of variables of the queries filtering by ids, older
+# builds of sqlite allowing 999 variables per query, the rest being
+# kept for the other filters (see CRITERIA_INDEX and SEARCH_FULLTEXT)
+MAX_SQL_VARIABLES = 900
 
 class WeekdayResource(ModelResource):
     """
@@ -101,50 +122,433 @@ class SearchResource(object):
     FIELD_DENIED_BASIC = ["email", "tel"]
 
     commaseparated_fields = ["type_garde", "diploma", "experience_type"]
+    # an optional CriteriaIndex over the exact / in filters, see build_criteria_index
+    criteria_index = None
+    # the FulltextIndex answering the q parameter if the database
+    # has no full text search, see build_fulltext_index
+    fulltext_index = None
+    # the fields counted by value in the facets, see get_facets
+    facet_fields = []
+    facet_boolean_fields = []
+    facet_commaseparated_fields = commaseparated_fields
+    # the GET parameters that do not change the facets
+    FACETS_IGNORED_PARAMS = ["limit", "offset", "cursor", "order_by", "format", "callback", "stream"]
+    # the planning filters answered with the availability bitmask
+    AVAILABILITY_FILTERS = {
+        "planning__weekday__in": "weekdays",
+        "planning__weekday__id__in": "weekdays",
+        "planning__schedule__in": "schedules",
+        "planning__schedule__id__in": "schedules",
+    }
+    # the relations read when dehydrating a result
+    related_fields = ["geolocation", "user"]
+    prefetch_fields = ["planning__weekday", "planning__schedule"]
+    compact_prefetch_fields = []
+    # hits / misses of the rendered cards, see dehydrate_template
+    card_cache_stats = CacheStats()
+    # orderings done by the database, with a stable tiebreak
+    # which allows the keyset pagination (see CursorPaginator)
+    sql_orderings = {
+        "-rating": ("-rating_avg", "-updated_at", "-id"),
+        "-updated_at": ("-updated_at", "-id")
+    }
+    default_ordering = "-updated_at"
 
     class Meta:
         allowed_methods = ["get", ]
+        paginator_class = CursorPaginator
 
-    def apply_sorting(self, obj_list, options=None):
+    def prepend_urls(self):
         """
-        Override apply_sorting method to manage particular cases,
-        like geolocation and rating.
+        Add the facets endpoint.
+        """
+        return [
+            url(
+                r"^(?P<resource_name>%s)/facets%s$" % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view("get_facets"), name="api_get_facets"
+            ),
+            url(
+                r"^(?P<resource_name>%s)/card_cache_stats%s$" % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view("get_card_cache_stats"), name="api_get_card_cache_stats"
+            ),
+        ]
+
+    def determine_format(self, request):
+        """
+        The compact format is serialized as json, see dehydrate_compact.
+
+        :param request:           the given HTTP request
+        """
+        if self.is_compact(request):
+            return "application/json"
+        return super(SearchResource, self).determine_format(request)
+
+    def is_compact(self, request):
+        """
+        Return True if the compact format is requested.
+
+        :param request:           the given HTTP request
+        """
+        return request.GET.get("format") == "compact"
+
+    def full_dehydrate(self, bundle, for_list=False):
+        """
+        Dehydrate the results with only the fields of the
+        search cards if the compact format is requested.
+
+        :param bundle:            the bundle to dehydrate
+        :param for_list:          if the bundle is part of a list
+        """
+        if bundle.request is not None and self.is_compact(bundle.request):
+            bundle.data = self.dehydrate_compact(bundle.obj)
+            return bundle
+        return super(SearchResource, self).full_dehydrate(bundle, for_list=for_list)
+
+    def dehydrate_compact(self, obj):
+        """
+        Return the fields needed to render the search card of
+        a result on the client side, instead of the template.
+        The badges are a bitmask, see Criteria.get_badges.
+
+        :param obj:               the result
+        """
+        return {
+            "id": obj.pk,
+            "resource_uri": self.get_resource_uri(obj),
+            "pseudo": obj.get_pseudo(),
+            "city": obj.city,
+            "rating": obj.total_rating,
+            "nb_ratings": obj.nb_ratings,
+            "badges": obj.get_badges(),
+            "tarif": obj.get_tarif_range(),
+            "profile_pic": obj.profile_pic.url if obj.profile_pic else None,
+            "languages": [
+                [l, data.LANGUAGES_DICT.get(l, u"")] for l in (obj.language or "").split(",") if l
+            ]
+        }
+
+    def get_list(self, request, **kwargs):
+        """
+        Return the serialized results. With the stream GET
+        parameter and the json format, the results are
+        streamed, see stream_list.
+
+        :param request:           the given HTTP request
+        """
+        if request.GET.get("stream") in ("1", "true") and self.determine_format(request) == "application/json":
+            # dispatch only returns HttpResponse instances
+            raise ImmediateHttpResponse(response=self.stream_list(request, **kwargs))
+
+        base_bundle = self.build_bundle(request=request)
+        objects = self.obj_get_list(bundle=base_bundle, **self.remove_api_resource_names(kwargs))
+        objects = self.sort_objects(request, objects)
+
+        paginator = self._meta.paginator_class(
+            request.GET, objects, resource_uri=self.get_resource_uri(), limit=self._meta.limit,
+            max_limit=self._meta.max_limit, collection_name=self._meta.collection_name
+        )
+        to_be_serialized = paginator.page()
+        objects = list(to_be_serialized[self._meta.collection_name])
+        self.prefetch_card_versions(request, objects)
+        to_be_serialized[self._meta.collection_name] = [
+            self.full_dehydrate(self.build_bundle(obj=obj, request=request), for_list=True)
+            for obj in objects
+        ]
+        to_be_serialized = self.alter_list_data_to_serialize(request, to_be_serialized)
+        return self.create_response(request, to_be_serialized)
+
+    def sort_objects(self, request, objects):
+        """
+        Sort the results. The match ordering depends on the
+        searcher (see order_by_match), the other ones are
+        handled by apply_sorting.
+
+        :param request:           the given HTTP request
+        :param objects:           the results
+        """
+        if request.GET.get("order_by") == "-match":
+            return self.order_by_match(request, objects)
+        return self.apply_sorting(objects, options=request.GET)
+
+    def order_by_match(self, request, objects):
+        """
+        Order the results by their match with the profile of the
+        searcher, see famille.utils.matching. Only the best results
+        up to the requested page are kept while scoring the results.
+
+        :param request:           the given HTTP request
+        :param objects:           the results
+        """
+        searcher = models.get_user_related(request.user) if models.has_user_related(request.user) else None
+        scorer = MatchScorer(
+            searcher, self._meta.object_class,
+            settings.SEARCH_MATCH["weights"], settings.SEARCH_MATCH["distance_scale"]
+        )
+        queryset = self._meta.object_class._default_manager.select_related(*self.related_fields)
+        queryset = queryset.prefetch_related(*self.get_prefetch_fields(request))
+        return MatchResults(objects.order_by(), scorer, queryset)
+
+    def stream_list(self, request, **kwargs):
+        """
+        Stream the serialized results as json. The results are
+        loaded and dehydrated by chunks (see settings.SEARCH_STREAMING),
+        so that the memory used does not depend on the number of results.
+        All the results are returned unless a limit is given.
+
+        :param request:           the given HTTP request
+        """
+        base_bundle = self.build_bundle(request=request)
+        objects = self.obj_get_list(bundle=base_bundle, **self.remove_api_resource_names(kwargs))
+        objects = self.sort_objects(request, objects)
+
+        paginator = Paginator(request.GET, objects, limit=0, max_limit=None)
+        limit, offset = paginator.get_limit(), paginator.get_offset()
+        meta = {
+            "limit": limit, "offset": offset, "next": None,
+            "previous": None, "total_count": paginator.get_count()
+        }
+        objects = objects[offset:offset + limit] if limit else objects[offset:]
+        return StreamingHttpResponse(
+            self.iter_serialized_list(request, objects, meta),
+            content_type=build_content_type("application/json")
+        )
+
+    def iter_serialized_list(self, request, objects, meta):
         """
-        order_by = options.get("order_by")
+        Serialize the results one by one, yielding json chunks.
 
-        if order_by == "-rating":
-            obj_list = sorted(obj_list, key=lambda u: - u.total_rating)
+        :param request:           the given HTTP request
+        :param objects:           the results
+        :param meta:              the meta of the results
+        """
+        yield '{"meta": %s, "%s": [' % (
+            self.serialize(request, meta, "application/json"), self._meta.collection_name
+        )
+        for i, obj in enumerate(self.iter_objects(request, objects)):
+            bundle = self.full_dehydrate(self.build_bundle(obj=obj, request=request), for_list=True)
+            yield ("," if i else "") + self.serialize(request, bundle, "application/json")
+        yield "]}"
+
+    def iter_objects(self, request, objects):
+        """
+        Iterate over the results by chunks: the ordered primary keys are
+        read with an iterator, and each chunk of results is then fetched
+        with its relations (see related_fields and prefetch_fields).
+
+        :param request:           the given HTTP request
+        :param objects:           the results, a queryset or a list
+        """
+        if isinstance(objects, list):
+            self.prefetch_card_versions(request, objects)
+            for obj in objects:
+                yield obj
+            return
+
+        pks = objects.prefetch_related(None).values_list("pk", flat=True).iterator()
+        queryset = objects.model._default_manager.select_related(*self.related_fields)
+        queryset = queryset.prefetch_related(*self.get_prefetch_fields(request))
+        for chunk in chunks(pks, settings.SEARCH_STREAMING["chunk_size"]):
+            results = queryset.in_bulk(chunk)
+            self.prefetch_card_versions(request, results.values())
+            for pk in chunk:
+                yield results[pk]
+
+    def get_card_cache_stats(self, request, **kwargs):
+        """
+        Return the hits / misses of the rendered cards cache
+        of the current process. Only for staff users.
+
+        :param request:           the given HTTP request
+        """
+        self.method_check(request, allowed=["get"])
+        if not request.user.is_staff:
+            return HttpForbidden()
+
+        return self.create_response(request, self.card_cache_stats.as_dict())
+
+    def get_facets(self, request, **kwargs):
+        """
+        Return the number of results for each value of the search
+        criteria, given the current filters. The facets are cached
+        for a short time in the cache shared by the processes (see
+        settings.SEARCH_FACETS), the counts are thus approximate:
+        they may miss the changes of the last seconds.
+
+        :param request:           the given HTTP request
+        """
+        self.method_check(request, allowed=["get"])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        cache_key = self.get_facets_cache_key(request)
+        facets = cache.get(cache_key)
+        if facets is None:
+            bundle = self.build_bundle(request=request)
+            queryset = self.obj_get_list(bundle=bundle, **self.remove_api_resource_names(kwargs))
+            facets = self.compute_facets(queryset.order_by())
+            cache.set(cache_key, facets, settings.SEARCH_FACETS["cache_timeout"])
+
+        return self.create_response(request, facets)
+
+    def get_facets_cache_key(self, request):
+        """
+        Return the cache key of the facets, built from the normalized
+        filters and from what makes the results depend on the user.
+
+        :param request:           the given HTTP request
+        """
+        params = sorted(
+            (key, sorted(request.GET.getlist(key)))
+            for key in request.GET if key not in self.FACETS_IGNORED_PARAMS
+        )
+        context = [self._meta.resource_name, params]
+        if models.has_user_related(request.user):
+            related = models.get_user_related(request.user)
+            context.append(type(related).__name__)
+            if "distance__iexact" in request.GET:
+                context.append(related.geolocation_id)
+
+        return "facets:%s" % hashlib.md5(json.dumps(context)).hexdigest()
+
+    def compute_facets(self, queryset):
+        """
+        Compute the facets of a queryset: the counts by value of the
+        facet fields, the counts of the boolean fields set, the counts by
+        value of the comma separated fields and the counts by tarif bucket.
+        Each kind of facet is computed with one grouped query, or using
+        the criteria index if any.
+
+        :param queryset:          the filtered queryset
+        """
+        facets = {}
+        fields = self.facet_fields + self.facet_boolean_fields
+        if self.criteria_index is not None and set(fields) <= set(self.criteria_index.fields):
+            bitset = build_bitset(queryset.values_list("pk", flat=True))
+            index_facets = self.criteria_index.facets(bitset)
+            for field in self.facet_fields:
+                facets[field] = dict((k, v) for k, v in index_facets.get(field, {}).iteritems() if k)
+            for field in self.facet_boolean_fields:
+                facets[field] = index_facets.get(field, {}).get(True, 0)
         else:
-            obj_list = super(SearchResource, self).apply_sorting(obj_list, options)
+            for field in self.facet_fields:
+                rows = queryset.values_list(field).annotate(count=Count("pk", distinct=True))
+                facets[field] = dict((value, count) for value, count in rows if value)
+            facets.update(self._compute_boolean_facets(queryset))
+
+        facets.update(self._compute_commaseparated_facets(queryset))
+        facets["tarif"] = self._compute_tarif_facets(queryset)
+        return facets
+
+    def _compute_boolean_facets(self, queryset):
+        """
+        Count the results having each boolean field set,
+        grouping by all the boolean fields at once.
+
+        :param queryset:          the filtered queryset
+        """
+        fields = self.facet_boolean_fields
+        facets = dict((field, 0) for field in fields)
+        if fields:
+            for row in queryset.values(*fields).annotate(count=Count("pk", distinct=True)):
+                for field in fields:
+                    if row[field]:
+                        facets[field] += row["count"]
+        return facets
+
+    def _compute_commaseparated_facets(self, queryset):
+        """
+        Count the results by value of the comma separated
+        fields, using the criteria table.
+
+        :param queryset:          the filtered queryset
+        """
+        fields = self.facet_commaseparated_fields
+        facets = dict((field, {}) for field in fields)
+        CriterionClass = users.CRITERION_CLASSES[self._meta.object_class]
+        rows = CriterionClass.objects.filter(
+            user__in=queryset.values("pk"), name__in=fields
+        ).values_list("name", "value").annotate(count=Count("user", distinct=True))
+        for name, value, count in rows:
+            facets[name][value] = count
+        return facets
+
+    def _compute_tarif_facets(self, queryset):
+        """
+        Count the results whose tarif overlaps each
+        tarif bucket (see settings.SEARCH_FACETS).
+
+        :param queryset:          the filtered queryset
+        """
+        buckets = settings.SEARCH_FACETS["tarif_buckets"]
+        facets = dict(("%s-%s" % bucket, 0) for bucket in buckets)
+        rows = queryset.filter(tarif_min__isnull=False, tarif_max__isnull=False).values_list(
+            "tarif_min", "tarif_max"
+        ).annotate(count=Count("pk", distinct=True))
+        for tarif_min, tarif_max, count in rows:
+            tarif = (tarif_min, tarif_max)
+            for bucket in buckets:
+                if get_overlap(bucket, tarif) > 0:
+                    facets["%s-%s" % bucket] += count
+        return facets
 
-        return self.filters_post_sorting(obj_list)
+    def apply_sorting(self, obj_list, options=None):
+        """
+        Override apply_sorting method to manage particular cases,
+        like rating, which is sorted using the denormalized average
+        (see UserInfo.rating_avg). The results are sorted by
+        default_ordering if no ordering is given.
+        """
+        options = options or {}
+        if options.get("q", "").strip() and not options.get("order_by"):
+            # ranked by filter_fulltext
+            return obj_list.order_by("-search_rank", "-id")
+
+        order_by = options.get("order_by", self.default_ordering)
+        if order_by in self.sql_orderings:
+            return obj_list.order_by(*self.sql_orderings[order_by])
+        return super(SearchResource, self).apply_sorting(obj_list, options)
 
     def apply_filters(self, request, applicable_filters):
         """
         Apply filtering on the objects. It first filters user that
         are premium (depending on the setting ALLOW_BASIC_PLAN_IN_SEARCH),
-        and then apply (if needed) the filtering on number of children.
+        and then apply (if needed) the filtering on number of children
+        and on distance.
 
         :param request:                a django HttpRequest object
         :param applicable_filters:     a dict of resource filters
         """
-        self.__request = request
         commaseparated_filters = {}
         nb_enfants = request.GET.get("n_enfants__length")
+        age = request.GET.get("age")
+        distance = request.GET.get("distance__iexact")
+        postal_code = request.GET.get("pc__iexact")
+        query = request.GET.get("q", "").strip()
         language = applicable_filters.pop("language__in", None)
         for f in self.commaseparated_fields:
             commaseparated_filters[f] = applicable_filters.pop("%s__in" % f, None)
-        applicable_filters.pop("tarif__in", None)  # we remove it since processed in filters_post_sorting
+        tarif = applicable_filters.pop("tarif__in", None)
+        availability = self.pop_availability_filters(applicable_filters)
+        # with a q search, the ids of both indexes would exceed the variables of sqlite
+        indexed_ids = None if query else self.filter_criteria_index(applicable_filters)
 
         qs = super(SearchResource, self).apply_filters(request, applicable_filters)
         qs = qs.distinct()  # for enfants__school filtering, can return duplicates
 
+        if indexed_ids is not None:
+            qs = qs.filter(pk__in=indexed_ids)
+
         if not settings.ALLOW_BASIC_PLAN_IN_SEARCH:
             qs = qs.filter(plan=self._meta.object_class.PLANS["premium"])
 
+        qs = self._meta.object_class.filter_visible(qs)
+
         if nb_enfants:
             qs = self.filter_nb_enfants(nb_enfants, qs)
 
+        if age:
+            qs = self.filter_age(age, qs)
+
         if language:
             qs = self.filter_language(language, qs)
 
@@ -152,43 +556,93 @@ class SearchResource(object):
             if value:
                 qs = self._filter_commaseparated_field(f, value, qs)
 
-        return qs
-
-    def filters_post_sorting(self, object_list):
-        """
-        Apply distance filtering after sorting since it returns a list.
-        """
-        distance = self.__request.GET.get("distance__iexact")
-        postal_code = self.__request.GET.get("pc__iexact")
-        tarif = self.__request.GET.get("tarif__in")
-        user = self.__request.user
-        del self.__request
+        if tarif:
+            qs = self.filter_tarif(tarif, qs)
 
-        object_list = [obj for obj in object_list if obj.visibility_score_is_enough]
+        if availability is not None:
+            qs = self._meta.object_class.filter_available(qs, availability)
 
-        if tarif and len(tarif.split(",")) == 2:
-           object_list = self.filter_tarif(tarif.split(","), object_list)
+        if query:
+            qs = self.filter_fulltext(query, qs)
 
         if postal_code:
-            return self.filter_postal_code(postal_code, object_list)
+            qs = self.filter_postal_code(postal_code, qs)
+        elif distance and models.user_is_located(request.user):
+            related = models.get_user_related(request.user)
+            qs = self.filter_distance(distance, related.geolocation, qs)
+
+        return qs
+
+    def filter_criteria_index(self, applicable_filters):
+        """
+        Answer the exact / in filters on the indexed fields using
+        the criteria index, if any, and return the matching ids. The
+        values are converted like the database does ("on" is True
+        for a boolean field). The filters are left in applicable_filters,
+        so that the database also checks them in case the index is
+        stale. If there are too many matching ids (see
+        settings.CRITERIA_INDEX), None is returned.
+
+        :param applicable_filters:     a dict of resource filters
+        """
+        if self.criteria_index is None:
+            return None
+
+        criteria = {}
+        for key, value in applicable_filters.iteritems():
+            field, _, lookup = key.partition("__")
+            if field in self.criteria_index.fields and lookup in ("exact", "in"):
+                model_field = self._meta.object_class._meta.get_field(field)
+                value = model_field.get_prep_lookup(lookup, value)
+                criteria[field] = value if lookup == "in" else [value]
+        if not criteria:
+            return None
+
+        bitset = self.criteria_index.query(criteria)
+        if bitset_count(bitset) > min(settings.CRITERIA_INDEX["max_ids"], MAX_SQL_VARIABLES):
+            return None
+        return bitset_ids(bitset)
+
+    def pop_availability_filters(self, applicable_filters):
+        """
+        Replace the filters on the weekdays / schedules of the plannings
+        by a filter on the availability bitmask of the users (see
+        Criteria.availability), avoiding the joins on the plannings.
+        The filters are removed from applicable_filters and the bitmask
+        is returned, or None if there is no such filter.
 
-        if not distance or not models.user_is_located(user):
-            return object_list
+        :param applicable_filters:     a dict of resource filters
+        """
+        keys = {}
+        for key, value in applicable_filters.iteritems():
+            if key in self.AVAILABILITY_FILTERS:
+                keys[key] = self.AVAILABILITY_FILTERS[key]
+        if not keys:
+            return None
+
+        ids = {"weekdays": [], "schedules": []}
+        for key, name in keys.iteritems():
+            ids[name].extend(applicable_filters[key])
+        try:
+            mask = planning.availability_mask(**ids)
+        except ValueError:
+            return None
 
-        related = models.get_user_related(user)
-        return self.filter_distance(distance, related.geolocation, object_list)
+        for key in keys:
+            del applicable_filters[key]
+        return mask
 
     def filter_distance(self, distance, geoloc, queryset):
         """
         Filter the queryset using distance and the user that is querying.
+        The filtering is done by the database, see UserInfo.located_within.
 
         :param distance:        the distance to look for
         :param geoloc:          the user geolocation that does the query
         :param queryset:        the queryset
         """
         distance = float(distance)  # distance in km
-        condition = lambda o: o.is_geolocated and is_close_enough(geoloc, o.geolocation, distance)
-        return [o for o in queryset if condition(o)]
+        return self._meta.object_class.located_within(geoloc, distance, queryset)
 
     def filter_postal_code(self, postal_code, queryset):
         """
@@ -216,6 +670,16 @@ class SearchResource(object):
         """
         raise NotImplementedError()
 
+    def filter_age(self, age, queryset):
+        """
+        Filter the queryset by an age bucket.
+        Only implemented for prestataires.
+
+        :param age:            the age bucket
+        :param queryset:       the initial queryset
+        """
+        raise NotImplementedError()
+
     def filter_language(self, language, queryset):
         """
         Filter the queryset by the languages.
@@ -226,21 +690,54 @@ class SearchResource(object):
         """
         raise NotImplementedError()
 
+    def filter_fulltext(self, query, queryset):
+        """
+        Filter the queryset by a full text query over the search text
+        of the users (see Criteria.get_search_text), and select the
+        rank of the results as search_rank. The postgresql full text
+        search is used if available, otherwise the fulltext index.
+
+        :param query:          the searched text
+        :param queryset:       the initial queryset
+        """
+        opts = self._meta.object_class._meta
+        table = connection.ops.quote_name(opts.db_table)
+        if self.fulltext_index is None:
+            column = "%s.%s" % (table, connection.ops.quote_name("search_text"))
+            vector, query = fulltext.tsvector_sql(column), fulltext.normalize(query)
+            return queryset.extra(
+                select={"search_rank": "ts_rank(%s, %s)" % (vector, fulltext.tsquery_sql())},
+                select_params=[query], where=["%s @@ %s" % (vector, fulltext.tsquery_sql())], params=[query]
+            )
+
+        # 3 variables per result: the id and the rank in the CASE, the id in pk__in
+        max_results = min(settings.SEARCH_FULLTEXT["max_results"], MAX_SQL_VARIABLES // 3)
+        ranked = self.fulltext_index.query(query)[:max_results]
+        if not ranked:
+            return queryset.none().extra(select={"search_rank": "0"})
+        rank = "CASE %s.%s %s ELSE 0 END" % (
+            table, connection.ops.quote_name(opts.pk.column), " ".join("WHEN %s THEN %s" for _ in ranked)
+        )
+        return queryset.filter(pk__in=[pk for pk, _ in ranked]).extra(
+            select={"search_rank": rank}, select_params=[v for item in ranked for v in item]
+        )
+
     def filter_tarif(self, tarif, queryset):
         """
-        Filter the queryset by the tarif. Compute the
-        intersection of intervals.
+        Filter the queryset by the tarif: keep the users whose
+        tarif overlaps the interval, using the bounds of the
+        tarif (see Criteria.tarif_min and tarif_max).
 
         :param tarif:          the tarif interval
         :param queryset:       the initial queryset
         """
-        tarif = [int(v) for v in tarif]
-        objects = []
-        for o in queryset:
-            o_tarif = [int(v) for v in o.tarif.split(",")]
-            if get_overlap(tarif, o_tarif) > 0:
-                objects.append(o)
-        return objects
+        if isinstance(tarif, basestring):
+            tarif = tarif.split(",")
+        try:
+            low, high = [int(v) for v in tarif]
+        except ValueError:
+            return queryset
+        return queryset.filter(tarif_min__lte=high, tarif_max__gte=low)
 
     def dehydrate(self, bundle):
         """
@@ -260,38 +757,230 @@ class SearchResource(object):
 
     def dehydrate_template(self, bundle):
         """
-        Dehydrate the template using the bundle.
+        Dehydrate the template using the bundle. The rendered
+        card is cached, see get_card_cache_key.
         """
+        cache_key = self.get_card_cache_key(bundle.obj, bundle.request.user)
+        card = local_cache.get(cache_key)
+        if card is not None:
+            self.card_cache_stats.hit()
+            return card
+
+        self.card_cache_stats.miss()
         search_type = "prestataire" if self._meta.resource_name == "prestataires" else "famille"
         template = get_result_template_from_user(bundle.request, search_type)
         context = {"result": bundle.obj, "user": bundle.request.user}
-        return render_to_string(template, context)
+        card = render_to_string(template, context)
+        local_cache.set(cache_key, card, settings.SEARCH_CARD_CACHE["timeout"])
+        return card
+
+    def prefetch_card_versions(self, request, objects):
+        """
+        Fetch the versions of the cards of the results (see
+        get_card_version) at once, if the cards are rendered.
+
+        :param request:      the given HTTP request
+        :param objects:      the results
+        """
+        if self.is_compact(request) or not objects:
+            return
+        versions = get_card_versions(self._meta.object_class, [obj.pk for obj in objects])
+        for obj in objects:
+            obj.card_version = versions[obj.pk]
+
+    def get_card_cache_key(self, obj, user):
+        """
+        Return the cache key of the card of a result, which depends
+        on the result version (see bump_card_version) and on what the
+        viewer can see: anonymous and basic users see the same cards,
+        premium users see a rating form for themselves.
+
+        The versions are kept in the shared cache, so that a change
+        invalidates the cards in all the processes, while the cards
+        are kept in the local cache of each process.
+
+        :param obj:          the result
+        :param user:         the request user
+        """
+        if not user.is_authenticated():
+            viewer = "anonymous"
+        elif models.has_user_related(user) and models.get_user_related(user).is_premium:
+            viewer = "premium-%s" % models.get_user_related(user).simple_id
+        else:
+            viewer = "basic"
+
+        # no spaces, the key must be valid for memcached too
+        updated_at = obj.updated_at.strftime("%Y%m%d%H%M%S%f") if obj.updated_at else ""
+        version = getattr(obj, "card_version", None) or get_card_version(type(obj), obj.pk)
+        return "search_card:%s:%s:%s:%s:%s:%s" % (
+            type(obj).__name__.lower(), obj.pk, version,
+            updated_at, obj.rating_count, viewer
+        )
 
     def get_object_list(self, request):
         """
-        Filter allowed object given the HTTP request.
+        Filter allowed object given the HTTP request. The relations
+        used when dehydrating the results are fetched in a constant
+        number of queries (see related_fields and prefetch_fields).
 
         :param request:           the given HTTP request
         """
         filters = compute_user_visibility_filters(request.user)
-        return super(SearchResource, self).get_object_list(request).filter(filters)
+        queryset = super(SearchResource, self).get_object_list(request).filter(filters)
+        queryset = queryset.select_related(*self.related_fields)
+        return queryset.prefetch_related(*self.get_prefetch_fields(request))
+
+    def get_prefetch_fields(self, request):
+        """
+        Return the relations to prefetch, fewer
+        of them being used by the compact format.
+
+        :param request:           the given HTTP request
+        """
+        return self.compact_prefetch_fields if self.is_compact(request) else self.prefetch_fields
 
     def _filter_commaseparated_field(self, field, values, queryset):
         """
         Filter the queryset by a comma separated field. This is
         useful for type_garde and language fields for instance.
+        The values are looked up in the criteria table, see
+        models.users.BaseCriterion.
 
         :param field:          the name of the field
         :param values:         the desired values
         :param queryset:       the initial queryset
         """
-        field_query = "%s__icontains" % field
-        filters = map(lambda v: Q(**{field_query: v}), values)
-        filters = reduce(operator.or_, filters, Q())
-        return queryset.filter(filters)
+        CriterionClass = users.CRITERION_CLASSES[self._meta.object_class]
+        return CriterionClass.filter_users(queryset, field, values)
+
+
+def _card_version_key(UserClass, pk):
+    return "search_card_version:%s:%s" % (UserClass.__name__.lower(), pk)
+
+
+def get_card_version(UserClass, pk):
+    """
+    Return the version of the search card of a user. A missing
+    version is initialized from the clock, so that it never
+    matches a card rendered before it was evicted.
+
+    :param UserClass:      the user class
+    :param pk:             the user id
+    """
+    key = _card_version_key(UserClass, pk)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+def get_card_versions(UserClass, pks):
+    """
+    Return the versions of the search cards of some
+    users, with one query to the cache if they exist.
+
+    :param UserClass:      the user class
+    :param pks:            the user ids
+    """
+    keys = dict((_card_version_key(UserClass, pk), pk) for pk in pks)
+    versions = cache.get_many(keys.keys())
+    return dict(
+        (pk, versions[key] if key in versions else get_card_version(UserClass, pk))
+        for key, pk in keys.iteritems()
+    )
+
+
+def bump_card_version(UserClass, pk):
+    """
+    Invalidate the search cards of a user.
+
+    :param UserClass:      the user class
+    :param pk:             the user id
+    """
+    key = _card_version_key(UserClass, pk)
+    cache.set(key, max(get_card_version(UserClass, pk) + 1, int(time.time() * 1000)), None)
+
+
+# the field linking a model to the user whose search card displays it
+CARD_USER_FIELDS = {
+    models.FamillePlanning: "famille",
+    models.PrestatairePlanning: "prestataire",
+    models.FamilleRatings: "user",
+    models.PrestataireRatings: "user",
+    models.Enfant: "famille"
+}
+
+
+def invalidate_search_card(sender, instance, **kwargs):
+    """
+    Invalidate the search card of the user that was saved,
+    or of the user the saved planning / rating / enfant belongs to.
+    """
+    if isinstance(instance, models.UserInfo):
+        bump_card_version(type(instance), instance.pk)
+        return
+
+    field = instance._meta.get_field(CARD_USER_FIELDS[type(instance)])
+    user_id = getattr(instance, field.attname)
+    if user_id:
+        bump_card_version(field.rel.to, user_id)
+
+
+def invalidate_planning_search_card(sender, instance, action, **kwargs):
+    """
+    Invalidate the search card of a user when the
+    weekdays / schedules of one of his plannings change.
+    """
+    if action in ("post_add", "post_remove", "post_clear") and type(instance) in CARD_USER_FIELDS:
+        invalidate_search_card(type(instance), instance)
+
+
+def build_fulltext_index(model):
+    """
+    Build the fulltext index of a search resource if the
+    database has no full text search (see the GIN index
+    on search_text for postgresql).
+
+    :param model:          the searched model
+    """
+    if connection.vendor == "postgresql":
+        return None
+
+    index = FulltextIndex(model, "search_text", max_age=settings.SEARCH_FULLTEXT["max_age"])
+    index.connect()
+    return index
+
+
+def build_criteria_index(model, fields):
+    """
+    Build the criteria index of a search resource, if
+    enabled (see settings.CRITERIA_INDEX).
+
+    :param model:          the searched model
+    :param fields:         the indexed fields
+    """
+    if not settings.CRITERIA_INDEX["enabled"]:
+        return None
+
+    index = CriteriaIndex(model, fields, max_age=settings.CRITERIA_INDEX["max_age"])
+    index.connect()
+    return index
 
 
 class PrestataireResource(SearchResource, ModelResource):
+    INDEXED_FIELDS = [
+        "type", "studies", "experience_year", "enfant_malade", "menage", "repassage",
+        "cuisine", "devoirs", "animaux", "permis", "psc1", "non_fumeur"
+    ]
+    criteria_index = build_criteria_index(models.Prestataire, INDEXED_FIELDS)
+    fulltext_index = build_fulltext_index(models.Prestataire)
+    facet_fields = ["type", "studies", "experience_year"]
+    facet_boolean_fields = [
+        "enfant_malade", "menage", "repassage", "cuisine", "devoirs",
+        "animaux", "permis", "psc1", "non_fumeur"
+    ]
+    facet_commaseparated_fields = SearchResource.commaseparated_fields + ["language"]
 
     plannings = fields.ToManyField(FamillePlanningResource, "planning", full=True, null=True)
     rating = fields.FloatField(attribute="total_rating")
@@ -309,6 +998,27 @@ class PrestataireResource(SearchResource, ModelResource):
             plannings=ALL_WITH_RELATIONS, birthday=('lte', 'gte')
         )
 
+    def dehydrate_compact(self, obj):
+        """
+        Add the type of prestataire to the compact fields.
+
+        :param obj:               the result
+        """
+        compact = super(PrestataireResource, self).dehydrate_compact(obj)
+        compact["type"] = obj.get_type()
+        return compact
+
+    def filter_age(self, age, queryset):
+        """
+        Filter the queryset by an age bucket, using
+        a range of birthdays (see Prestataire.AGES).
+
+        :param age:            the age bucket
+        :param queryset:       the initial queryset
+        """
+        lookups = models.Prestataire.get_birthday_lookups(age)
+        return queryset.filter(**lookups) if lookups else queryset
+
     def filter_language(self, language, queryset):
         """
         Filter the queryset by the languages.
@@ -320,6 +1030,11 @@ class PrestataireResource(SearchResource, ModelResource):
 
 
 class FamilleResource(SearchResource, ModelResource):
+    fulltext_index = build_fulltext_index(models.Famille)
+    facet_fields = ["type", "type_presta", "type_attente_famille"]
+    prefetch_fields = SearchResource.prefetch_fields + ["enfants"]
+    compact_prefetch_fields = ["enfants"]
+
     plannings = fields.ToManyField(FamillePlanningResource, "planning", full=True, null=True)
     enfants = fields.ToManyField(EnfantResource, "enfants", full=True, null=True)
     rating = fields.FloatField(attribute="total_rating")
@@ -341,11 +1056,22 @@ class FamilleResource(SearchResource, ModelResource):
             plannings=ALL_WITH_RELATIONS, enfants=ALL_WITH_RELATIONS
         )
 
+    def dehydrate_compact(self, obj):
+        """
+        Add the number of children to the compact fields.
+
+        :param obj:               the result
+        """
+        compact = super(FamilleResource, self).dehydrate_compact(obj)
+        compact["nb_enfants"] = len(obj.enfants.all())
+        return compact
+
     def dehydrate_nb_enfants(self, bundle):
         """
-        Dehydrate the number of childrens.
+        Dehydrate the number of childrens, using
+        the prefetched enfants.
         """
-        return bundle.obj.enfants.count()
+        return len(bundle.obj.enfants.all())
 
     def filter_nb_enfants(self, nb_enfants, queryset):
         """
@@ -356,3 +1082,16 @@ class FamilleResource(SearchResource, ModelResource):
         """
         queryset = queryset.annotate(nb_enfants=Count("enfants"))
         return queryset.filter(nb_enfants=nb_enfants)
+
+
+# signals
+for model in [models.Famille, models.Prestataire] + CARD_USER_FIELDS.keys():
+    uid = "famille.search_card.%s" % model.__name__
+    post_save.connect(invalidate_search_card, sender=model, dispatch_uid=uid)
+    post_delete.connect(invalidate_search_card, sender=model, dispatch_uid=uid)
+for PlanningClass in (models.FamillePlanning, models.PrestatairePlanning):
+    for through in (PlanningClass.weekday.through, PlanningClass.schedule.through):
+        m2m_changed.connect(
+            invalidate_planning_search_card, sender=through,
+            dispatch_uid="famille.search_card.%s" % through.__name__
+        )
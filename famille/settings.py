@@ -86,6 +86,24 @@ DATABASES = {
     'default': dj_database_url.config()
 }
 
+# Cache, the default one is shared by all the processes (the search cards
+# versions, the facets...), create its table with
+# `./manage.py createcachetable famille_cache`. The local one is per process.
+# https://docs.djangoproject.com/en/1.6/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'famille.utils.cache.DatabaseCache',
+        'LOCATION': 'famille_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        }
+    },
+    'local': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
@@ -145,6 +163,49 @@ for key in os.environ:
 
 NB_SEARCH_RESULTS = 5
 POSTAL_CODE_DISTANCE = 20.0
+POSTAL_CODE_CACHE_SIZE = 10000
+POSTAL_CODE_CACHE_STATS_INTERVAL = 1000  # number of lookups between two logs of the cache stats, 0 to disable
+FAVORITES_COUNT_CACHE_TIMEOUT = 60 * 60  # in seconds, invalidated when a favorite is added or removed
+GEOCODER = "famille.utils.geolocation.google_geocode"  # famille.utils.geolocation.dummy_geocode for local dev
+GEOLOCATION_JOBS = {
+    "max_attempts": 5,
+    "backoff": 600,  # in seconds, doubled after each failed attempt
+}
+GEOLOCATION_CACHE = {
+    "size": 10000,
+    "ttl": 30 * 24 * 3600,  # in seconds
+    "error_ttl": 3600,  # in seconds, for the addresses not found by the geocoder
+    "eviction": "lru",  # see famille.utils.python.CACHE_EVICTION_POLICIES
+}
+CRITERIA_INDEX = {
+    "enabled": False,  # in-memory index of the prestataire search criteria, see famille.utils.index
+    "max_age": 3600,  # in seconds, the index is rebuilt after, or when changed by another process
+    "max_ids": 900,  # above, the criteria are filtered by the database instead
+}
+SEARCH_CARD_CACHE = {
+    "timeout": 24 * 3600,  # in seconds, the cards are also invalidated when the user changes
+}
+SEARCH_STREAMING = {
+    "chunk_size": 200,  # number of results loaded at once when streaming, see SearchResource.stream_list
+}
+SEARCH_MATCH = {
+    # the weights of the scores when ordering the results by match, see famille.utils.matching
+    "weights": {"criteria": 3.0, "planning": 2.0, "distance": 2.0, "rating": 1.0, "premium": 0.5},
+    "distance_scale": 10,  # in km, the distance at which the distance score is halved
+}
+SEARCH_FULLTEXT = {
+    # the fulltext index is only used without postgresql, see famille.utils.fulltext
+    "max_age": 3600,  # in seconds, the fulltext index is rebuilt after
+    "max_results": 300,  # maximum number of results of a q search with the fulltext index, 3 SQL variables each
+}
+AUTOCOMPLETE = {
+    "max_results": 10,  # number of users returned by the message recipients lookup
+    "cache_timeout": 30,  # in seconds, absorbs the repeated keystrokes
+}
+SEARCH_FACETS = {
+    "cache_timeout": 30,  # in seconds, in the shared cache, the counts are approximate for as long
+    "tarif_buckets": [(3, 5), (6, 8), (9, 11), (12, 14), (15, 20)],  # in euros per hour
+}
 NOREPLY_EMAIL = "ne-pas-repondre@uneviedefamille.fr"
 CONTACT_EMAIL = "contact.uneviedefamille@gmail.com"
 DEFAULT_FROM_EMAIL = NOREPLY_EMAIL
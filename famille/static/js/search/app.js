@@ -8,6 +8,8 @@ function App(){
     this.maxNbSearchResults = parseInt($(".max-nb-search-results").val(), 10);
     this.totalNbSearchResults = parseInt($(".total-nb-search-results").val(), 10);
     this.emptyResultTemplate = $(".empty-result-template").html();
+    this.compactResultTemplate = $(".compact-result-template").html();
+    this.badges = JSON.parse($(".badges").val() || "[]");
     this.searchType = $(".search-type").val();
     this.searchApi = "/api/v1/{type}s/?".replace("{type}", this.searchType);
     this.userPlan = $(".p-type").val();
@@ -21,11 +23,14 @@ App.prototype.initialize = function(){
         totalNbSearchResults: this.totalNbSearchResults,
         baseUrl: this.baseUrl,
         searchApi: this.searchApi,
-        searchType: this.searchType
+        searchType: this.searchType,
+        compact: !!this.compactResultTemplate
     });
     this.view = new View({
         el: $(".search-view"),
         resultTemplate: this.emptyResultTemplate,
+        compactResultTemplate: this.compactResultTemplate,
+        badges: this.badges,
         userPlan: this.userPlan
     });
     this.view.initFavorites();
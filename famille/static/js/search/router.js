@@ -16,6 +16,7 @@ module.exports = Backbone.Router.extend({
         this.baseUrl = options.baseUrl;
         this.searchType = options.searchType;
         this.searchApi = options.searchApi;
+        this.compact = options.compact;
         if (options.totalNbSearchResults > this.limit)
             this.next = this.searchApi + "offset=" + this.limit + "&limit=" + this.limit;
         this.previous = null;
@@ -49,6 +50,8 @@ module.exports = Backbone.Router.extend({
 
     addMetaToUrl: function (url) {
         if (url.indexOf("limit") === -1) url += "&limit=" + this.limit;
+        // the cards are rendered from the compact results, see view.formatResult
+        if (this.compact && url.indexOf("format=") === -1) url += "&format=compact";
 
         return url;
     },
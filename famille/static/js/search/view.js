@@ -18,23 +18,9 @@ var constructTarifFilter = function (name, value) {
 };
 
 
+// the age bucket is translated into a range of birthdays by the API
 var constructAgeFilter = function(name, value) {
-    var birhdayField = "birthday";
-    var today = new Date();
-    var birthDate;
-    switch(value) {
-        case "16-":
-            birthDate = new Date(today.setYear(today.getYear() - 16));
-            return birhdayField + "__gte="+ birthDate.toISOString().split('T')[0];
-        case "18-":
-            birthDate = new Date(today.setYear(today.getYear() - 18));
-            return birhdayField + "__gte="+ birthDate.toISOString().split('T')[0];
-        case "18+":
-            birthDate = new Date(today.setYear(today.getYear() - 18));
-            return birhdayField + "__lte="+ birthDate.toISOString().split('T')[0];
-        default:
-            return "";
-    }
+    return "age=" + encodeURIComponent(value);
 };
 
 var dateToIso = function (date) {
@@ -63,6 +49,8 @@ module.exports = Backbone.View.extend({
 
     initialize: function(options){
         this.resultTemplate = options.resultTemplate;
+        this.compactResultTemplate = options.compactResultTemplate && _.template(options.compactResultTemplate);
+        this.badges = options.badges;
         this.userPlan = options.userPlan;
         _.bindAll(this, "displayResults", "formatResult", "displayNext", "displayPrevious", "toggleFavorite");
         this.$distanceButton = this.$(".control-distance");
@@ -189,11 +177,25 @@ module.exports = Backbone.View.extend({
 
     formatResult: function(object){
         return new ResultView({
-            el: object.template,
+            el: _.has(object, "template") ? object.template : this.renderCompactResult(object),
             data: object
         });
     },
 
+    /**
+     * Render a card from a result of the compact format: the
+     * badges are a bitmask following the order of this.badges.
+     */
+    renderCompactResult: function(object){
+        var badges = _.map(this.badges, function (badge) { return badge.join(","); });
+        var badge = function (name, value, image) {
+            var index = _.indexOf(badges, name + "," + (value || "")),
+                icon = image || value || name;
+            return (object.badges & (1 << index)) ? icon : "no-" + icon;
+        };
+        return $.trim(this.compactResultTemplate({result: object, badge: badge}));
+    },
+
     error: function(jqXHR){
         notifier.error("Une erreur est survenue, veuillez réessayer ultérieurement.");
     },
@@ -110,7 +110,7 @@ def get_rating_form(profile, request_user):
 
     if has_user_related(request_user):
         related_user = get_user_related(request_user)
-        if not RatingClass.user_has_voted_for(related_user, profile):
+        if profile.pk not in RatingClass.get_voted_user_ids(related_user):
             rating = RatingClass(user=profile, by=related_user.simple_id)
             return RatingFormClass(instance=rating)
     return None
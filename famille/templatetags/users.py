@@ -26,6 +26,29 @@ def get_badge_icon(user, name):
     return BADGE_FOLDER % name
 
 
+@register.filter(name='has_value')
+def has_value(values, value):
+    """
+    Return True if a value is one of the values
+    of a comma separated field.
+
+    :param values:    the comma separated values
+    :param value:     the value to look for
+    """
+    return unicode(value) in (values or "").split(",")
+
+
+@register.filter(name='is_favorite')
+def is_favorite(user, favorites):
+    """
+    Return True if a user is one of the favorites.
+
+    :param user:         the user
+    :param favorites:    the set of (object_type, object_id), see UserInfo.get_favorite_keys
+    """
+    return (user.__class__.__name__, user.pk) in (favorites or ())
+
+
 @register.filter(name='badge_icon_garde')
 def get_badge_icon_garde(user, value):
     """
@@ -35,8 +58,7 @@ def get_badge_icon_garde(user, value):
     :param user:     the user
     :param value:     the value of the parameter
     """
-    garde = user.type_garde or ""
-    if value not in garde:
+    if not has_value(user.type_garde, value):
         value = "no-%s" % value
 
     return BADGE_FOLDER % value
@@ -77,8 +99,7 @@ def get_language_icon(user, value):
     :param user:     the user
     :param value:    the value of the language
     """
-    language = user.language or ""
-    if value in language:
+    if has_value(user.language, value):
         return FLAG_FOLDER % value
 
 
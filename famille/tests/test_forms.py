@@ -10,7 +10,10 @@ from famille import forms, models
 from famille.utils import fields
 
 
-__all__ = ["RegistrationFormTestCase", "FamilleFormTestCase", "AccountFormManager", "FieldsTestCase"]
+__all__ = [
+    "RegistrationFormTestCase", "FamilleFormTestCase", "AccountFormManager",
+    "PlanningFormTestCase", "FieldsTestCase"
+]
 
 
 class RegistrationFormTestCase(TestCase):
@@ -207,6 +210,22 @@ class AccountFormManager(TestCase):
         self.assertFalse(m.forms["profil"].save.called)
 
 
+class PlanningFormTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("a", "a@gmail.com", "a")
+        self.famille = models.Famille.objects.create(user=self.user, email="a@gmail.com")
+
+    def test_save_update_availability(self):
+        data = {"plannings": [{"start_date": "2014-10-01", "weekday": [1, 3], "schedule": [2]}]}
+        form = forms.FamillePlanningApiForm(data=data, instance=self.famille)
+        self.assertTrue(form.is_valid())
+        form.save()
+
+        famille = models.Famille.objects.get(pk=self.famille.pk)
+        self.assertEqual(famille.availability, models.availability_mask([1, 3], [2]))
+
+
 class FieldsTestCase(TestCase):
 
     def test_upload_to_timestamp(self):
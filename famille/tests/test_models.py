@@ -7,6 +7,7 @@ import types
 
 from django.conf import settings
 from django.contrib.auth.models import User, AnonymousUser
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.models.signals import pre_save
 from django.http.request import HttpRequest
@@ -17,12 +18,12 @@ from paypal.standard.ipn.models import PayPalIPN
 from verification.models import KeyGroup, Key
 
 from famille import models, errors
-from famille.models import utils, planning
+from famille.models import utils, planning, users
 from famille.models.users import (
     UserInfo, FamilleFavorite, PrestataireFavorite,
     Geolocation, check_plan_expiration
 )
-from famille.utils import payment
+from famille.utils import payment, geolocation
 
 
 __all__ = ["ModelsTestCase", "RatingTestCase", "GeolocationTestCase"]
@@ -99,12 +100,77 @@ class ModelsTestCase(TestCase):
         self.famille.save()
 
         self.famille.geolocate()
-        geolocate.assert_called_with("32 rue des Epinettes 75017 Paris, France")
+        geolocate.assert_called_with("32 rue des Epinettes 75017 Paris, France", use_cache=True)
         self.assertIsNotNone(models.Geolocation.objects.filter(lat=48.895603, lon=2.322858).first())
         self.assertEqual(self.famille.geolocation.lat, 48.895603)
         self.assertEqual(self.famille.geolocation.lon, 2.322858)
+        self.assertEqual(models.Famille.objects.get(pk=self.famille.pk).geolocation, self.famille.geolocation)
 
-    @patch("famille.models.users.UserInfo.geolocate")
+    def test_schedule_geolocation(self):
+        self.famille.city = "Paris"
+        self.famille.save()
+        self.famille.schedule_geolocation()
+        self.famille.schedule_geolocation()
+        self.assertTrue(self.famille.geolocation.pending)
+        self.assertFalse(self.famille.is_geolocated)
+        self.assertEqual(models.Famille.objects.get(pk=self.famille.pk).geolocation, self.famille.geolocation)
+        self.assertEqual(models.GeolocationJob.objects.filter(object_type="Famille").count(), 1)
+
+    @patch("famille.utils.geolocation.geolocate")
+    def test_geolocation_job_run(self, geolocate):
+        geolocate.return_value = 48.895603, 2.322858
+        self.famille.city = "Paris"
+        self.famille.save()
+        self.famille.schedule_geolocation()
+
+        self.assertEqual(models.GeolocationJob.run_pending(), 1)
+        famille = models.Famille.objects.get(pk=self.famille.pk)
+        self.assertTrue(famille.is_geolocated)
+        self.assertFalse(famille.geolocation.pending)
+        self.assertFalse(models.GeolocationJob.objects.exists())
+
+    @patch("famille.utils.geolocation.geolocate")
+    def test_geolocation_job_retry(self, geolocate):
+        geolocate.side_effect = errors.GeolocationError()
+        self.famille.city = "Paris"
+        self.famille.save()
+        job = models.GeolocationJob.enqueue(self.famille)
+
+        job.run()
+        job = models.GeolocationJob.objects.get(pk=job.pk)
+        self.assertEqual(job.attempts, 1)
+        self.assertGreater(job.run_at, datetime.now(utc))
+        self.assertTrue(models.Famille.objects.get(pk=self.famille.pk).geolocation.pending)
+        self.assertEqual(models.GeolocationJob.run_pending(), 0)  # not due yet
+
+        job.attempts = settings.GEOLOCATION_JOBS["max_attempts"] - 1
+        job.save()
+        job.run()
+        self.assertFalse(models.GeolocationJob.objects.exists())
+        self.assertTrue(models.Famille.objects.get(pk=self.famille.pk).geolocation.has_error)
+
+    @patch("famille.utils.geolocation._geocode")
+    def test_geolocation_job_retry_cache(self, geocode):
+        geolocation.address_cache.clear()
+        geolocation.address_error_cache.clear()
+        geocode.side_effect = errors.AddressNotFoundError()
+        self.famille.city = "Paris"
+        self.famille.save()
+        job = models.GeolocationJob.enqueue(self.famille)
+        job.run()
+        self.assertEqual(geocode.call_count, 1)
+
+        # the retry calls the geocoder despite the cached error
+        geocode.side_effect = None
+        geocode.return_value = 48.895603, 2.322858
+        models.GeolocationJob.objects.filter(pk=job.pk).update(run_at=datetime.now(utc))
+        self.assertEqual(models.GeolocationJob.run_pending(), 1)
+        self.assertEqual(geocode.call_count, 2)
+        self.assertTrue(models.Famille.objects.get(pk=self.famille.pk).is_geolocated)
+        self.assertFalse(models.GeolocationJob.objects.exists())
+        self.assertEqual(geolocation.geolocate(self.famille.get_address()), (48.895603, 2.322858))
+
+    @patch("famille.models.users.UserInfo.schedule_geolocation")
     def test_manage_geolocation(self, mock):
         self.famille.country = "France"  # not enough
         self.famille.save()
@@ -168,6 +234,38 @@ class ModelsTestCase(TestCase):
         self.assertIsInstance(favs["Famille"][0], models.Famille)
         self.assertEqual(favs["Famille"][0].description, self.famille.description)
 
+    def test_get_favorites_data_batched(self):
+        presta2 = models.Prestataire(user=self.user3, email="c@gmail.com")
+        presta2.save()
+        self.famille.add_favorite("/api/v1/prestataires/%s" % presta2.pk)
+        FamilleFavorite(famille=self.famille, object_id=self.famille.pk, object_type="Famille").save()
+        # a deleted user is ignored
+        FamilleFavorite(famille=self.famille, object_id=9999, object_type="Famille").save()
+
+        with self.assertNumQueries(3):
+            favs = self.famille.get_favorites_data()
+        self.assertEqual(favs["Prestataire"], [self.presta, presta2])
+        self.assertEqual(favs["Famille"], [self.famille])
+
+    def test_get_favorite_keys(self):
+        self.assertEqual(self.famille.get_favorite_keys(), set([("Prestataire", self.presta.pk)]))
+        self.assertEqual(self.presta.get_favorite_keys(), set([("Famille", self.famille.pk)]))
+        self.famille.remove_favorite("/api/v1/prestataires/%s" % self.presta.pk)
+        self.assertEqual(self.famille.get_favorite_keys(), set())
+
+    def test_get_favorites_count(self):
+        self.assertEqual(self.famille.get_favorites_count(), 1)
+        # a query to the shared cache instead of the count
+        with self.assertNumQueries(1):
+            self.assertEqual(self.famille.get_favorites_count(), 1)
+        self.assertEqual(cache.get(self.famille.favorites_count_cache_key), 1)
+
+        self.famille.add_favorite("/api/v1/familles/%s" % self.famille.pk)
+        self.assertIsNone(cache.get(self.famille.favorites_count_cache_key))
+        self.assertEqual(self.famille.get_favorites_count(), 2)
+        self.famille.remove_favorite("/api/v1/prestataires/%s" % self.presta.pk)
+        self.assertEqual(self.famille.get_favorites_count(), 1)
+
     def test_get_resource_uri(self):
         out = "/api/v1/familles/%s" % self.famille.pk
         self.assertEqual(self.famille.get_resource_uri(), out)
@@ -303,6 +401,15 @@ class ModelsTestCase(TestCase):
         expected = [self.famille, self.presta]
         self.assertEquals(UserInfo.decode_users(data), expected)
 
+    def test_decode_users_batched(self):
+        user = User.objects.create_user("d", "d@gmail.com", "d")
+        famille = models.Famille.objects.create(user=user, email=user.email)
+        data = "---".join([self.famille.encoded, self.presta.encoded, famille.encoded, self.famille.encoded])
+        with self.assertNumQueries(2):
+            users = UserInfo.decode_users(data)
+            self.assertEqual([u.user.username for u in users], ["a", "b", "d", "a"])
+        self.assertEqual(users, [self.famille, self.presta, famille, self.famille])
+
     def test_decode_users_notok(self):
         data = base64.urlsafe_b64encode(json.dumps({"type": "Prestataire", "pk": 118926}))
         self.assertRaises(ValueError, UserInfo.decode_users, data)
@@ -310,6 +417,9 @@ class ModelsTestCase(TestCase):
         data = "eaziouehazoenuazehazpoieybazioueh"
         self.assertRaises(ValueError, UserInfo.decode_users, data)
 
+        data = base64.urlsafe_b64encode(json.dumps({"type": "Famille", "pk": "a"}))
+        self.assertRaises(ValueError, UserInfo.decode_users, data)
+
     @patch("django.core.mail.EmailMessage.send")
     def test_check_plan_expiration_basic(self, send):
         self.famille.plan = "basic"
@@ -354,11 +464,80 @@ class ModelsTestCase(TestCase):
 
     def test_visibility_score_empty(self):
         p = models.Prestataire()
-        self.assertEquals(p.visibility_score, 0)
+        self.assertEquals(p.compute_visibility_score(), 0)
 
     def test_visibility_score_not_empty(self):
         p = models.Prestataire(type="baby", name="To", first_name="Tou", street="Rue des Moines", city="Paris")
-        self.assertEquals(p.visibility_score, 0.625)
+        self.assertEquals(p.compute_visibility_score(), 0.625)
+
+    def test_get_badges(self):
+        p = models.Prestataire(type_garde="1,10", diploma="2", menage=True)
+        self.assertEqual(p.get_badges(), (1 << 1) | (1 << 5) | (1 << 11))
+        self.assertEqual(models.Prestataire().get_badges(), 0)
+
+    def test_get_tarif_range(self):
+        self.assertEqual(models.Prestataire(tarif="3,20").get_tarif_range(), [3, 20])
+        self.assertIsNone(models.Prestataire(tarif="").get_tarif_range())
+
+    def test_save_tarif_range(self):
+        self.presta.tarif = "5,12"
+        self.presta.save()
+        presta = models.Prestataire.objects.get(pk=self.presta.pk)
+        self.assertEqual((presta.tarif_min, presta.tarif_max), (5, 12))
+
+        self.presta.tarif = ""
+        self.presta.save()
+        presta = models.Prestataire.objects.get(pk=self.presta.pk)
+        self.assertEqual((presta.tarif_min, presta.tarif_max), (None, None))
+
+    def test_get_search_text(self):
+        self.presta.nationality = u"Française"
+        self.assertEqual(self.presta.get_search_text(), u"une description\nfrancaise")
+        self.presta.save()
+        models.Reference.objects.create(prestataire=self.presta, missions=u"Aide aux DEVOIRS")
+        presta = models.Prestataire.objects.get(pk=self.presta.pk)
+        self.assertEqual(presta.search_text, u"une description\nfrancaise\naide aux devoirs")
+
+        self.famille.description = None
+        self.famille.save()
+        enfant = models.Enfant.objects.create(famille=self.famille, e_name="Toto", e_school=u"École Jaurès")
+        self.assertEqual(models.Famille.objects.get(pk=self.famille.pk).search_text, u"ecole jaures")
+        enfant.delete()
+        self.assertEqual(models.Famille.objects.get(pk=self.famille.pk).search_text, u"")
+
+    def test_get_birthday_lookups(self):
+        today = date(2015, 3, 10)
+        self.assertEqual(models.Prestataire.get_birthday_lookups("16-", today), {"birthday__gt": date(1999, 3, 10)})
+        self.assertEqual(models.Prestataire.get_birthday_lookups("18+", today), {"birthday__lte": date(1997, 3, 10)})
+        self.assertIsNone(models.Prestataire.get_birthday_lookups("20+", today))
+
+    def test_sync_criteria(self):
+        self.presta.language = "1,10"
+        self.presta.type_garde = "2"
+        self.presta.save()
+        self.assertEqual(
+            set(self.presta.criteria.values_list("name", "value")),
+            set([("language", "1"), ("language", "10"), ("type_garde", "2")])
+        )
+
+        self.presta.language = "10,12"
+        self.presta.type_garde = None
+        self.presta.save()
+        self.assertEqual(
+            set(self.presta.criteria.values_list("name", "value")),
+            set([("language", "10"), ("language", "12")])
+        )
+
+    def test_visibility_score_saved(self):
+        self.presta.name = "To"
+        self.presta.city = "Paris"
+        self.presta.save()
+        self.assertEquals(models.Prestataire.objects.get(pk=self.presta.pk).visibility_score, 0.25)
+
+        with patch.object(models.Prestataire, "MIN_VISIBILITY_SCORE", 0.3):
+            self.assertFalse(models.Prestataire.filter_visible(models.Prestataire.objects.all()).exists())
+        with patch.object(models.Prestataire, "MIN_VISIBILITY_SCORE", 0.25):
+            self.assertTrue(models.Prestataire.filter_visible(models.Prestataire.objects.all()).exists())
 
     def test_visibility_score_is_enough_zero(self):
         p = models.Prestataire()
@@ -383,6 +562,10 @@ class GeolocationTestCase(TestCase):
 
     def setUp(self):
         self.geoloc = models.Geolocation()
+        users.postal_code_cache.clear()
+
+    def tearDown(self):
+        models.PostalCode.objects.all().delete()
 
     @patch("famille.utils.geolocation.geolocate")
     def test_from_postal_code(self, mock_geo):
@@ -394,7 +577,40 @@ class GeolocationTestCase(TestCase):
         self.assertFalse(g.has_error)
 
         mock_geo.side_effect = errors.GeolocationError()
-        self.assertRaises(errors.GeolocationError, models.Geolocation.from_postal_code, "75001")
+        self.assertRaises(errors.GeolocationError, models.Geolocation.from_postal_code, "75002")
+
+    @patch("famille.utils.geolocation.geolocate")
+    def test_from_postal_code_cache(self, mock_geo):
+        mock_geo.return_value = 12.1, 13.2
+        models.Geolocation.from_postal_code("75001")
+        models.Geolocation.from_postal_code(" 75001 ")
+        self.assertEqual(mock_geo.call_count, 1)
+        self.assertEqual(models.PostalCode.objects.get(code="75001").lat, 12.1)
+
+        # not in memory anymore, but in database
+        users.postal_code_cache.clear()
+        g = models.Geolocation.from_postal_code("75001")
+        self.assertEqual(mock_geo.call_count, 1)
+        self.assertEqual(g.lon, 13.2)
+        stats = models.Geolocation.postal_code_cache_stats()
+        self.assertEqual(stats["memory"]["misses"], 1)
+        self.assertGreaterEqual(stats["database"]["hits"], 1)
+
+    @patch("famille.models.users.logger")
+    @patch("famille.utils.geolocation.geolocate")
+    def test_postal_code_cache_stats_logged(self, mock_geo, logger):
+        mock_geo.return_value = 12.1, 13.2
+        stats = users.postal_code_cache.stats
+        interval = 3 - (stats.hits + stats.misses) % 3
+        with self.settings(POSTAL_CODE_CACHE_STATS_INTERVAL=3):
+            for _ in range(interval):
+                models.Geolocation.from_postal_code("75001")
+        logger.info.assert_called_once_with("Postal code caches: %s", models.Geolocation.postal_code_cache_stats())
+
+        logger.reset_mock()
+        with self.settings(POSTAL_CODE_CACHE_STATS_INTERVAL=0):
+            models.Geolocation.from_postal_code("75001")
+        self.assertFalse(logger.info.called)
 
     @patch("famille.utils.geolocation.geolocate")
     def test_geolocate(self, mock_geo):
@@ -411,6 +627,16 @@ class GeolocationTestCase(TestCase):
         self.assertIsNone(self.geoloc.lon)
         self.assertTrue(self.geoloc.has_error)
 
+    @patch("famille.utils.geolocation.geolocate")
+    def test_geolocate_cell(self, mock_geo):
+        mock_geo.return_value = 48.895603, 2.322858
+        self.geoloc.geolocate("an address")
+        self.assertEqual(self.geoloc.cell, "488:23")
+
+        mock_geo.side_effect = errors.GeolocationError()
+        self.geoloc.geolocate("an address")
+        self.assertIsNone(self.geoloc.cell)
+
 
 class RatingTestCase(TestCase):
 
@@ -458,6 +684,50 @@ class RatingTestCase(TestCase):
         ).save()
         self.assertEqual(self.famille.total_rating, 2.375)
 
+    def test_user_rating_update_delete(self):
+        rating = models.FamilleRatings(user=self.famille, a=4, b=4, c=4, d=4)
+        rating.save()
+        models.FamilleRatings(user=self.famille, a=2, b=2, c=2, d=2).save()
+        self.assertEqual(self.famille.total_rating, 3)
+
+        rating.a = rating.b = rating.c = rating.d = 5
+        rating.save()
+        self.assertEqual(self.famille.total_rating, 3.5)
+        self.assertEqual(models.Famille.objects.get(pk=self.famille.pk).total_rating, 3.5)
+
+        rating.delete()
+        self.assertEqual(self.famille.nb_ratings, 1)
+        self.assertEqual(self.famille.total_rating, 2)
+        famille = models.Famille.objects.get(pk=self.famille.pk)
+        self.assertEqual((famille.rating_sum, famille.rating_count, famille.rating_avg), (2, 1, 2))
+
+    def test_user_save_keeps_ratings(self):
+        famille = models.Famille.objects.get(pk=self.famille.pk)
+        models.FamilleRatings(user=self.famille, a=4, b=4, c=4, d=4).save()
+        famille.name = "Toto"
+        famille.save()
+        famille = models.Famille.objects.get(pk=self.famille.pk)
+        self.assertEqual(famille.name, "Toto")
+        self.assertEqual(famille.nb_ratings, 1)
+
+    def test_user_save_explicit_pk(self):
+        user = User.objects.create_user("c", "c@gmail.com", "c")
+        famille = models.Famille(pk=self.famille.pk + 100, user=user, email="c@gmail.com", rating_count=2)
+        famille.save()
+        famille = models.Famille.objects.get(pk=self.famille.pk + 100)
+        self.assertEqual(famille.email, "c@gmail.com")
+        self.assertEqual(famille.rating_count, 2)
+
+    def test_rebuild_user_ratings(self):
+        models.FamilleRatings(user=self.famille, a=4, b=2, c=1, d=3).save()
+        models.FamilleRatings(user=self.famille, a=1, b=3, c=0, d=5).save()
+        models.Famille.objects.update(rating_sum=0, rating_count=0, rating_avg=0)
+
+        self.assertEqual(models.FamilleRatings.rebuild_user_ratings(), 1)
+        famille = models.Famille.objects.get(pk=self.famille.pk)
+        self.assertEqual(famille.nb_ratings, 2)
+        self.assertEqual(famille.total_rating, 2.375)
+
     def test_user_has_voted_for(self):
         models.FamilleRatings(user=self.famille, by="??").save()
         self.assertFalse(models.FamilleRatings.user_has_voted_for(self.presta, self.famille))
@@ -566,6 +836,40 @@ class PlanningTestCase(TestCase):
         expected = u"Les Lundi (le matin, le soir), ponctuellement à partir du 12/07/1991"
         self.assertEqual(self.planning.display, expected)
 
+    def test_availability_mask(self):
+        self.assertEqual(planning.availability_mask([1], [1, 3]), 0b101)
+        self.assertEqual(planning.availability_mask([2], [1]), 1 << 10)
+        self.assertEqual(planning.availability_mask([1, 7]), (2 ** 10 - 1) | ((2 ** 10 - 1) << 60))
+        self.assertEqual(planning.availability_mask(), 2 ** 70 - 1)
+        self.assertEqual(planning.availability_mask([8], ["2"]), 0)
+
+    def test_get_availability(self):
+        self.planning.weekday.clear()
+        self.assertEqual(self.planning.get_availability(), 0)
+        self.planning.weekday.add(2)
+        self.planning.schedule.clear()
+        self.planning.schedule.add(4)
+        self.assertEqual(self.planning.get_availability(), planning.availability_mask([2], [4]))
+        self.planning.schedule.clear()
+        self.assertEqual(self.planning.get_availability(), planning.availability_mask([2]))
+
+    def test_update_availability(self):
+        self.planning.weekday.clear()
+        self.planning.weekday.add(7)
+        self.planning.schedule.clear()
+        self.planning.schedule.add(10)
+        other = planning.FamillePlanning.objects.create(famille=self.famille)
+        other.weekday.add(1)
+        other.schedule.add(2)
+        self.famille.update_availability()
+
+        expected = planning.availability_mask([7], [10]) | planning.availability_mask([1], [2])
+        self.assertEqual(self.famille.availability, expected)
+        famille = models.Famille.objects.get(pk=self.famille.pk)
+        self.assertEqual(famille.availability, expected)
+        self.assertEqual(famille.availability_0, 2)
+        self.assertEqual(famille.availability_1, 1 << 6)
+
 
 class ReferenceTestCase(TestCase):
 
@@ -1,8 +1,16 @@
+# -*- coding=utf-8 -*-
+from datetime import date, datetime, timedelta
+import json
+
+from django.conf import settings
 from django.contrib.auth.models import User, AnonymousUser
+from django.core.cache import cache
+from django.http import QueryDict
 from django.test import TestCase
-from mock import Mock, MagicMock
+from mock import Mock, MagicMock, patch
 
 from famille import resources, models
+from famille.utils.index import CriteriaIndex
 
 
 class ResourcesTestCase(TestCase):
@@ -48,4 +56,398 @@ class ResourcesTestCase(TestCase):
         self.famille.save()
         bundle = Mock(spec=["data", "request"], data=self.data, request=request)
         output = self.famille_resource.dehydrate(bundle)
-        self.assertEqual(output.data, self.data)
\ No newline at end of file
+        self.assertEqual(output.data, self.data)
+
+    def test_filter_distance(self):
+        user2 = User.objects.create_user("b", "b@gmail.com", "b")
+        close = models.Geolocation(lat=48.883588, lon=2.327195)  # place de clichy
+        close.save()
+        far = models.Geolocation(lat=43.296482, lon=5.36978)  # marseille
+        far.save()
+        self.famille.geolocation = close
+        self.famille.save()
+        other = models.Famille(user=user2, email="b@gmail.com", geolocation=far)
+        other.save()
+
+        origin = models.Geolocation(lat=48.895603, lon=2.322858)  # 32 rue des epinettes
+        qs = models.Famille.objects.all()
+        self.assertEqual(list(self.famille_resource.filter_distance(1.4, origin, qs)), [self.famille])
+        self.assertEqual(list(self.famille_resource.filter_distance(1.3, origin, qs)), [])
+        self.assertEqual(
+            set(self.famille_resource.filter_distance(700, origin, qs)),
+            set([self.famille, other])
+        )
+        self.assertEqual(list(models.Famille.ids_located_within(origin, 1.4)), [self.famille.pk])
+
+    def test_apply_sorting_rating(self):
+        users = []
+        for i in range(3):
+            user = User.objects.create_user("user%s" % i, "user%s@gmail.com" % i, "p")
+            users.append(models.Famille(user=user, email=user.email))
+            users[-1].save()
+        models.FamilleRatings(user=users[0], a=2, b=2, c=2, d=2).save()
+        models.FamilleRatings(user=users[2], a=4, b=4, c=4, d=4).save()
+
+        qs = self.famille_resource.apply_sorting(models.Famille.objects.all(), {"order_by": "-rating"})
+        self.assertEqual(list(qs.values_list("pk", flat=True)), [
+            users[2].pk, users[0].pk, users[1].pk, self.famille.pk
+        ])
+
+    def test_filter_age(self):
+        resource = resources.PrestataireResource()
+        prestas = []
+        for i, years in enumerate((15, 17, 30)):
+            user = User.objects.create_user("age%s" % i, "age%s@gmail.com" % i, "p")
+            birthday = date.today() - timedelta(days=365 * years + 10)
+            prestas.append(models.Prestataire.objects.create(user=user, email=user.email, birthday=birthday))
+        qs = models.Prestataire.objects.order_by("pk")
+        self.assertEqual(list(resource.filter_age("16-", qs)), prestas[:1])
+        self.assertEqual(list(resource.filter_age("18-", qs)), prestas[:2])
+        self.assertEqual(list(resource.filter_age("18+", qs)), prestas[2:])
+        self.assertEqual(list(resource.filter_age("toto", qs)), prestas)
+        self.assertEqual(prestas[2].age, 30)
+
+    def test_filter_tarif(self):
+        self.famille.tarif = "10,15"
+        self.famille.save()
+        qs = models.Famille.objects.all()
+        self.assertEqual(list(self.famille_resource.filter_tarif(["3", "10"], qs)), [self.famille])
+        self.assertEqual(list(self.famille_resource.filter_tarif("12,20", qs)), [self.famille])
+        self.assertEqual(list(self.famille_resource.filter_tarif(["3", "9"], qs)), [])
+        self.assertEqual(list(self.famille_resource.filter_tarif(["3", "a"], qs)), [self.famille])
+
+    def test_pop_availability_filters(self):
+        filters = {"planning__weekday__id__in": ["1", "7"], "planning__schedule__in": ["2"], "city__iexact": "Paris"}
+        mask = self.famille_resource.pop_availability_filters(filters)
+        self.assertEqual(mask, models.availability_mask([1, 7], [2]))
+        self.assertEqual(filters, {"city__iexact": "Paris"})
+        self.assertIsNone(self.famille_resource.pop_availability_filters(filters))
+
+        filters = {"planning__weekday__in": ["a"]}
+        self.assertIsNone(self.famille_resource.pop_availability_filters(filters))
+        self.assertEqual(filters, {"planning__weekday__in": ["a"]})
+
+    def test_filter_available(self):
+        user2 = User.objects.create_user("b", "b@gmail.com", "b")
+        other = models.Famille.objects.create(user=user2, email="b@gmail.com")
+        self.famille.availability = models.availability_mask([1], [2])
+        self.famille.save()
+        other.availability = models.availability_mask([7], [10])
+        other.save()
+
+        qs = models.Famille.objects.order_by("pk")
+        filter_available = models.Famille.filter_available
+        self.assertEqual(list(filter_available(qs, models.availability_mask([1]))), [self.famille])
+        self.assertEqual(list(filter_available(qs, models.availability_mask([7], [9, 10]))), [other])
+        self.assertEqual(list(filter_available(qs, models.availability_mask([1, 7]))), [self.famille, other])
+        self.assertEqual(list(filter_available(qs, models.availability_mask([1], [3]))), [])
+        self.assertEqual(list(filter_available(qs, 0)), [])
+
+    def test_filter_commaseparated_field(self):
+        user2 = User.objects.create_user("b", "b@gmail.com", "b")
+        other = models.Famille(user=user2, email="b@gmail.com", language="10,12", diploma="1")
+        other.save()
+        self.famille.language = "1,2"
+        self.famille.save()
+
+        qs = models.Famille.objects.all()
+        filter_field = self.famille_resource._filter_commaseparated_field
+        self.assertEqual(list(filter_field("language", ["1"], qs)), [self.famille])
+        self.assertEqual(set(filter_field("language", ["2", "12"], qs)), set([self.famille, other]))
+        self.assertEqual(list(filter_field("diploma", ["2"], qs)), [])
+
+    def test_filter_criteria_index(self):
+        resource = resources.PrestataireResource()
+        user2 = User.objects.create_user("b", "b@gmail.com", "b")
+        presta = models.Prestataire(user=user2, email="b@gmail.com", type="baby", menage=True)
+        presta.save()
+        filters = {"type__in": ["baby", "nounou"], "menage__exact": True, "city__iexact": "Paris"}
+
+        self.assertIsNone(resource.filter_criteria_index(filters))
+        with patch.object(resource, "criteria_index", CriteriaIndex(models.Prestataire, ["type", "menage"])):
+            self.assertEqual(resource.filter_criteria_index(filters), [presta.pk])
+            # left to the database too
+            self.assertEqual(len(filters), 3)
+
+            # the values of the search form
+            self.assertEqual(resource.filter_criteria_index({"menage__exact": "on"}), [presta.pk])
+            self.assertEqual(resource.filter_criteria_index({"menage__exact": "0"}), [])
+
+            filters = {"menage__exact": False}
+            with patch.dict("django.conf.settings.CRITERIA_INDEX", max_ids=0):
+                self.assertEqual(resource.filter_criteria_index({"menage__exact": True}), None)
+            self.assertEqual(resource.filter_criteria_index(filters), [])
+
+    def test_search_criteria_index(self):
+        user2 = User.objects.create_user("b", "b@gmail.com", "b")
+        presta = models.Prestataire(user=user2, email="b@gmail.com", plan="premium", type="baby", menage=True)
+        presta.save()
+        index = CriteriaIndex(models.Prestataire, resources.PrestataireResource.INDEXED_FIELDS)
+        with patch.object(resources.PrestataireResource, "criteria_index", index):
+            response = self.client.get("/api/v1/prestataires/", {"menage__exact": "on", "type__in": "baby"})
+            objects = json.loads(response.content)["objects"]
+            self.assertEqual([o["resource_uri"] for o in objects], ["/api/v1/prestataires/%s/" % presta.pk])
+
+            # stale index, the database filters the results too
+            index.build()
+            models.Prestataire.objects.filter(pk=presta.pk).update(menage=False)
+            response = self.client.get("/api/v1/prestataires/", {"menage__exact": "on"})
+            self.assertEqual(json.loads(response.content)["objects"], [])
+
+    def _create_prestataires(self):
+        prestas = []
+        for i, (type, menage, tarif, language) in enumerate([
+            ("baby", True, "3,6", "1,10"), ("nounou", True, "10,15", "10"), ("baby", False, "15,20", "")
+        ]):
+            user = User.objects.create_user("p%s" % i, "p%s@gmail.com" % i, "p")
+            presta = models.Prestataire(
+                user=user, email=user.email, type=type, menage=menage,
+                tarif=tarif, language=language, plan="premium"
+            )
+            presta.save()
+            prestas.append(presta)
+        return prestas
+
+    def test_compute_facets(self):
+        self._create_prestataires()
+        resource = resources.PrestataireResource()
+        facets = resource.compute_facets(models.Prestataire.objects.all())
+        self.assertEqual(facets["type"], {"baby": 2, "nounou": 1})
+        self.assertEqual(facets["menage"], 2)
+        self.assertEqual(facets["permis"], 0)
+        self.assertEqual(facets["language"], {"1": 1, "10": 2})
+        self.assertEqual(facets["tarif"], {"3-5": 1, "6-8": 1, "9-11": 1, "12-14": 1, "15-20": 2})
+
+        facets = resource.compute_facets(models.Prestataire.objects.filter(menage=True))
+        self.assertEqual(facets["type"], {"baby": 1, "nounou": 1})
+
+        with patch.object(resource, "criteria_index", CriteriaIndex(models.Prestataire, resource.INDEXED_FIELDS)):
+            self.assertEqual(resource.compute_facets(models.Prestataire.objects.filter(menage=True)), facets)
+
+    def test_get_facets(self):
+        cache.clear()
+        self._create_prestataires()
+        response = self.client.get("/api/v1/prestataires/facets/", {"type__in": "baby"})
+        self.assertEqual(response.status_code, 200)
+        facets = json.loads(response.content)
+        self.assertEqual(facets["type"], {"baby": 2})
+        self.assertEqual(facets["menage"], 1)
+
+        # cached
+        models.Prestataire.objects.filter(type="baby").update(menage=True)
+        facets = json.loads(self.client.get("/api/v1/prestataires/facets/", {"type__in": "baby", "limit": 5}).content)
+        self.assertEqual(facets["menage"], 1)
+
+        # in the shared cache, until the timeout
+        request = Mock(GET=QueryDict("type__in=baby"), user=AnonymousUser())
+        cache_key = resources.PrestataireResource().get_facets_cache_key(request)
+        self.assertEqual(cache.get(cache_key)["menage"], 1)
+        cache.delete(cache_key)
+        facets = json.loads(self.client.get("/api/v1/prestataires/facets/", {"type__in": "baby"}).content)
+        self.assertEqual(facets["menage"], 2)
+
+    def _create_search_results(self, nb_results):
+        weekday = models.Weekday.objects.create(name="Lundi")
+        schedule = models.Schedule.objects.create(name="Matin")
+        for i in range(nb_results):
+            user = User.objects.create_user("q%s" % i, "q%s@gmail.com" % i, "p")
+            presta = models.Prestataire(user=user, email=user.email, plan="premium")
+            presta.save()
+            planning = models.PrestatairePlanning.objects.create(prestataire=presta)
+            planning.weekday.add(weekday)
+            planning.schedule.add(schedule)
+
+    def test_search_queries_anonymous(self):
+        self._create_search_results(3)
+        # count, results, plannings, weekdays, schedules, card versions
+        with self.assertNumQueries(6):
+            response = self.client.get("/api/v1/prestataires/")
+        self.assertEqual(len(json.loads(response.content)["objects"]), 3)
+
+    def test_search_queries_premium(self):
+        self._create_search_results(3)
+        self.famille.plan = "premium"
+        self.famille.plan_expires_at = datetime(2500, 1, 1)
+        self.famille.save()
+        self.client.login(username="a", password="a")
+        # + session, user, famille and ratings given by the famille
+        with self.assertNumQueries(10):
+            response = self.client.get("/api/v1/prestataires/")
+        self.assertEqual(len(json.loads(response.content)["objects"]), 3)
+
+    def _get_pages(self, url, params, link):
+        pages = []
+        while url:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.content)
+            pages.append([int(o["resource_uri"].split("/")[-2]) for o in data["objects"]])
+            url, params = data["meta"][link], {}
+        return pages
+
+    def test_cursor_pagination(self):
+        self._create_search_results(5)
+        models.Prestataire.objects.filter(user__username="q3").update(rating_avg=4)
+        models.Prestataire.objects.filter(user__username="q1").update(rating_avg=2)
+        expected = list(models.Prestataire.objects.order_by("-rating_avg", "-updated_at", "-id").values_list("pk", flat=True))
+
+        pages = self._get_pages("/api/v1/prestataires/", {"limit": 2, "order_by": "-rating"}, "next")
+        self.assertEqual(pages, [expected[:2], expected[2:4], expected[4:]])
+
+        response = self.client.get("/api/v1/prestataires/", {"limit": 2, "order_by": "-rating", "offset": 2})
+        next_url = json.loads(response.content)["meta"]["next"]
+        self.assertIn("cursor=", next_url)
+        self.assertNotIn("offset=", next_url)
+        last_page = json.loads(self.client.get(next_url).content)
+        self.assertEqual(len(last_page["objects"]), 1)
+        self.assertIsNone(last_page["meta"]["next"])
+
+        pages = self._get_pages(last_page["meta"]["previous"], {}, "previous")
+        self.assertEqual(pages, [expected[2:4], expected[:2]])
+
+    def test_order_by_match(self):
+        self._create_search_results(4)
+        models.Prestataire.objects.filter(user__username="q2").update(rating_avg=5)
+        models.Prestataire.objects.filter(user__username="q0").update(menage=True, rating_avg=1)
+        q0, q2 = [models.Prestataire.objects.get(user__username=name).pk for name in ("q0", "q2")]
+
+        pages = self._get_pages("/api/v1/prestataires/", {"limit": 2, "order_by": "-match"}, "next")
+        self.assertEqual(pages[0][0], q2)
+        self.assertEqual(len(sum(pages, [])), 4)
+
+        self.famille.menage = True
+        self.famille.save()
+        self.client.login(username="a", password="a")
+        response = self.client.get("/api/v1/prestataires/", {"limit": 1, "order_by": "-match", "format": "compact"})
+        data = json.loads(response.content)
+        self.assertEqual([o["id"] for o in data["objects"]], [q0])
+        self.assertEqual(data["meta"]["total_count"], 4)
+        self.assertIn("offset=1", data["meta"]["next"])
+
+    def test_fulltext_search(self):
+        self._create_search_results(4)
+        descriptions = {"q0": u"Étudiante", "q1": u"J'aime les enfants", "q2": u"Enfants, enfants, enfants"}
+        for username, description in descriptions.iteritems():
+            presta = models.Prestataire.objects.get(user__username=username)
+            presta.description = description
+            presta.save()
+        q0, q1, q2 = [models.Prestataire.objects.get(user__username=name).pk for name in ("q0", "q1", "q2")]
+
+        self.assertEqual(self._get_pages("/api/v1/prestataires/", {"q": "enfant"}, "next"), [[q2, q1]])
+        self.assertEqual(self._get_pages("/api/v1/prestataires/", {"q": "etudiantes"}, "next"), [[q0]])
+        self.assertEqual(self._get_pages("/api/v1/prestataires/", {"q": "toto"}, "next"), [[]])
+        pages = self._get_pages("/api/v1/prestataires/", {"q": "enfants", "order_by": "-updated_at", "limit": 1}, "next")
+        self.assertEqual(sorted(sum(pages, [])), sorted([q1, q2]))
+
+        response = self.client.get("/api/v1/prestataires/facets/", {"q": "enfant"})
+        self.assertEqual(json.loads(response.content)["language"], {})
+
+    def test_fulltext_search_many_results(self):
+        nb_users = 400  # more than 999 / 3
+        User.objects.bulk_create([User(username="f%s" % i) for i in range(nb_users)])
+        models.Prestataire.objects.bulk_create([
+            models.Prestataire(
+                user=user, email="%s@gmail.com" % user.username, plan="premium",
+                search_text=u"nounou " + u"enfants " * (i % 10 + 1)
+            )
+            for i, user in enumerate(User.objects.filter(username__startswith="f"))
+        ])
+        resource = resources.PrestataireResource()
+        resource.fulltext_index.build()
+        # rebuilt lazily once the users are rolled back
+        self.addCleanup(setattr, resource.fulltext_index, "_postings", None)
+
+        queryset = resource.filter_fulltext("enfants", models.Prestataire.objects.all())
+        _, params = queryset.query.sql_with_params()
+        self.assertLessEqual(len(params), resources.MAX_SQL_VARIABLES)
+        results = list(queryset)
+        self.assertEqual(len(results), settings.SEARCH_FULLTEXT["max_results"])
+        # the best ranked
+        count = lambda text: text.count("enfants")
+        others = models.Prestataire.objects.exclude(pk__in=[r.pk for r in results]).values_list("search_text", flat=True)
+        self.assertGreaterEqual(min(count(r.search_text) for r in results), max(count(text) for text in others))
+
+        response = self.client.get("/api/v1/prestataires/", {"q": "nounou", "menage__exact": "on", "limit": 5})
+        self.assertEqual(response.status_code, 200)
+
+    def test_cursor_pagination_invalid(self):
+        self._create_search_results(1)
+        response = self.client.get("/api/v1/prestataires/", {"cursor": "toto"})
+        self.assertEqual(response.status_code, 400)
+        cursor = resources.CursorPaginator({}, None).get_cursor(
+            [("-rating_avg", models.Prestataire._meta.get_field("rating_avg"), True)], models.Prestataire()
+        )
+        response = self.client.get("/api/v1/prestataires/", {"cursor": cursor})
+        self.assertEqual(response.status_code, 400)
+
+    def test_stream_list(self):
+        self._create_search_results(5)
+        expected = json.loads(self.client.get("/api/v1/prestataires/", {"limit": 0}).content)
+        with patch.dict(settings.SEARCH_STREAMING, chunk_size=2):
+            response = self.client.get("/api/v1/prestataires/", {"stream": "true"})
+        self.assertTrue(response.streaming)
+        data = json.loads("".join(response.streaming_content))
+        self.assertEqual(data["objects"], expected["objects"])
+        self.assertEqual(data["meta"]["total_count"], 5)
+        self.assertEqual(set(data["objects"][0].keys()), set(resources.PrestataireResource.FIELD_ACCESS_NOT_LOGGED))
+
+        response = self.client.get("/api/v1/prestataires/", {"stream": "true", "limit": 2, "offset": 1})
+        data = json.loads("".join(response.streaming_content))
+        self.assertEqual(data["objects"], expected["objects"][1:3])
+
+    def test_compact_format(self):
+        self._create_search_results(2)
+        models.Prestataire.objects.filter(user__username="q0").update(menage=True, language="0")
+        # results, plannings are not prefetched
+        with self.assertNumQueries(2):
+            response = self.client.get("/api/v1/prestataires/", {"format": "compact", "order_by": "-rating"})
+        self.assertEqual(response["Content-Type"], "application/json")
+        objects = json.loads(response.content)["objects"]
+        presta = models.Prestataire.objects.get(user__username="q0")
+        compact = [o for o in objects if o["id"] == presta.pk][0]
+        self.assertNotIn("template", compact)
+        self.assertEqual(compact["resource_uri"], "/api/v1/prestataires/%s/" % presta.pk)
+        self.assertEqual(compact["badges"], presta.get_badges())
+        self.assertEqual(compact["languages"], [["0", "Anglais"]])
+        self.assertEqual(compact["tarif"], presta.get_tarif_range())
+        self.assertIsNone(compact["profile_pic"])
+
+        response = self.client.get("/api/v1/familles/", {"format": "compact"})
+        self.assertEqual(json.loads(response.content)["objects"], [])
+
+    def test_dehydrate_template_cache(self):
+        resources.local_cache.clear()
+        resource = resources.FamilleResource()
+        bundle = Mock(obj=self.famille, request=MagicMock(user=AnonymousUser()))
+        stats = resources.SearchResource.card_cache_stats
+        hits, misses = stats.hits, stats.misses
+
+        card = resource.dehydrate_template(bundle)
+        self.assertEqual(resource.dehydrate_template(bundle), card)
+        self.assertEqual((stats.hits - hits, stats.misses - misses), (1, 1))
+
+        models.Enfant(famille=self.famille, e_name="Toto").save()
+        self.assertNotEqual(resource.dehydrate_template(bundle), card)
+        self.assertEqual((stats.hits - hits, stats.misses - misses), (1, 2))
+
+        planning = models.FamillePlanning.objects.create(famille=self.famille)
+        resource.dehydrate_template(bundle)
+        planning.weekday.add(models.Weekday.objects.create(name="Lundi"))
+        resource.dehydrate_template(bundle)
+        self.assertEqual((stats.hits - hits, stats.misses - misses), (1, 4))
+
+    def test_get_card_cache_key(self):
+        self.famille.plan = "premium"
+        self.famille.save()
+        anonymous = resources.FamilleResource().get_card_cache_key(self.famille, AnonymousUser())
+        premium = resources.FamilleResource().get_card_cache_key(self.famille, self.user1)
+        self.assertTrue(anonymous.endswith(":anonymous"))
+        self.assertTrue(premium.endswith(":premium-famille__%s" % self.famille.pk))
+        self.assertNotIn(" ", premium)  # valid memcached key
+
+        version = resources.get_card_version(models.Famille, self.famille.pk)
+        resources.bump_card_version(models.Famille, self.famille.pk)
+        self.assertGreater(resources.get_card_version(models.Famille, self.famille.pk), version)
+
+        models.FamilleRatings(user=self.famille, by="prestataire__1").save()
+        self.assertNotEqual(resources.FamilleResource().get_card_cache_key(self.famille, self.user1), premium)
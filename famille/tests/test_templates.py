@@ -1,3 +1,5 @@
+from django.contrib.auth.models import AnonymousUser
+from django.template.loader import render_to_string
 from django.test import TestCase
 
 from famille import models
@@ -16,6 +18,11 @@ class TemplateTagsTestCase(TestCase):
         obj = models.Famille()
         self.assertEqual(helpers.get_class_name(obj), "Famille")
 
+    def test_compact_result_template(self):
+        html = render_to_string("search/results/compact_prestataire.html", {"user": AnonymousUser()})
+        self.assertIn("<%- result.pseudo %>", html)
+        self.assertIn('<%- badge("experience_type", "1", "bebe") %>', html)
+
     def test_get_range(self):
         self.assertEqual(helpers.get_range(""), [])
         self.assertEqual(helpers.get_range("2"), [0, 1])
@@ -43,6 +50,20 @@ class TemplateTagsTestCase(TestCase):
         self.assertEquals(users.get_badge_icon_garde(obj, "1"), "img/badges/1.png")
         obj.type_garde = "1,3,6"
         self.assertEquals(users.get_badge_icon_garde(obj, "3"), "img/badges/3.png")
+        obj.type_garde = "10,11"
+        self.assertEquals(users.get_badge_icon_garde(obj, "1"), "img/badges/no-1.png")
+
+    def test_has_value(self):
+        self.assertFalse(users.has_value(None, "1"))
+        self.assertFalse(users.has_value("10,21", "1"))
+        self.assertTrue(users.has_value("10,1", "1"))
+        self.assertTrue(users.has_value("10,1", 10))
+
+    def test_is_favorite(self):
+        presta = models.Prestataire(pk=2)
+        self.assertFalse(users.is_favorite(presta, None))
+        self.assertFalse(users.is_favorite(presta, set([("Famille", 2)])))
+        self.assertTrue(users.is_favorite(presta, set([("Famille", 2), ("Prestataire", 2)])))
 
     def test_get_languages_html(self):
         self.assertEquals(users.get_languages_html(None), "")
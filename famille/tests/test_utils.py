@@ -1,10 +1,13 @@
+# -*- coding=utf-8 -*-
 import base64
 from datetime import date, datetime, timedelta
 import json
 
 from django.conf import settings
 from django.contrib.auth.models import User, AnonymousUser
+from django.core.cache import cache
 from django.core.signing import BadSignature
+from django.db.models.signals import post_save, post_delete
 from django.http import HttpResponseBadRequest, Http404
 from django.http.request import QueryDict, HttpRequest
 from django.test import TestCase
@@ -16,7 +19,8 @@ from postman.models import Message
 
 from famille import utils, models, errors
 from famille.models.users import Geolocation
-from famille.utils import geolocation, http, python, mail, payment, lookup
+from famille.utils import geolocation, http, python, mail, payment, lookup, index, matching, fulltext, cache as utils_cache
+from famille.utils.threading import RateLimiter
 
 
 __all__ = ["UtilsTestCase", "GeolocationTestCase", "PythonTestCase", "HTTPTestCase"]
@@ -47,8 +51,40 @@ class UtilsTestCase(TestCase):
         self.assertEqual(utils.get_overlap([1,2], [1,4]), 2)
         self.assertEqual(utils.get_overlap([1,4], [3,4]), 2)
 
+    @patch("famille.utils.threading.time")
+    def test_rate_limiter(self, time_mock):
+        time_mock.time.return_value = 100
+        limiter = RateLimiter(2)
+        limiter.wait()
+        self.assertFalse(time_mock.sleep.called)
+        limiter.wait()
+        time_mock.sleep.assert_called_with(0.5)
+        limiter.wait()
+        time_mock.sleep.assert_called_with(1.0)
+
+        limiter = RateLimiter(None)
+        time_mock.sleep.reset_mock()
+        limiter.wait()
+        limiter.wait()
+        self.assertFalse(time_mock.sleep.called)
+
+
+    def test_database_cache_get_many(self):
+        self.assertIsInstance(cache, utils_cache.DatabaseCache)
+        cache.set("a", 1)
+        cache.set("b", {"c": 2})
+        cache.set("expired", 3, -1)
+        self.assertEqual(cache.get_many([]), {})
+        with self.assertNumQueries(1):
+            self.assertEqual(cache.get_many(["a", "b", "expired", "missing"]), {"a": 1, "b": {"c": 2}})
+
+
 class GeolocationTestCase(TestCase):
 
+    def setUp(self):
+        geolocation.address_cache.clear()
+        geolocation.address_error_cache.clear()
+
     def test_geodistance(self):
         origin = Geolocation(lat=12.2, lon=1.0)
         to = origin
@@ -68,11 +104,56 @@ class GeolocationTestCase(TestCase):
         self.assertTrue(geolocation.is_close_enough(origin, to, 1.4))  # ~ 1.373 km
         self.assertFalse(geolocation.is_close_enough(origin, to, 1.3))  # ~ 1.373 km
 
+    def test_bounding_box(self):
+        origin = Geolocation(lat=48.895603, lon=2.322858)  # 32 rue des epinettes
+        to = Geolocation(lat=48.883588, lon=2.327195)  # place de clichy
+        (lat_min, lat_max), (lon_min, lon_max) = geolocation.bounding_box(origin, 1.4)
+        self.assertTrue(lat_min <= to.lat <= lat_max)
+        self.assertTrue(lon_min <= to.lon <= lon_max)
+
+        (lat_min, lat_max), (lon_min, lon_max) = geolocation.bounding_box(origin, 1.0)
+        self.assertFalse(lat_min <= to.lat <= lat_max)
+
+    def test_grid_cells(self):
+        origin = Geolocation(lat=48.895603, lon=2.322858)  # 32 rue des epinettes
+        to = Geolocation(lat=48.883588, lon=2.327195)  # place de clichy
+        self.assertEqual(geolocation.grid_cell(origin.lat, origin.lon), "488:23")
+        self.assertIn(geolocation.grid_cell(to.lat, to.lon), geolocation.grid_cells(origin, 1.4))
+        self.assertEqual(len(geolocation.grid_cells(origin, 1)), 2)  # close to the 48.9 latitude
+        self.assertIsNone(geolocation.grid_cells(origin, 1000))
+
     @patch("geopy.geocoders.GoogleV3.geocode")
     def test_geolocate(self, mock):
         mock.side_effect = geopy_exc.GeopyError
         self.assertRaises(errors.GeolocationError, geolocation.geolocate, "")
 
+    def test_dummy_geocode(self):
+        with self.settings(GEOCODER="famille.utils.geolocation.dummy_geocode"):
+            lat, lon = geolocation.geolocate("32 rue des Epinettes 75017 Paris")
+        self.assertEqual((lat, lon), geolocation.dummy_geocode("32 rue des epinettes, 75017 paris"))
+        self.assertTrue(43 <= lat <= 50)
+        self.assertTrue(-1 <= lon <= 7)
+
+    @patch("geopy.geocoders.GoogleV3.geocode")
+    def test_geolocate_cache(self, mock):
+        mock.return_value = "an address", (48.8, 2.3)
+        self.assertEqual(geolocation.geolocate("1 rue Truc, 75001 Paris"), (48.8, 2.3))
+        self.assertEqual(geolocation.geolocate("1 rue truc  75001 PARIS"), (48.8, 2.3))
+        self.assertEqual(mock.call_count, 1)
+
+        mock.return_value = None
+        self.assertRaises(errors.AddressNotFoundError, geolocation.geolocate, "nowhere")
+        self.assertRaises(errors.AddressNotFoundError, geolocation.geolocate, "Nowhere")
+        self.assertEqual(mock.call_count, 2)
+
+        # the quota / timeout errors are not cached
+        mock.side_effect = geopy_exc.GeocoderQuotaExceeded
+        self.assertRaises(errors.GeolocationError, geolocation.geolocate, "2 rue Truc, 75001 Paris")
+        mock.side_effect = None
+        mock.return_value = "an address", (48.9, 2.3)
+        self.assertEqual(geolocation.geolocate("2 rue Truc, 75001 Paris"), (48.9, 2.3))
+        self.assertEqual(mock.call_count, 4)
+
 
 class PythonTestCase(TestCase):
 
@@ -105,6 +186,10 @@ class PythonTestCase(TestCase):
         self.assertEqual(q, [1, 2])
         self.assertEqual(r, [3])
 
+    def test_chunks(self):
+        self.assertEqual(list(python.chunks(xrange(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(python.chunks([], 2)), [])
+
     def test_jsonencoder(self):
         d = date.today()
         dt = datetime.now()
@@ -116,11 +201,41 @@ class PythonTestCase(TestCase):
         t = python.generate_timestamp()
         self.assertIsInstance(t, int)
 
+    def test_lru_cache(self):
+        cache = python.LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)  # evicts b, least recently used
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats.as_dict(), {"hits": 2, "misses": 1, "ratio": 2 / 3.0})
+
+    def test_lru_cache_ttl(self):
+        cache = python.LRUCache(2, ttl=0)
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+    def test_fifo_cache(self):
+        cache = python.FIFOCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)  # evicts a, first inserted
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+
     def test_get_age_from_date(self):
         self.assertIsNone(python.get_age_from_date(None))
         d = date.today() - timedelta(days=360*10)
         self.assertEquals(python.get_age_from_date(d), 9)
 
+    def test_years_ago(self):
+        self.assertEqual(python.years_ago(date(2015, 3, 10), 16), date(1999, 3, 10))
+        self.assertEqual(python.years_ago(date(2016, 2, 29), 18), date(1998, 2, 28))
+
 
 class HTTPTestCase(TestCase):
 
@@ -168,6 +283,15 @@ class HTTPTestCase(TestCase):
         self.assertEqual(decorated(self.request), "success")
         self.assertEqual(self.request.related_user, self.famille)
 
+    @patch.dict("os.environ", {"QUOTAGUARD_URL": "http://proxy", "http_proxy": "http://old"})
+    def test_use_proxy_nested(self):
+        import os
+        with http.use_proxy():
+            with http.use_proxy():
+                self.assertEqual(os.environ["http_proxy"], "http://proxy")
+            self.assertEqual(os.environ["http_proxy"], "http://proxy")
+        self.assertEqual(os.environ["http_proxy"], "http://old")
+
     def test_jsonresponse(self):
         resp = http.JsonResponse({"toto": "tata"})
         self.assertEqual(resp.content, '{"toto": "tata"}')
@@ -254,6 +378,202 @@ DUMMY_IPN = {
 }
 
 
+class IndexTestCase(TestCase):
+
+    def setUp(self):
+        self.prestas = []
+        for i, (type, menage) in enumerate([("baby", True), ("nounou", True), ("baby", False)]):
+            user = User.objects.create_user("p%s" % i, "p%s@gmail.com" % i, "p")
+            presta = models.Prestataire(user=user, email=user.email, type=type, menage=menage)
+            presta.save()
+            self.prestas.append(presta)
+        self.index = index.CriteriaIndex(models.Prestataire, ["type", "menage"])
+
+    def tearDown(self):
+        models.Prestataire.objects.all().delete()
+        User.objects.all().delete()
+
+    def test_bitset(self):
+        bitset = index.build_bitset([3, 0, 17, 1000])
+        self.assertEqual(bitset, 1 | 1 << 3 | 1 << 17 | 1 << 1000)
+        self.assertEqual(index.bitset_ids(bitset), [0, 3, 17, 1000])
+        self.assertEqual(index.bitset_count(bitset), 4)
+        self.assertEqual(index.build_bitset([]), 0)
+        self.assertEqual(index.bitset_ids(0), [])
+
+    def test_query(self):
+        p1, p2, p3 = [p.pk for p in self.prestas]
+        query = lambda criteria: index.bitset_ids(self.index.query(criteria))
+        self.assertEqual(query({}), [p1, p2, p3])
+        self.assertEqual(query({"type": ["baby"]}), [p1, p3])
+        self.assertEqual(query({"type": ["baby", "nounou"], "menage": [True]}), [p1, p2])
+        self.assertEqual(query({"type": ["mamy"]}), [])
+
+    def test_facets(self):
+        self.assertEqual(self.index.facets(), {
+            "type": {"baby": 2, "nounou": 1},
+            "menage": {True: 2, False: 1}
+        })
+        bitset = self.index.query({"menage": [True]})
+        self.assertEqual(self.index.facets(bitset)["type"], {"baby": 1, "nounou": 1})
+
+    def test_update_remove(self):
+        self.index.connect()
+        try:
+            self.index.build()
+            p1, p2, p3 = self.prestas
+            p3.type = "nounou"
+            p3.save()
+            self.assertEqual(index.bitset_ids(self.index.query({"type": ["nounou"]})), [p2.pk, p3.pk])
+
+            p2.delete()
+            self.assertEqual(index.bitset_ids(self.index.query({"type": ["nounou"]})), [p3.pk])
+            self.assertEqual(index.bitset_ids(self.index.query({})), [p1.pk, p3.pk])
+        finally:
+            uid = "famille.criteria_index.Prestataire"
+            post_save.disconnect(sender=models.Prestataire, dispatch_uid=uid)
+            post_delete.disconnect(sender=models.Prestataire, dispatch_uid=uid)
+
+    def test_shared_version(self):
+        other = index.CriteriaIndex(models.Prestataire, ["type", "menage"])  # in another process
+        other.build()
+        self.index.connect()
+        try:
+            self.index.build()
+            self.assertFalse(other.is_stale)
+            p1, p2, p3 = self.prestas
+            p3.type = "nounou"
+            p3.save()
+            self.assertFalse(self.index.is_stale)
+            self.assertTrue(other.is_stale)
+            self.assertEqual(index.bitset_ids(other.query({"type": ["nounou"]})), [p2.pk, p3.pk])
+
+            models.Prestataire.objects.filter(pk=p1.pk).update(type="nounou")
+            self.index.invalidate()
+            self.assertTrue(self.index.is_stale)
+            self.assertTrue(other.is_stale)
+        finally:
+            uid = "famille.criteria_index.Prestataire"
+            post_save.disconnect(sender=models.Prestataire, dispatch_uid=uid)
+            post_delete.disconnect(sender=models.Prestataire, dispatch_uid=uid)
+
+    def test_max_age(self):
+        self.index.max_age = 60
+        self.assertTrue(self.index.is_stale)
+        self.index.build()
+        self.assertFalse(self.index.is_stale)
+        self.index._built_at -= 61
+        self.assertTrue(self.index.is_stale)
+
+
+class FulltextTestCase(TestCase):
+
+    def setUp(self):
+        self.prestas = []
+        texts = [u"Étudiante, j'adore les enfants", u"Garde d'enfants et aide aux devoirs", u"Nationalité française"]
+        for i, text in enumerate(texts):
+            user = User.objects.create_user("p%s" % i, "p%s@gmail.com" % i, "p")
+            presta = models.Prestataire(user=user, email=user.email, description=text)
+            presta.save()
+            self.prestas.append(presta)
+        self.index = fulltext.FulltextIndex(models.Prestataire, "search_text")
+
+    def tearDown(self):
+        models.Prestataire.objects.all().delete()
+        User.objects.all().delete()
+
+    def test_normalize(self):
+        self.assertEqual(fulltext.normalize(u"Éducatrice à l'École"), u"educatrice a l'ecole")
+        self.assertEqual(fulltext.normalize("Fran\xc3\xa7aise"), u"francaise")
+
+    def test_tokenize(self):
+        self.assertEqual(fulltext.tokenize(u"Les enfants de l'école"), [u"enfant", u"ecol"])
+        self.assertEqual(fulltext.tokenize(u"anglaise anglais"), [u"anglai", u"anglai"])
+        self.assertEqual(fulltext.tokenize(u"éducatrices éducateur"), [u"educ", u"educ"])
+        self.assertEqual(fulltext.tokenize(None), [])
+
+    def test_query(self):
+        p1, p2, p3 = [p.pk for p in self.prestas]
+        query = lambda text: [pk for pk, _ in self.index.query(text)]
+        self.assertEqual(sorted(query(u"enfant")), sorted([p1, p2]))
+        self.assertEqual(query(u"ENFANTS devoirs"), [p2])
+        self.assertEqual(query(u"francais"), [p3])
+        self.assertEqual(query(u"zzz"), [])
+        self.assertEqual(query(u"les"), [])
+
+    def test_ranking(self):
+        self.prestas[1].description = u"Enfants, enfants"
+        self.prestas[1].save()
+        self.index.build()
+        self.assertEqual([pk for pk, _ in self.index.query(u"enfants")], [self.prestas[1].pk, self.prestas[0].pk])
+
+    def test_update_remove(self):
+        self.index.connect()
+        try:
+            self.index.build()
+            p1, p2, p3 = self.prestas
+            p3.description = u"Baby-sitting des enfants"
+            p3.save()
+            self.assertEqual(sorted(pk for pk, _ in self.index.query(u"enfant")), sorted([p1.pk, p2.pk, p3.pk]))
+            self.assertEqual(self.index.query(u"francaise"), [])
+
+            p2.delete()
+            self.assertEqual(sorted(pk for pk, _ in self.index.query(u"enfant")), sorted([p1.pk, p3.pk]))
+        finally:
+            self.index.disconnect()
+
+
+class MatchingTestCase(TestCase):
+
+    def setUp(self):
+        self.weights = {"criteria": 3.0, "planning": 2.0, "distance": 2.0, "rating": 1.0, "premium": 0.5}
+        self.famille = models.Famille(
+            language="1,2", menage=True, availability=models.availability_mask([1], [1, 2]),
+            geolocation=Geolocation(lat=48.85, lon=2.35)
+        )
+
+    def get_row(self, scorer, pk=1, coords=(None, None), **kwargs):
+        presta = models.Prestataire(pk=pk, **kwargs)
+        values = {"pk": pk, "geolocation__lat": coords[0], "geolocation__lon": coords[1]}
+        return tuple(values.get(name, getattr(presta, name, None)) for name in scorer.fields)
+
+    def test_fields(self):
+        scorer = matching.MatchScorer(self.famille, models.Prestataire, self.weights, 10)
+        self.assertEqual(scorer.fields, [
+            "pk", "language", "menage", "availability_0", "availability_1",
+            "geolocation__lat", "geolocation__lon", "rating_avg", "plan"
+        ])
+        self.assertEqual(scorer.nb_criteria, 3)
+        self.assertEqual(scorer.nb_availability, 2)
+
+    def test_score(self):
+        scorer = matching.MatchScorer(self.famille, models.Prestataire, self.weights, 10)
+        self.assertEqual(scorer.score(self.get_row(scorer)), 0)
+        row = self.get_row(scorer, language="2,3", menage=True)
+        self.assertAlmostEqual(scorer.score(row), 3.0 * 2 / 3)
+        row = self.get_row(scorer, availability=models.availability_mask([1], [2, 3]))
+        self.assertAlmostEqual(scorer.score(row), 2.0 / 2)
+        row = self.get_row(scorer, coords=(48.85, 2.35), rating_avg=2.5, plan="premium")
+        self.assertAlmostEqual(scorer.score(row), 2.0 + 0.5 + 0.5)
+        row = self.get_row(scorer, coords=(48.85 + 10 / 111.2, 2.35))
+        self.assertAlmostEqual(scorer.score(row), 1.0, places=2)
+
+    def test_score_anonymous(self):
+        scorer = matching.MatchScorer(None, models.Prestataire, self.weights, 10)
+        self.assertEqual(scorer.fields, [
+            "pk", "availability_0", "availability_1",
+            "geolocation__lat", "geolocation__lon", "rating_avg", "plan"
+        ])
+        row = self.get_row(scorer, coords=(48.85, 2.35), rating_avg=5, language="1", plan="premium")
+        self.assertAlmostEqual(scorer.score(row), 1.5)
+
+    def test_top(self):
+        scorer = matching.MatchScorer(None, models.Prestataire, self.weights, 10)
+        rows = [self.get_row(scorer, pk=i, rating_avg=r) for i, r in enumerate([1, 5, 0, 3, 5])]
+        self.assertEqual([pk for _, pk in scorer.top(rows, 3)], [4, 1, 3])
+        self.assertEqual([pk for _, pk in scorer.top(rows)], [4, 1, 3, 0, 2])
+
+
 class PaymentTestCase(TestCase):
 
     def setUp(self):
@@ -405,6 +725,28 @@ class LookupTestCase(TestCase):
         results = list(self.lookup.get_query_results("to"))
         self.assertEqual(len(results), 2)
 
+    def test_get_query_results_bounded(self):
+        self.presta.name, self.famille.name = "B", "A"
+        self.famille.email = "test2@email.com"
+        self.presta.save()
+        self.famille.save()
+        with self.assertNumQueries(2):
+            results = self.lookup.get_query_results("toto")
+            self.assertEqual(results, [self.famille, self.presta])
+            self.assertEqual(results[1].user.username, self.user.username)
+
+        with patch.dict(settings.AUTOCOMPLETE, {"max_results": 1}):
+            self.assertEqual(self.lookup.get_query_results("toto"), [self.famille])
+        self.assertEqual(self.lookup.get_query_results("test2@"), [self.famille])
+
+    def test_get_results(self):
+        lookup.cache.clear()
+        self.assertEqual(self.lookup.get_results("  "), [])
+        expected = [self.lookup.format_result(self.presta), self.lookup.format_result(self.famille)]
+        self.assertEqual(sorted(self.lookup.get_results(u"Toto")), sorted(expected))
+        with self.assertNumQueries(0):
+            self.assertEqual(sorted(self.lookup.get_results(u"toto ")), sorted(expected))
+
     def test_format_result(self):
         expected = {
             "text": "Toto",
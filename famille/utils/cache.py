@@ -0,0 +1,51 @@
+from __future__ import absolute_import
+import base64
+from datetime import datetime
+
+try:
+    from django.utils.six.moves import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.core.cache.backends import db
+from django.db import connections, router
+from django.db.backends.util import typecast_timestamp
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+
+
+class DatabaseCache(db.DatabaseCache):
+    """
+    The database cache of django, shared by all the processes,
+    fetching several keys with one query in get_many (django
+    fetches them one by one).
+    """
+    def get_many(self, keys, version=None):
+        """
+        Fetch a bunch of keys from the cache.
+
+        :param keys:         the keys
+        :param version:      the version of the keys
+        """
+        keys = dict((self.make_key(key, version=version), key) for key in keys)
+        if not keys:
+            return {}
+        for key in keys:
+            self.validate_key(key)
+
+        connection = connections[router.db_for_read(self.cache_model_class)]
+        cursor = connection.cursor()
+        cursor.execute("SELECT cache_key, value, expires FROM %s WHERE cache_key IN (%s)" % (
+            connection.ops.quote_name(self._table), ", ".join(["%s"] * len(keys))
+        ), keys.keys())
+
+        now = timezone.now()
+        results = {}
+        for key, value, expires in cursor.fetchall():
+            if connection.features.needs_datetime_string_cast and not isinstance(expires, datetime):
+                expires = typecast_timestamp(str(expires))
+            if expires < now:  # removed by get or by the culling
+                continue
+            value = connection.ops.process_clob(value)
+            results[keys[key]] = pickle.loads(base64.b64decode(force_bytes(value)))
+        return results
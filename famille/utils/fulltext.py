@@ -0,0 +1,229 @@
+from __future__ import absolute_import
+from collections import defaultdict, Counter
+from math import log
+import re
+import threading
+import time
+import unicodedata
+
+from django.db.models.signals import post_save, post_delete
+
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+STOP_WORDS = frozenset([
+    "au", "aux", "avec", "ce", "ces", "dans", "de", "des", "du", "elle", "en", "et",
+    "il", "je", "la", "le", "les", "leur", "lui", "ma", "mais", "me", "mes", "mon",
+    "ne", "nous", "on", "ou", "par", "pas", "pour", "qu", "que", "qui", "sa", "se",
+    "ses", "son", "sur", "ta", "te", "tes", "ton", "tu", "un", "une", "vos", "votre",
+    "vous", "est", "sont", "ai", "as", "a", "y"
+])
+# the suffixes removed by stem, longest first, with their replacement
+SUFFIXES = (
+    ("issements", ""), ("issement", ""), ("atrices", ""), ("ateurs", ""), ("ations", ""),
+    ("atrice", ""), ("ateur", ""), ("ation", ""), ("ements", ""), ("ement", ""),
+    ("euses", ""), ("euse", ""), ("eurs", ""), ("eur", ""), ("ances", ""), ("ance", ""),
+    ("ences", ""), ("ence", ""), ("ismes", ""), ("isme", ""), ("istes", ""), ("iste", ""),
+    ("ables", ""), ("able", ""), ("ives", ""), ("ive", ""), ("ifs", ""), ("if", ""),
+    ("aux", "al"), ("ees", ""), ("ee", ""), ("er", ""), ("ez", ""),
+)
+MIN_STEM_LENGTH = 3
+# the postgresql text search configuration, also used by the GIN indexes
+POSTGRESQL_CONFIG = "french"
+
+
+def normalize(text):
+    """
+    Lower case a text and remove its accents.
+
+    :param text:     the text
+    """
+    if not isinstance(text, unicode):
+        text = text.decode("utf-8")
+    text = unicodedata.normalize("NFKD", text)
+    return u"".join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def stem(word):
+    """
+    A light french stemmer: remove the derivational
+    suffix, then the plural and feminine marks.
+
+    :param word:     a normalized word
+    """
+    for suffix, replacement in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= MIN_STEM_LENGTH:
+            word = word[:-len(suffix)] + replacement
+            break
+    for mark in ("s", "x", "e", "s"):
+        if word.endswith(mark) and len(word) > MIN_STEM_LENGTH:
+            word = word[:-1]
+    return word
+
+
+def tokenize(text):
+    """
+    Return the stemmed terms of a text, without the stop words.
+
+    :param text:     the text
+    """
+    return [
+        stem(word) for word in WORD_RE.findall(normalize(text or u""))
+        if len(word) > 1 and word not in STOP_WORDS
+    ]
+
+
+def tsvector_sql(column):
+    """
+    Return the postgresql tsvector of a column, matching
+    the expression of the GIN indexes.
+
+    :param column:   the quoted column
+    """
+    return "to_tsvector('%s', %s)" % (POSTGRESQL_CONFIG, column)
+
+
+def tsquery_sql():
+    """
+    Return the postgresql tsquery of a text given as parameter.
+    """
+    return "plainto_tsquery('%s', %%s)" % POSTGRESQL_CONFIG
+
+
+class FulltextIndex(object):
+    """
+    An in-memory inverted index over a text field of a model, used
+    when the database has no full text search (see the postgresql
+    GIN index on the search_text of the users). The results are
+    ranked with BM25.
+
+    The index is built lazily, rebuilt when older than max_age and
+    updated on post_save / post_delete once connect is called.
+
+    :param model:        the indexed model
+    :param field:        the name of the indexed field
+    :param max_age:      the maximum age of the index in seconds, None for no limit
+    """
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, model, field, max_age=None):
+        self.model = model
+        self.field = field
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        self._postings = None
+        self._lengths = {}
+        self._built_at = None
+
+    def build(self):
+        """
+        Build the index from the database.
+        """
+        postings, lengths = defaultdict(dict), {}
+        for pk, text in self.model.objects.values_list("pk", self.field).iterator():
+            terms = Counter(tokenize(text))
+            lengths[pk] = sum(terms.itervalues())
+            for term, count in terms.iteritems():
+                postings[term][pk] = count
+
+        with self._lock:
+            self._postings = postings
+            self._lengths = lengths
+            self._built_at = time.time()
+
+    @property
+    def is_stale(self):
+        """
+        Return True if the index must be (re)built.
+        """
+        if self._postings is None:
+            return True
+        return self.max_age is not None and time.time() - self._built_at > self.max_age
+
+    def ensure_built(self):
+        """
+        Build the index if it is stale.
+        """
+        if self.is_stale:
+            self.build()
+
+    def remove(self, pk):
+        """
+        Remove an object from the index.
+
+        :param pk:       the primary key of the object
+        """
+        with self._lock:
+            if self._postings is None or self._lengths.pop(pk, None) is None:
+                return
+            for term in [t for t, docs in self._postings.iteritems() if pk in docs]:
+                del self._postings[term][pk]
+                if not self._postings[term]:
+                    del self._postings[term]
+
+    def update(self, obj):
+        """
+        Add or update an object in the index.
+
+        :param obj:      the model instance
+        """
+        terms = Counter(tokenize(getattr(obj, self.field)))
+        with self._lock:
+            if self._postings is None:
+                return
+            self.remove(obj.pk)
+            self._lengths[obj.pk] = sum(terms.itervalues())
+            for term, count in terms.iteritems():
+                self._postings[term][obj.pk] = count
+
+    def query(self, text):
+        """
+        Return the (pk, score) of the objects having all the
+        terms of the text, best first.
+
+        :param text:     the searched text
+        """
+        terms = set(tokenize(text))
+        if not terms:
+            return []
+
+        self.ensure_built()
+        with self._lock:
+            postings = [self._postings.get(term, {}) for term in terms]
+            nb_docs = len(self._lengths)
+            avg_length = float(sum(self._lengths.itervalues())) / max(nb_docs, 1) or 1.0
+            pks = set.intersection(*[set(docs) for docs in postings])
+            scores = dict.fromkeys(pks, 0.0)
+            for docs in postings:
+                idf = log(1 + (nb_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                for pk in pks:
+                    tf = docs[pk]
+                    norm = self.K1 * (1 - self.B + self.B * self._lengths[pk] / avg_length)
+                    scores[pk] += idf * tf * (self.K1 + 1) / (tf + norm)
+
+        return sorted(scores.iteritems(), key=lambda item: (-item[1], -item[0]))
+
+    def _on_save(self, sender, instance, raw=False, **kwargs):
+        if not raw:
+            self.update(instance)
+
+    def _on_delete(self, sender, instance, **kwargs):
+        self.remove(instance.pk)
+
+    @property
+    def dispatch_uid(self):
+        return "famille.fulltext_index.%s.%s" % (self.model.__name__, id(self))
+
+    def connect(self):
+        """
+        Keep the index up to date using the model signals.
+        """
+        post_save.connect(self._on_save, sender=self.model, weak=False, dispatch_uid=self.dispatch_uid)
+        post_delete.connect(self._on_delete, sender=self.model, weak=False, dispatch_uid=self.dispatch_uid)
+
+    def disconnect(self):
+        """
+        Stop updating the index.
+        """
+        post_save.disconnect(sender=self.model, dispatch_uid=self.dispatch_uid)
+        post_delete.disconnect(sender=self.model, dispatch_uid=self.dispatch_uid)
@@ -1,32 +1,121 @@
+import hashlib
 import logging
-from math import acos, cos, sin, radians
+from math import acos, cos, sin, radians, degrees, pi, floor
 import traceback
 
+from django.conf import settings
+from django.utils.module_loading import import_by_path
 from geopy import geocoders, exc as geopy_exc
 
 from famille import errors
 from famille.utils.http import use_proxy
+from famille.utils.python import CACHE_EVICTION_POLICIES
 
 
 EARTH_RADIUS =  6371.0  # in km
+CELL_SIZE = 0.1  # in degrees, ~11km of latitude
+MAX_GRID_CELLS = 1000
 
 
-def geolocate(address):
+def build_address_caches(config):
+    """
+    Build the caches of geolocated addresses: one for
+    the coordinates, one for the addresses that cannot
+    be geolocated.
+
+    :param config:          a dict like settings.GEOLOCATION_CACHE
+    """
+    CacheClass = CACHE_EVICTION_POLICIES[config.get("eviction", "lru")]
+    return (
+        CacheClass(config["size"], ttl=config["ttl"]),
+        CacheClass(config["size"], ttl=config["error_ttl"])
+    )
+
+
+address_cache, address_error_cache = build_address_caches(settings.GEOLOCATION_CACHE)
+
+
+def normalize_address(address):
+    """
+    Normalize an address so that the different ways of
+    writing the same address share the same cache entry.
+
+    :param address:         the address to normalize
+    """
+    return u" ".join(address.replace(",", " ").split()).lower()
+
+
+def geolocate(address, use_cache=True):
     """
     Geolocate an address, i.e. return its
-    GPS coordinates.
+    GPS coordinates. The results and the addresses
+    that are not found are cached, see settings.GEOLOCATION_CACHE.
+    The other errors (quota, timeout...) are not cached.
+
+    :param address:         the address to geolocalize
+    :param use_cache:       if False, the geocoder is called even if the address is cached
+    """
+    key = normalize_address(address)
+    if use_cache:
+        coordinates = address_cache.get(key)
+        if coordinates is not None:
+            return coordinates
+
+        if address_error_cache.get(key) is not None:
+            raise errors.AddressNotFoundError("Address '%s' cannot be found (cached)" % address)
+
+    try:
+        coordinates = _geocode(address)
+    except errors.AddressNotFoundError:
+        address_error_cache.set(key, True)
+        raise
+
+    address_cache.set(key, coordinates)
+    return coordinates
+
+
+def _geocode(address):
+    """
+    Call the geocoder defined by settings.GEOCODER.
+
+    :param address:         the address to geolocalize
+    """
+    return import_by_path(settings.GEOCODER)(address)
+
+
+def google_geocode(address):
+    """
+    Call the Google geocoding API.
 
     :param address:         the address to geolocalize
     """
     try:
         with use_proxy():
             geocoder = geocoders.GoogleV3(scheme="http")
-            _, (lat, lon) = geocoder.geocode(address)
-        return lat, lon
+            location = geocoder.geocode(address)
     except geopy_exc.GeopyError:
         logging.critical("Cannot geolocate address due to API error: %s", traceback.format_exc())
         raise errors.GeolocationError("Address '%s' cannot be geolocated" % address)
 
+    if location is None:
+        raise errors.AddressNotFoundError("Address '%s' cannot be found" % address)
+    _, (lat, lon) = location
+    return lat, lon
+
+
+def dummy_geocode(address):
+    """
+    A geocoder that does not call any API, useful for local
+    development and tests. It returns coordinates in France
+    that only depend on the address.
+
+    :param address:         the address to geolocalize
+    """
+    digest = hashlib.md5(normalize_address(address).encode("utf-8")).hexdigest()
+    lat = 43.0 + int(digest[:8], 16) % 7000 / 1000.0
+    lon = -1.0 + int(digest[8:16], 16) % 8000 / 1000.0
+    return lat, lon
+
 
 def geodistance(origin, to):
     """
@@ -58,3 +147,91 @@ def is_close_enough(origin, to, distance):
         raise ValueError("One of the two points is missing")
 
     return geodistance(origin, to) <= distance
+
+
+def bounding_box(origin, distance):
+    """
+    Compute the box (in degrees) that contains every point
+    located at less than a given distance of a GPS point.
+    Useful to prefilter on indexed lat / lon columns.
+
+    :param origin:         a Geolocation model
+    :param distance:       the distance in km
+    :returns:              ((lat_min, lat_max), (lon_min, lon_max))
+    """
+    delta_lat = degrees(distance / EARTH_RADIUS)
+    delta_lon = degrees(distance / (EARTH_RADIUS * max(cos(radians(origin.lat)), 0.01)))
+    return (
+        (origin.lat - delta_lat, origin.lat + delta_lat),
+        (origin.lon - delta_lon, origin.lon + delta_lon)
+    )
+
+
+def grid_cell(lat, lon):
+    """
+    Return the key of the grid cell a GPS point belongs to.
+    The grid splits the world in CELL_SIZE x CELL_SIZE degrees cells.
+
+    :param lat:            the latitude
+    :param lon:            the longitude
+    """
+    return "%d:%d" % (floor(lat / CELL_SIZE), floor(lon / CELL_SIZE))
+
+
+def grid_cells(origin, distance):
+    """
+    Return the keys of the grid cells overlapping the
+    circle of a given radius around a GPS point. If the
+    circle overlaps too many cells (more than MAX_GRID_CELLS),
+    None is returned and the caller should use bounding_box.
+
+    :param origin:         a Geolocation model
+    :param distance:       the distance in km
+    """
+    (lat_min, lat_max), (lon_min, lon_max) = bounding_box(origin, distance)
+    lat_cells = range(int(floor(lat_min / CELL_SIZE)), int(floor(lat_max / CELL_SIZE)) + 1)
+    lon_cells = range(int(floor(lon_min / CELL_SIZE)), int(floor(lon_max / CELL_SIZE)) + 1)
+    if len(lat_cells) * len(lon_cells) > MAX_GRID_CELLS:
+        return None
+
+    return ["%d:%d" % (i, j) for i in lat_cells for j in lon_cells]
+
+
+def distance_sql(origin, distance, lat_column, lon_column):
+    """
+    Build the SQL condition that is true when a point is close
+    enough to the origin. This is the spherical law of cosines used
+    in geodistance, where acos has been removed by comparing with
+    cos(distance / EARTH_RADIUS) (acos is decreasing).
+
+    :param origin:         a Geolocation model
+    :param distance:       the distance in km
+    :param lat_column:     the (quoted) SQL latitude column
+    :param lon_column:     the (quoted) SQL longitude column
+    :returns:              the SQL condition and its parameters
+    """
+    sql = (
+        "%%s * sin(radians(%(lat)s)) + %%s * cos(radians(%(lat)s)) * cos(radians(%(lon)s - %%s)) >= %%s"
+        % {"lat": lat_column, "lon": lon_column}
+    )
+    lat = radians(origin.lat)
+    params = [sin(lat), cos(lat), origin.lon, cos(min(distance / EARTH_RADIUS, pi))]
+    return sql, params
+
+
+def register_sqlite_functions(sender, connection, **kwargs):
+    """
+    SQLite has no trigonometric functions, which are needed
+    by distance_sql. This will be connected to the connection_created
+    signal.
+
+    :param connection:     the database connection
+    """
+    if connection.vendor != "sqlite":
+        return
+
+    def null_safe(func):
+        return lambda value: None if value is None else func(value)
+
+    for name, func in (("sin", sin), ("cos", cos), ("radians", radians)):
+        connection.connection.create_function(name, 1, null_safe(func))
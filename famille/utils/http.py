@@ -1,6 +1,8 @@
+from __future__ import absolute_import
 from contextlib import contextmanager
 import json
 import os
+import threading
 
 from django.contrib.auth.decorators import login_required as django_login_required
 from django.core.exceptions import ObjectDoesNotExist
@@ -71,16 +73,28 @@ class JsonResponse(HttpResponse):
         )
 
 
+_proxy_lock = threading.Lock()
+_proxy_state = {"users": 0, "http_proxy": None}
+
+
 @contextmanager
 def use_proxy():
     """
-    A context manager to use an HTTP proxy.
+    A context manager to use an HTTP proxy. It can be
+    used by several threads at the same time: the environment
+    is restored when the last one exits.
     """
-    _http_proxy = os.environ.get("http_proxy")
+    with _proxy_lock:
+        if not _proxy_state["users"]:
+            _proxy_state["http_proxy"] = os.environ.get("http_proxy")
+            os.environ['http_proxy'] = os.environ['QUOTAGUARD_URL']
+        _proxy_state["users"] += 1
     try:
-        os.environ['http_proxy'] = os.environ['QUOTAGUARD_URL']
         yield
     finally:
-        os.environ.pop("http_proxy")
-        if _http_proxy:
-            os.environ['http_proxy'] = _http_proxy
+        with _proxy_lock:
+            _proxy_state["users"] -= 1
+            if not _proxy_state["users"]:
+                os.environ.pop("http_proxy")
+                if _proxy_state["http_proxy"]:
+                    os.environ['http_proxy'] = _proxy_state["http_proxy"]
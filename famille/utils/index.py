@@ -0,0 +1,225 @@
+from __future__ import absolute_import
+import binascii
+from collections import defaultdict
+import threading
+import time
+import uuid
+
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+
+
+def build_bitset(ids):
+    """
+    Build a bitset (a python integer) with
+    the bits of the given ids set.
+
+    :param ids:      the integer ids
+    """
+    ids = list(ids)
+    if not ids:
+        return 0
+    data = bytearray(max(ids) / 8 + 1)
+    for i in ids:
+        data[i >> 3] |= 1 << (i & 7)
+    data.reverse()
+    return int(binascii.hexlify(data), 16)
+
+
+def bitset_ids(bitset):
+    """
+    Return the ids set in a bitset, ordered.
+
+    :param bitset:   the bitset
+    """
+    bits = bin(bitset)[:1:-1]
+    return [i for i, bit in enumerate(bits) if bit == "1"]
+
+
+def bitset_count(bitset):
+    """
+    Return the number of ids set in a bitset.
+
+    :param bitset:   the bitset
+    """
+    return bin(bitset).count("1")
+
+
+class CriteriaIndex(object):
+    """
+    An in-memory index over some fields of a model. It keeps
+    one bitset per (field, value) over the primary keys, so that
+    any combination of criteria is answered with bitwise operations.
+
+    The index is built lazily, rebuilt when older than max_age and
+    updated on post_save / post_delete once connect is called. The
+    signals also change the version of the index in the cache shared
+    by the processes, so that the indexes of the other processes are
+    rebuilt. The changes that send no signal (queryset.update) are
+    only seen after max_age, or after a call to invalidate.
+
+    :param model:        the indexed model
+    :param fields:       the names of the indexed fields
+    :param max_age:      the maximum age of the index in seconds, None for no limit
+    """
+    def __init__(self, model, fields, max_age=None):
+        self.model = model
+        self.fields = tuple(fields)
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        self._bitsets = None
+        self._all = 0
+        self._built_at = None
+        self._version = None
+
+    @property
+    def version_key(self):
+        return "famille.criteria_index.%s" % self.model.__name__
+
+    def get_version(self):
+        """
+        Return the version of the index shared by the processes.
+        """
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, uuid.uuid4().hex, None)
+            version = cache.get(self.version_key)
+        return version
+
+    def invalidate(self):
+        """
+        Make the indexes of all the processes rebuild,
+        return the new version.
+        """
+        version = uuid.uuid4().hex
+        cache.set(self.version_key, version, None)
+        return version
+
+    def build(self):
+        """
+        Build the index from the database.
+        """
+        version = self.get_version()
+        ids = defaultdict(list)
+        all_ids = []
+        for row in self.model.objects.values_list("pk", *self.fields).iterator():
+            all_ids.append(row[0])
+            for field, value in zip(self.fields, row[1:]):
+                ids[(field, value)].append(row[0])
+
+        bitsets = dict((key, build_bitset(values)) for key, values in ids.iteritems())
+        with self._lock:
+            self._bitsets = bitsets
+            self._all = build_bitset(all_ids)
+            self._built_at = time.time()
+            self._version = version
+
+    @property
+    def is_stale(self):
+        """
+        Return True if the index must be (re)built.
+        """
+        if self._bitsets is None:
+            return True
+        if self.max_age is not None and time.time() - self._built_at > self.max_age:
+            return True
+        return self.get_version() != self._version
+
+    def ensure_built(self):
+        """
+        Build the index if it is stale.
+        """
+        if self.is_stale:
+            self.build()
+
+    def remove(self, pk):
+        """
+        Remove an object from the index.
+
+        :param pk:       the primary key of the object
+        """
+        bit = 1 << pk
+        with self._lock:
+            if self._bitsets is None:
+                return
+            self._all &= ~bit
+            for key, bitset in self._bitsets.iteritems():
+                if bitset & bit:
+                    self._bitsets[key] = bitset & ~bit
+
+    def update(self, obj):
+        """
+        Add or update an object in the index.
+
+        :param obj:      the model instance
+        """
+        bit = 1 << obj.pk
+        with self._lock:
+            if self._bitsets is None:
+                return
+            self.remove(obj.pk)
+            self._all |= bit
+            for field in self.fields:
+                key = (field, getattr(obj, field))
+                self._bitsets[key] = self._bitsets.get(key, 0) | bit
+
+    def query(self, criteria):
+        """
+        Return the bitset of the objects matching the criteria,
+        i.e. for each field, one of the values.
+
+        :param criteria:     a dict field -> list of values
+        """
+        self.ensure_built()
+        with self._lock:
+            result = self._all
+            for field, values in criteria.iteritems():
+                matching = 0
+                for value in values:
+                    matching |= self._bitsets.get((field, value), 0)
+                result &= matching
+        return result
+
+    def facets(self, bitset=None):
+        """
+        Return the number of objects for each value of each
+        field, among the objects of the bitset (all by default).
+
+        :param bitset:       the bitset to count in
+        """
+        self.ensure_built()
+        facets = defaultdict(dict)
+        with self._lock:
+            bitset = self._all if bitset is None else bitset
+            for (field, value), values in self._bitsets.iteritems():
+                count = bitset_count(values & bitset)
+                if count:
+                    facets[field][value] = count
+        return dict(facets)
+
+    def changed(self):
+        """
+        Change the shared version after a change applied to the index,
+        keeping the index if it was up to date with the other processes.
+        """
+        up_to_date = self._version is not None and self.get_version() == self._version
+        version = self.invalidate()
+        if up_to_date:
+            self._version = version
+
+    def _on_save(self, sender, instance, raw=False, **kwargs):
+        if not raw:
+            self.update(instance)
+            self.changed()
+
+    def _on_delete(self, sender, instance, **kwargs):
+        self.remove(instance.pk)
+        self.changed()
+
+    def connect(self):
+        """
+        Keep the index up to date using the model signals.
+        """
+        uid = "famille.criteria_index.%s" % self.model.__name__
+        post_save.connect(self._on_save, sender=self.model, weak=False, dispatch_uid=uid)
+        post_delete.connect(self._on_delete, sender=self.model, weak=False, dispatch_uid=uid)
@@ -1,16 +1,56 @@
-from itertools import chain
+import hashlib
+import heapq
 
+from django.conf import settings
+from django.core.cache import get_cache
 from django.db.models import Q
 
 from famille.models import Famille, Prestataire, has_user_related, get_user_related
 
 
+# the results are cached by each process, only for a short time
+cache = get_cache("local")
+
+
 class PostmanUserLookup(object):
+    """
+    The lookup of the recipients of messages. The matching users
+    are fetched with one bounded query per user class (see
+    settings.AUTOCOMPLETE), backed by trigram indexes on postgresql,
+    and the formatted results are cached by the process for a short time.
+    """
+    model_classes = (Prestataire, Famille)
+
+    def get_results(self, query):
+        """
+        Return the formatted results of a query, from
+        the cache if the query was recently done.
+
+        :param query:         the query
+        """
+        query = (query or "").strip()
+        if not query:
+            return []
+
+        cache_key = "famille.lookup.%s" % hashlib.md5(query.lower().encode("utf-8")).hexdigest()
+        results = cache.get(cache_key)
+        if results is None:
+            results = [self.format_result(obj) for obj in self.get_query_results(query)]
+            cache.set(cache_key, results, settings.AUTOCOMPLETE["cache_timeout"])
+        return results
 
     def get_query_results(self, query):
-        q_prestataire = self.get_queryset_from_model(Prestataire, query)
-        q_famille = self.get_queryset_from_model(Famille, query)
-        return chain(q_prestataire, q_famille)
+        """
+        Return the first users matching the query, ordered by name.
+
+        :param query:         the query
+        """
+        max_results = settings.AUTOCOMPLETE["max_results"]
+        querysets = [
+            self.get_queryset_from_model(model_class, query)[:max_results]
+            for model_class in self.model_classes
+        ]
+        return heapq.nsmallest(max_results, (obj for qs in querysets for obj in qs), key=lambda obj: obj.name)
 
     def format_result(self, obj):
         return {
@@ -41,4 +81,4 @@ class PostmanUserLookup(object):
             Q(name__icontains=query) |
             Q(email__istartswith=query) |
             Q(first_name__icontains=query)
-        ).order_by('name')
+        ).select_related("user").order_by('name')
@@ -0,0 +1,171 @@
+import heapq
+from math import acos, cos, sin, radians
+
+from famille.utils.geolocation import EARTH_RADIUS
+
+
+MAX_RATING = 5.0
+
+
+def bit_count(mask):
+    """
+    Return the number of bits set in a mask.
+
+    :param mask:     the mask
+    """
+    return bin(mask).count("1")
+
+
+class MatchScorer(object):
+    """
+    Score the candidates of a search against the profile of the searcher
+    (a Famille or a Prestataire, or None): overlap of the criteria, overlap
+    of the plannings (see Criteria.availability), distance, rating and
+    premium plan, each between 0 and 1, are summed with the given weights.
+
+    The candidates are scored from the rows of a values_list (see fields),
+    the searcher side being computed once, so that the scores of a whole
+    candidate set are computed in one pass.
+
+    :param searcher:       the profile of the searcher, or None
+    :param model:          the model of the candidates
+    :param weights:        a dict criteria / planning / distance / rating / premium -> weight
+    :param distance_scale: in km, the distance at which the distance score is 0.5
+    """
+    def __init__(self, searcher, model, weights, distance_scale):
+        self.model = model
+        self.weights = weights
+        self.distance_scale = float(distance_scale)
+        self.premium = model.PLANS["premium"]
+
+        self.criteria = []
+        self.booleans = []
+        self.availability = 0
+        self.origin = None
+        if searcher is not None:
+            for name in model.CRITERIA_FIELDS:
+                values = set(v for v in (getattr(searcher, name) or "").split(",") if v)
+                if values:
+                    self.criteria.append((name, values))
+            self.booleans = [name for name in model.MATCH_BOOLEAN_FIELDS if getattr(searcher, name)]
+            self.availability = searcher.availability
+            if searcher.is_geolocated:
+                lat = radians(searcher.geolocation.lat)
+                self.origin = (sin(lat), cos(lat), radians(searcher.geolocation.lon))
+
+        self.nb_criteria = sum(len(values) for _, values in self.criteria) + len(self.booleans)
+        self.nb_availability = bit_count(self.availability)
+        self.nb_words = len(model.AVAILABILITY_FIELDS)
+
+    @property
+    def fields(self):
+        """
+        The fields of the values_list rows given to score.
+        """
+        return (
+            ["pk"] + [name for name, _ in self.criteria] + self.booleans +
+            list(self.model.AVAILABILITY_FIELDS) +
+            ["geolocation__lat", "geolocation__lon", "rating_avg", "plan"]
+        )
+
+    def score(self, row):
+        """
+        Return the score of a candidate.
+
+        :param row:      the values of the fields of the candidate
+        """
+        weights = self.weights
+        score, i = 0.0, 1
+
+        if self.nb_criteria:
+            common = 0
+            for _, values in self.criteria:
+                common += len(values.intersection((row[i] or "").split(",")))
+                i += 1
+            for _ in self.booleans:
+                common += 1 if row[i] else 0
+                i += 1
+            score += weights["criteria"] * float(common) / self.nb_criteria
+
+        availability = 0
+        for j, word in enumerate(row[i:i + self.nb_words]):
+            availability |= word << (j * self.model.AVAILABILITY_BITS)
+        i += self.nb_words
+        if self.nb_availability:
+            score += weights["planning"] * float(bit_count(availability & self.availability)) / self.nb_availability
+
+        lat, lon, rating, plan = row[i:i + 4]
+        if self.origin is not None and lat is not None and lon is not None:
+            sin1, cos1, lon1 = self.origin
+            lat2 = radians(lat)
+            cosine = sin1 * sin(lat2) + cos1 * cos(lat2) * cos(radians(lon) - lon1)
+            distance = acos(max(-1.0, min(1.0, cosine))) * EARTH_RADIUS
+            score += weights["distance"] * self.distance_scale / (self.distance_scale + distance)
+
+        score += weights["rating"] * (rating or 0) / MAX_RATING
+        if plan == self.premium:
+            score += weights["premium"]
+        return score
+
+    def top(self, rows, k=None):
+        """
+        Return the (score, pk) of the k best candidates, best first,
+        using a bounded heap. All of them are returned if k is None.
+
+        :param rows:     the values_list rows of the candidates
+        :param k:        the number of candidates returned
+        """
+        scored = ((self.score(row), row[0]) for row in rows)
+        if k is None:
+            return sorted(scored, reverse=True)
+        return heapq.nlargest(k, scored)
+
+
+class MatchResults(object):
+    """
+    The results of a search ordered by match (see MatchScorer), lazily:
+    the candidates are only scored when a slice is requested, keeping
+    the best ones up to the end of the slice, and the objects of the
+    slice are then fetched from the given queryset.
+
+    :param candidates:     the queryset of the candidates
+    :param scorer:         a MatchScorer
+    :param queryset:       the queryset the results are fetched from
+    """
+    def __init__(self, candidates, scorer, queryset):
+        self.candidates = candidates
+        self.scorer = scorer
+        self.queryset = queryset
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self.candidates.count()
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def rank(self, k=None):
+        """
+        Return the (score, pk) of the k best candidates.
+
+        :param k:        the number of candidates, all if None
+        """
+        rows = self.candidates.prefetch_related(None).values_list(*self.scorer.fields)
+        return self.scorer.top(rows.iterator(), k)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        if key.step is not None or (key.start or 0) < 0 or (key.stop is not None and key.stop < 0):
+            raise ValueError("Only positive slices are supported.")
+
+        ranked = self.rank(key.stop)[key.start:]
+        objects = self.queryset.in_bulk([pk for _, pk in ranked])
+        results = []
+        for score, pk in ranked:
+            obj = objects[pk]
+            obj.match_score = score
+            results.append(obj)
+        return results
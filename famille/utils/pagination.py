@@ -0,0 +1,191 @@
+import base64
+from datetime import date
+import json
+from urllib import urlencode
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import QuerySet
+from tastypie.exceptions import BadRequest
+from tastypie.paginator import Paginator
+
+
+def encode_cursor(names, values, backwards=False):
+    """
+    Build an opaque cursor from the ordering and from
+    the values of the row to start after.
+
+    :param names:        the ordering of the queryset
+    :param values:       the values of the ordering fields
+    :param backwards:    if the cursor points to the previous rows
+    """
+    values = [v.isoformat() if isinstance(v, date) else v for v in values]
+    payload = json.dumps({"o": list(names), "v": values, "b": backwards})
+    return base64.urlsafe_b64encode(payload)
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor built with encode_cursor. Return the
+    ordering, the raw values and the direction.
+
+    :param cursor:       the cursor
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        return payload["o"], payload["v"], payload["b"]
+    except (TypeError, ValueError, KeyError, UnicodeEncodeError):
+        raise BadRequest("Invalid cursor '%s' provided." % cursor)
+
+
+class CursorPaginator(Paginator):
+    """
+    A paginator using keyset pagination when the objects are a queryset
+    ordered by non null fields of the model ending with the primary key,
+    e.g. (-updated_at, -id): each page is fetched with a filter on the
+    values of the last row of the previous one, so that any page costs
+    the same as the first one. The pages are linked using an opaque
+    ``cursor`` GET parameter.
+
+    Otherwise (lists, unknown orderings), it falls back to the offset
+    pagination of tastypie.
+    """
+
+    def get_ordering(self):
+        """
+        Return the ordering of the objects as a list of
+        (name, field, descending), or None if it cannot
+        be used for keyset pagination.
+        """
+        if not isinstance(self.objects, QuerySet):
+            return None
+
+        opts = self.objects.model._meta
+        ordering = []
+        for name in self.objects.query.order_by:
+            descending = name.startswith("-")
+            name = name.lstrip("-")
+            try:
+                field = opts.pk if name == "pk" else opts.get_field(name)
+            except FieldDoesNotExist:
+                return None
+            if field.null:
+                return None
+            ordering.append(("-" + name if descending else name, field, descending))
+
+        if not ordering or not ordering[-1][1].primary_key:
+            return None
+        return ordering
+
+    def get_cursor_filter(self, ordering, values, backwards):
+        """
+        Return the filter selecting the rows after (or before
+        if backwards) the given values, in the given ordering.
+
+        :param ordering:     the ordering, see get_ordering
+        :param values:       the values of the ordering fields
+        :param backwards:    if the rows before are selected
+        """
+        query, equal = None, {}
+        for (_, field, descending), value in zip(ordering, values):
+            lookup = "lt" if descending != backwards else "gt"
+            after = Q(**equal) & Q(**{"%s__%s" % (field.attname, lookup): value})
+            query = after if query is None else query | after
+            equal[field.attname] = value
+        return query
+
+    def get_cursor_values(self, ordering, cursor):
+        """
+        Decode the cursor, checking that it matches the ordering.
+
+        :param ordering:     the ordering, see get_ordering
+        :param cursor:       the cursor
+        """
+        names, values, backwards = decode_cursor(cursor)
+        if names != [name for name, _, _ in ordering] or len(values) != len(ordering):
+            raise BadRequest("Invalid cursor '%s' provided." % cursor)
+
+        try:
+            values = [field.to_python(value) for (_, field, _), value in zip(ordering, values)]
+        except ValidationError:
+            raise BadRequest("Invalid cursor '%s' provided." % cursor)
+        return values, bool(backwards)
+
+    def get_cursor(self, ordering, obj, backwards=False):
+        """
+        Return the cursor of the rows after (or before) an object.
+
+        :param ordering:     the ordering, see get_ordering
+        :param obj:          the object
+        :param backwards:    if the cursor points to the previous rows
+        """
+        names = [name for name, _, _ in ordering]
+        values = [getattr(obj, field.attname) for _, field, _ in ordering]
+        return encode_cursor(names, values, backwards)
+
+    def _generate_cursor_uri(self, limit, cursor):
+        if self.resource_uri is None or cursor is None:
+            return None
+
+        request_params = self.request_data.copy()
+        for key in ("limit", "offset", "cursor"):
+            request_params.pop(key, None)
+        request_params["limit"] = limit
+        request_params["cursor"] = cursor
+        try:
+            encoded_params = request_params.urlencode()
+        except AttributeError:
+            encoded_params = urlencode(request_params)
+
+        return "%s?%s" % (self.resource_uri, encoded_params)
+
+    def page(self):
+        """
+        Generate the requested page, using the cursor if
+        any, or the offset for the first pages.
+        """
+        ordering = self.get_ordering()
+        cursor = self.request_data.get("cursor")
+        if ordering is None:
+            if cursor:
+                raise BadRequest("A cursor cannot be used with this ordering.")
+            return super(CursorPaginator, self).page()
+
+        limit = self.get_limit()
+        count = self.get_count()
+        objects, offset, backwards = self.objects, None, False
+        if cursor:
+            values, backwards = self.get_cursor_values(ordering, cursor)
+            objects = objects.filter(self.get_cursor_filter(ordering, values, backwards))
+            if backwards:
+                objects = objects.reverse()
+        else:
+            offset = self.get_offset()
+            objects = objects[offset:]
+
+        objects = list(objects[:limit + 1] if limit else objects)
+        has_more = bool(limit) and len(objects) > limit
+        if has_more:
+            objects = objects[:limit]
+        if backwards:
+            objects.reverse()
+
+        next_cursor = previous_cursor = None
+        if objects:
+            if has_more or backwards:
+                next_cursor = self.get_cursor(ordering, objects[-1])
+            if (has_more and backwards) or (not backwards and (cursor or offset)):
+                previous_cursor = self.get_cursor(ordering, objects[0], backwards=True)
+
+        return {
+            self.collection_name: objects,
+            "meta": {
+                "limit": limit,
+                "offset": offset,
+                "cursor": cursor,
+                "next": self._generate_cursor_uri(limit, next_cursor),
+                "previous": self._generate_cursor_uri(limit, previous_cursor),
+                "total_count": count,
+            }
+        }
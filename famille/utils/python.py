@@ -1,6 +1,9 @@
+from __future__ import absolute_import
+from collections import OrderedDict
 import datetime
 from itertools import islice
 import json
+import threading
 import time
 
 
@@ -59,6 +62,22 @@ def isplit(iterable, index):
     return islice(iterable, index), islice(iterable, index, None)
 
 
+def chunks(iterable, size):
+    """
+    Split an iterable into lists of at most size items,
+    consuming it lazily.
+
+    :param iterable:     the iterable to split
+    :param size:         the size of the lists
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 class JSONEncoder(json.JSONEncoder):
     """
     Custom encoder to user when encoding object not
@@ -88,3 +107,114 @@ def get_age_from_date(born):
     if not born:
         return None
     return today.year - born.year - ((today.month, today.day) < (born.month, born.day))
+
+
+def years_ago(today, years):
+    """
+    Return the date a number of years before today,
+    the 29th of February becoming the 28th.
+
+    :param today:        the date to start from
+    :param years:        the number of years
+    """
+    try:
+        return today.replace(year=today.year - years)
+    except ValueError:
+        return today.replace(year=today.year - years, day=28)
+
+
+class CacheStats(object):
+    """
+    Count the hits and misses of a cache.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def hit(self):
+        self.hits += 1
+
+    def miss(self):
+        self.misses += 1
+
+    @property
+    def ratio(self):
+        """
+        The hit ratio, None if the cache was never queried.
+        """
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else None
+
+    def as_dict(self):
+        return {"hits": self.hits, "misses": self.misses, "ratio": self.ratio}
+
+
+class LRUCache(object):
+    """
+    A bounded in-process cache, evicting the least
+    recently used key when full.
+
+    :param maxsize:      the maximum number of keys
+    :param ttl:          the time to live of the keys in seconds,
+                         None if they never expire
+    """
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires_at, value = self._data[key]
+            except KeyError:
+                self.stats.miss()
+                return default
+
+            if expires_at is not None and expires_at <= time.time():
+                del self._data[key]
+                self.stats.miss()
+                return default
+
+            self._touch(key)
+            self.stats.hit()
+            return value
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires_at, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.stats = CacheStats()
+
+    def _touch(self, key):
+        """
+        Mark a key as recently used.
+        """
+        self._data[key] = self._data.pop(key)
+
+
+class FIFOCache(LRUCache):
+    """
+    A bounded in-process cache, evicting the oldest
+    inserted key when full.
+    """
+    def _touch(self, key):
+        pass
+
+
+CACHE_EVICTION_POLICIES = {
+    "lru": LRUCache,
+    "fifo": FIFOCache
+}
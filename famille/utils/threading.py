@@ -1,4 +1,7 @@
+from __future__ import absolute_import
 import multiprocessing
+import threading
+import time
 
 
 def async(func):
@@ -13,3 +16,26 @@ def async(func):
         process.start()
 
     return wrapped
+
+
+class RateLimiter(object):
+    """
+    Limit the number of calls per second, among
+    several threads. Call wait before each call.
+
+    :param rate:     the maximum number of calls per second,
+                     no limit if None or 0
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next_call = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            delay = self._next_call - now
+            self._next_call = max(now, self._next_call) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
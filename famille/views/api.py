@@ -104,12 +104,8 @@ def message_autocomplete(request):
     if not lookup.check_auth(request):
         return JsonResponse(status=403)
 
-    query = request.GET.get("query")
-    results = lookup.get_query_results(query)
-    data = [lookup.format_result(result) for result in results]
-
     return JsonResponse({
-        "objects": data
+        "objects": lookup.get_results(request.GET.get("query"))
     })
 
 
@@ -1,5 +1,6 @@
 # -*- coding=utf-8 -*-
 from collections import defaultdict
+import json
 
 from django.conf import settings
 from django.contrib.auth import logout
@@ -54,13 +55,15 @@ def search(request):
     """
     data = request.POST if request.method == "POST" else request.GET
     search_type = data.get("type")
+    is_premium = False
     if request.user.is_authenticated():
         related = get_user_related(request.user)
-        favorites = related.favorites.all()
+        favorites = related.get_favorite_keys()
+        is_premium = related.is_premium
         if not search_type and isinstance(related, Prestataire):
             search_type = "famille"
     else:
-        favorites = []
+        favorites = set()
 
     search_type = "prestataire" if search_type not in ["famille", "prestataire"] else search_type
     if search_type == "famille":
@@ -79,13 +82,15 @@ def search(request):
 
     if data.get("postal_code"):
         objects = objects.filter(Q(postal_code=data["postal_code"]) | Q(city=data["postal_code"]))
-    objects = objects.order_by("-updated_at")
-    objects = [obj for obj in objects if obj.visibility_score_is_enough]
+    objects = objects.model.filter_visible(objects).order_by("-updated_at", "-id")
 
-    total_search_results = len(objects)
+    total_search_results = objects.count()
     nb_search_results = min(settings.NB_SEARCH_RESULTS, total_search_results)
     objects = objects[:nb_search_results]
     result_template = get_result_template_from_user(request, search_type)
+    # the cards of premium users depend on them (rating forms), they
+    # are rendered by the server, the others from the compact format
+    compact_template = None if is_premium else "search/results/compact_%s.html" % search_type
     return render(
         request, template,
         get_context(
@@ -93,7 +98,8 @@ def search(request):
             nb_search_results=nb_search_results, ordering=form.ordering_dict,
             favorites=favorites, user=request.user, search_type=search_type,
             max_nb_search_results=settings.NB_SEARCH_RESULTS,
-            total_search_results=total_search_results
+            total_search_results=total_search_results,
+            compact_template=compact_template, badges=json.dumps(objects.model.BADGES)
         )
     )
 